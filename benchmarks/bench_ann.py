@@ -0,0 +1,111 @@
+"""Recall and latency of the IVF index (python_rag_ann) against exact search.
+
+Builds a NumpyVectorStore (or, with --mapped, a MappedVectorStore written with ann=True)
+from synthetic clustered embeddings, adding rows in batches like ingest does so the index
+trains and then grows incrementally. Then it queries held-out vectors from the same
+clusters at each nprobe and reports recall@k against a brute force float32 scan and ms per
+query. The "scan" row is the store's own search without the index.
+
+    python benchmarks/bench_ann.py
+    python benchmarks/bench_ann.py --rows 200000 --nprobe 1,4,16,64 --mapped --output ann.json
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "iterations"))
+
+import python_rag_ann  # noqa: E402
+import python_rag_store  # noqa: E402
+
+
+def clustered_vectors(rows, dimensions, clusters, rng):
+    """Points scattered around random centres, so there's structure for k-means to find,
+    like embeddings of text about a limited number of topics"""
+    centres = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+    assigned = rng.integers(0, clusters, rows)
+    noise = rng.standard_normal((rows, dimensions), dtype=np.float32)
+    return centres[assigned] + 1.5 * noise
+
+
+def build_store(vectors, batch_size, mapped, path):
+    ids = [f"row-{i}" for i in range(len(vectors))]
+    start = time.perf_counter()
+    if mapped:
+        with python_rag_store.MappedStoreWriter(path, ann=True) as writer:
+            for i in range(0, len(vectors), batch_size):
+                writer.add(ids[i : i + batch_size], embeddings=vectors[i : i + batch_size])
+        store = python_rag_store.MappedVectorStore(path)
+    else:
+        store = python_rag_store.NumpyVectorStore(
+            "ann", dimensions=vectors.shape[1], index=python_rag_ann.IVFFlatIndex()
+        )
+        for i in range(0, len(vectors), batch_size):
+            store.add(ids[i : i + batch_size], embeddings=vectors[i : i + batch_size])
+    return store, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=500, help="topics in the synthetic data")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="comma separated")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per add()")
+    parser.add_argument(
+        "--mapped", default=False, action="store_true", help="benchmark MappedVectorStore"
+    )
+    parser.add_argument("--output", help="write results here as JSON")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = clustered_vectors(args.rows + args.queries, args.dimensions, args.clusters, rng)
+    queries, vectors = vectors[: args.queries], vectors[args.queries :]
+
+    with tempfile.TemporaryDirectory() as path:
+        store, build_seconds = build_store(vectors, args.batch_size, args.mapped, path)
+        index = store.index
+        print(
+            f"{args.rows} rows in {build_seconds:.1f}s, {index.nlist} lists "
+            f"(sizes {index.list_sizes().min()}-{index.list_sizes().max()})"
+        )
+        nprobes = [int(n) for n in args.nprobe.split(",")]
+        results = python_rag_ann.recall_at_k(store, queries, args.k, nprobes)
+
+    scan_ms = results[0]["ms_per_query"]
+    for result in results:
+        nprobe = "scan" if result["nprobe"] is None else result["nprobe"]
+        print(
+            f"nprobe {nprobe:>5}: recall@{args.k} {result['recall']:.3f}  "
+            f"{result['ms_per_query']:>7.3f} ms/query  "
+            f"({scan_ms / result['ms_per_query']:.1f}x scan)"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {
+                    "rows": args.rows,
+                    "dimensions": args.dimensions,
+                    "k": args.k,
+                    "nlist": index.nlist,
+                    "mapped": args.mapped,
+                    "build_seconds": build_seconds,
+                    "results": results,
+                },
+                file,
+            )
+
+
+if __name__ == "__main__":
+    main()
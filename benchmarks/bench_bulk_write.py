@@ -0,0 +1,84 @@
+"""Write throughput of python_rag_ingest.BulkWriter against a local chroma server.
+
+Starts a throwaway `chroma run` server (same as bench_rag.py), then upserts the same
+synthetic rows (random embeddings, short documents, a source in the metadata) into a fresh
+collection at each concurrency level and reports rows/sec. Every run is checked by counting
+the collection afterwards. Concurrency 1 is the one-batch-at-a-time baseline.
+
+    python benchmarks/bench_bulk_write.py
+    python benchmarks/bench_bulk_write.py --rows 50000 --concurrency 1,4,8 --output bulk.json
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+from bench_rag import chroma_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "iterations"))
+
+import python_rag_ingest  # noqa: E402
+
+
+def synthetic_rows(rows, dimensions, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = [f"row-{i}" for i in range(rows)]
+    documents = [f"Synthetic chunk {i} " + "lorem ipsum " * 20 for i in range(rows)]
+    embeddings = rng.standard_normal((rows, dimensions), dtype=np.float32)
+    metadatas = [{"source": f"file-{i % 100}.txt"} for i in range(rows)]
+    return ids, documents, embeddings, metadatas
+
+
+def bench(client, rows, concurrency, batch_size):
+    name = f"bulk_{concurrency}"
+    if name in [c.name for c in client.list_collections()]:
+        client.delete_collection(name)
+    collection = client.create_collection(name=name)
+    with python_rag_ingest.BulkWriter(
+        collection, batch_size=batch_size, max_concurrency=concurrency
+    ) as writer:
+        writer.upsert(*rows)
+    stats = writer.stats()
+    stats["concurrency"] = concurrency
+    stats["batch_size"] = writer.batch_size
+    stats["count_ok"] = collection.count() == len(rows[0])
+    client.delete_collection(name)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma separated")
+    parser.add_argument("--batch-size", type=int, help="rows per request (default: server's)")
+    parser.add_argument("--output", help="write results here as JSON")
+    args = parser.parse_args()
+
+    import chromadb
+
+    rows = synthetic_rows(args.rows, args.dimensions)
+    results = []
+    with chroma_server() as (host, port):
+        client = chromadb.HttpClient(host=host, port=port)
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            stats = bench(client, rows, concurrency, args.batch_size)
+            print(
+                f"concurrency {concurrency:>3}: {stats['rows_per_second']:>9.1f} rows/s "
+                f"({stats['batches']} batches of {stats['batch_size']}, "
+                f"{stats['retries']} retries, count {'ok' if stats['count_ok'] else 'WRONG'})"
+            )
+            results.append(stats)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"rows": args.rows, "dimensions": args.dimensions, "results": results}, file)
+    sys.exit(0 if all(r["count_ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,637 @@
+"""End-to-end latency benchmarks for the scripts in iterations/.
+
+Each script's ingest and query path is re-run, through the script's own helpers, against
+local stand-ins: the fake Ollama/Gemini server in fake_backends.py and a throwaway `chroma
+run` server for the persisted scripts. Every (script, corpus size) pair runs in its own
+process with an empty embedding cache and no snapshot, so peak RSS and import/model loading
+are measured from a cold start.
+
+    python benchmarks/bench_rag.py --scripts 2,4,5,6,7 --sizes 1,4,16
+    python benchmarks/bench_rag.py --baseline bench_results.json --output new_results.json
+
+Scripts 1, 3 and 8 use chroma's built-in ONNX model, which chroma downloads on first use.
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+
+import fake_backends
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+ITERATIONS_DIR = REPO_ROOT / "iterations"
+TEXT_SOURCE = REPO_ROOT / "data" / "escondido.txt"
+PDF_SOURCE = REPO_ROOT / "data" / "ticket-to-ride-rulebook.pdf"
+
+STAGES = ["load", "split", "embed", "add", "query", "prompt", "generate"]
+INGEST_STAGES = ["split", "embed", "add"]
+QUERY_STAGES = ["query", "prompt", "generate"]
+
+
+class StageTimer:
+    """Accumulates wall time per pipeline stage. A stage started inside another one (the
+    embedding done while a collection is being filled, say) only counts towards the inner
+    stage, so the stages add up to the time spent."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        # Time spent in the stages inside each stage that's running, innermost last
+        self._inner = [0.0]
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._inner.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self._inner.pop()
+            self._inner[-1] += elapsed
+
+    def timed(self, name, fn):
+        """`fn` with every call timed as stage `name`"""
+
+        def call(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        return call
+
+    def timed_iter(self, name, iterable):
+        """`iterable` with the time it takes to produce each item timed as stage `name`"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+
+_DONE = object()
+
+
+# Corpora. Every copy is made slightly different so that larger sizes really are more
+# unique chunks to embed rather than the same chunks again.
+
+
+def small_documents(size):
+    documents = ["This is a document about pineapple", "This is a document about oranges"]
+    return [f"{doc} (copy {i})" for i in range(size) for doc in documents]
+
+
+def text_corpus(size):
+    content = TEXT_SOURCE.read_text()
+    copies = []
+    for i in range(size):
+        copies.append("\n".join(f"{line} [{i}]" if line else line for line in content.split("\n")))
+    return "\n\n".join(copies)
+
+
+def query_list(query, count):
+    return [f"{query} ({i})" for i in range(count)]
+
+
+def split(text):
+    import python_rag_ingest
+
+    return python_rag_ingest.make_text_splitter().split_text(text)
+
+
+# One function per script. Each one goes through that script's own ingest and query path
+# (its helpers, the embedding cache, its snapshot and RagPipeline), with the corpus swapped
+# for one of the benchmark's size, and returns how many chunks it indexed. The embedding
+# cache and snapshots live in `workdir`, so every run starts cold.
+
+
+def bench_script_1(timer, size, queries, workdir):
+    import python_rag_common
+
+    with timer.stage("load"):
+        documents = small_documents(size)
+        embed_func = python_rag_common.get_chromadb_embedding_function()
+        collection = python_rag_common.create_ephemeral_collection("bench", embed_func)
+    with timer.stage("add"):
+        with timer.stage("embed"):
+            embeddings = embed_func(documents)
+        collection.add(documents=documents, embeddings=embeddings, ids=_ids(documents))
+    for query in query_list("A question about most florida juice", queries):
+        with timer.stage("query"):
+            collection.query(query_texts=query, n_results=2)
+    return len(documents)
+
+
+def bench_script_2(timer, size, queries, workdir):
+    import python_rag_common
+
+    script = _script(2)
+    with timer.stage("load"):
+        documents = small_documents(size)
+        collection = python_rag_common.create_ephemeral_collection("bench")
+    with timer.stage("embed"):
+        embeddings = python_rag_common.embed_texts_ollama(
+            documents, "nomic-embed-text", cache=python_rag_common.get_embedding_cache()
+        )
+    with timer.stage("add"):
+        collection.add(documents=documents, embeddings=embeddings, ids=_ids(documents))
+    for query in query_list("This is a query about spikey hawaiian fruit", queries):
+        with timer.stage("query"):
+            query_embedding = script.get_embeddings_for_input(query, "nomic-embed-text")
+            collection.query(query_embeddings=query_embedding, n_results=2)
+    return len(documents)
+
+
+def bench_script_3(timer, size, queries, workdir):
+    import python_rag_common
+    import python_rag_pipeline
+
+    with timer.stage("load"):
+        source = _write_text_corpus(size, workdir)
+        embed_func = python_rag_common.get_chromadb_embedding_function(
+            cache=python_rag_common.get_embedding_cache()
+        )
+        collection = python_rag_common.create_ephemeral_collection("bench", embed_func)
+        model = python_rag_common.get_ollama_llm("deepseek-r1:8b")
+    _index_text_file(
+        timer,
+        collection,
+        source,
+        embed_func,
+        python_rag_common.chromadb_embedding_model_name(),
+        workdir,
+    )
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        _query_args(), collection, model.invoke, lambda query: embed_func([query])[0]
+    )
+    _answer(timer, pipeline, "Who settled Escondido?", queries)
+    return collection.count()
+
+
+def bench_script_4(timer, size, queries, workdir):
+    import python_rag_common
+
+    script = _script(4)
+    with timer.stage("load"):
+        documents = small_documents(size)
+        collection = python_rag_common.create_ephemeral_collection("bench")
+    with timer.stage("embed"):
+        embeddings = [script.get_embeddings_for_input(document) for document in documents]
+    with timer.stage("add"):
+        collection.add(documents=documents, embeddings=embeddings, ids=_ids(documents))
+    for query in query_list("This is a query about popular florida orchard", queries):
+        with timer.stage("query"):
+            query_embedding = script.get_embeddings_for_input(query)
+            collection.query(query_embeddings=query_embedding, n_results=2)
+    return len(documents)
+
+
+def bench_script_5(timer, size, queries, workdir):
+    import python_rag_common
+    import python_rag_pipeline
+
+    script = _script(5)
+    with timer.stage("load"):
+        source = _write_text_corpus(size, workdir)
+        collection = python_rag_common.create_ephemeral_collection("bench")
+        python_rag_common.get_gemini_client()
+
+    def embed_fn(texts):
+        return python_rag_common.embed_texts_gemini(
+            texts,
+            model=script.GEMINI_EMBEDDING_MODEL,
+            max_concurrency=4,
+            cache=python_rag_common.get_embedding_cache(),
+        )
+
+    _index_text_file(timer, collection, source, embed_fn, script.GEMINI_EMBEDDING_MODEL, workdir)
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        _query_args(),
+        collection,
+        python_rag_common.generate_gemini_answer,
+        script.get_embeddings_for_input,
+    )
+    _answer(timer, pipeline, "Who settled Escondido?", queries)
+    return collection.count()
+
+
+def bench_script_6(timer, size, queries, workdir):
+    import python_rag_common
+    import python_rag_ingest
+    import python_rag_pipeline
+
+    script = _script(6)
+    with timer.stage("load"):
+        content = text_corpus(size)
+        chroma_client = python_rag_common.get_chroma_http_client()
+        name = f"bench_{size}"
+        if name in [c.name for c in chroma_client.list_collections()]:
+            chroma_client.delete_collection(name)
+        collection = chroma_client.create_collection(name=name)
+    with timer.stage("split"):
+        texts = split(content)
+
+    def embed_fn(new_texts):
+        return python_rag_common.embed_texts_gemini(
+            new_texts, max_concurrency=4, cache=python_rag_common.get_embedding_cache()
+        )
+
+    with timer.stage("add"):
+        with python_rag_ingest.BulkWriter(collection, max_concurrency=4) as writer:
+            python_rag_ingest.sync_collection(
+                collection, script.SOURCE_PATH, texts, timer.timed("embed", embed_fn), writer
+            )
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        _query_args(),
+        collection,
+        python_rag_common.generate_gemini_answer,
+        script.get_embeddings_for_input,
+    )
+    _answer(timer, pipeline, "Who settled Escondido?", queries)
+    return len(texts)
+
+
+def bench_script_7(timer, size, queries, workdir):
+    import python_rag_common
+    import python_rag_ingest
+    import python_rag_pipeline
+
+    script = _script(7)
+    # Script 7 only queries, so the collection is filled (untimed) first
+    chroma_client = python_rag_common.get_chroma_http_client()
+    collection = chroma_client.get_or_create_collection(name=f"bench_7_{size}")
+    texts = split(text_corpus(size))
+    python_rag_ingest.sync_collection(
+        collection, "bench", texts, python_rag_common.embed_texts_gemini
+    )
+
+    with timer.stage("load"):
+        collection = chroma_client.get_collection(name=f"bench_7_{size}")
+        python_rag_common.get_gemini_client()
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        _query_args(),
+        collection,
+        python_rag_common.generate_gemini_answer,
+        script.get_embeddings_for_input,
+    )
+    _answer(timer, pipeline, "Who settled Escondido?", queries)
+    return len(texts)
+
+
+def bench_script_8(timer, size, queries, workdir):
+    import python_rag_common
+    import python_rag_ingest
+    import python_rag_pipeline
+    import python_rag_snapshot
+
+    with timer.stage("load"):
+        embed_func = python_rag_common.get_chromadb_embedding_function(
+            cache=python_rag_common.get_embedding_cache()
+        )
+        collection = python_rag_common.create_ephemeral_collection("bench", embed_func)
+        model = python_rag_common.get_ollama_llm("deepseek-r1:8b")
+    model_name = python_rag_common.chromadb_embedding_model_name()
+
+    def build(writer):
+        # Pages stream through splitting into the collection like they do in the script, so
+        # reading the PDF counts as splitting. Every copy's pages are numbered apart so
+        # their chunks get IDs of their own.
+        pages = (
+            (f"{i}-{page_number}", text)
+            for i in range(size)
+            for page_number, text in python_rag_ingest.iter_pdf_pages(PDF_SOURCE)
+        )
+        chunks = python_rag_ingest.iter_page_chunks(
+            PDF_SOURCE, pages, python_rag_ingest.make_text_splitter()
+        )
+        python_rag_ingest.add_chunks_in_batches(
+            writer, timer.timed_iter("split", chunks), embed_fn=timer.timed("embed", embed_func)
+        )
+
+    with timer.stage("add"):
+        python_rag_snapshot.restore_or_build(
+            collection,
+            python_rag_snapshot.snapshot_path([PDF_SOURCE], model_name, workdir),
+            model_name,
+            [PDF_SOURCE],
+            build,
+        )
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        _query_args(), collection, model.invoke, lambda query: embed_func([query])[0]
+    )
+    _answer(timer, pipeline, "When does the game end?", queries)
+    return collection.count()
+
+
+def _index_text_file(timer, collection, source, embed_fn, model, workdir):
+    """Scripts 3 and 5's build: split the file, embed the chunks and add them through a
+    snapshot writer"""
+    import python_rag_ingest
+    import python_rag_snapshot
+
+    def build(writer):
+        with timer.stage("split"):
+            texts = split(Path(source).read_text())
+        with timer.stage("embed"):
+            embeddings = embed_fn(texts)
+        writer.add(
+            documents=texts,
+            embeddings=embeddings,
+            ids=python_rag_ingest.chunk_ids(source, texts),
+        )
+
+    with timer.stage("add"):
+        python_rag_snapshot.restore_or_build(
+            collection,
+            python_rag_snapshot.snapshot_path([source], model, workdir),
+            model,
+            [source],
+            build,
+        )
+
+
+def _answer(timer, pipeline, query, queries):
+    """Ask the questions one print_answer() each, like the scripts' ask_questions(). Its
+    prompt and generate spans are those stages; the rest of its time (embedding the
+    question, the answer cache and the search) is the query stage."""
+    import python_rag_metrics
+
+    def spent(name):
+        return python_rag_metrics.METRICS.spans.get(name, (0, 0.0, 0.0))[1]
+
+    for question in query_list(query, queries):
+        before = {stage: spent(stage) for stage in ["prompt", "generate"]}
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            pipeline.print_answer(question)
+        rest = time.perf_counter() - start
+        for stage, seconds in before.items():
+            timer.seconds[stage] += spent(stage) - seconds
+            rest -= spent(stage) - seconds
+        timer.seconds["query"] += rest
+
+
+def _query_args():
+    """The scripts' default query options, except that only an identical question reuses a
+    cached answer, so every benchmark question is generated"""
+    import python_rag_pipeline
+
+    parser = argparse.ArgumentParser()
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    return parser.parse_args(["--answer-cache-threshold", "1.0"])
+
+
+def _script(number):
+    """Script `number`'s module, for the helpers it defines itself"""
+    (path,) = ITERATIONS_DIR.glob(f"{number}_*.py")
+    return importlib.import_module(path.stem)
+
+
+def _write_text_corpus(size, workdir):
+    """text_corpus(size) as a file, since scripts 3 and 5 snapshot the file they index"""
+    path = Path(workdir) / "escondido.txt"
+    path.write_text(text_corpus(size))
+    return str(path)
+
+
+def _ids(texts):
+    return [str(i) for i in range(len(texts))]
+
+
+SCENARIOS = {
+    1: bench_script_1,
+    2: bench_script_2,
+    3: bench_script_3,
+    4: bench_script_4,
+    5: bench_script_5,
+    6: bench_script_6,
+    7: bench_script_7,
+    8: bench_script_8,
+}
+PERSISTED_SCRIPTS = {6, 7}
+
+
+def run_one(script, size, queries):
+    """Run one scenario in this process and return its measurements"""
+    sys.path.insert(0, str(ITERATIONS_DIR))
+    timer = StageTimer()
+    with tempfile.TemporaryDirectory(prefix="bench_rag_") as workdir:
+        os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embeddings.sqlite3")
+        start = time.perf_counter()
+        chunks = SCENARIOS[script](timer, size, queries, workdir)
+        wall = time.perf_counter() - start
+
+    ingest_seconds = sum(timer.seconds[stage] for stage in INGEST_STAGES)
+    query_seconds = sum(timer.seconds[stage] for stage in QUERY_STAGES)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    peak_rss_mb = peak_rss / 1024 if sys.platform != "darwin" else peak_rss / (1024 * 1024)
+    return {
+        "script": script,
+        "size": size,
+        "chunks": chunks,
+        "queries": queries,
+        "stages": {stage: timer.seconds.get(stage, 0.0) for stage in STAGES},
+        "ingest_chunks_per_second": chunks / ingest_seconds if ingest_seconds else None,
+        "queries_per_second": queries / query_seconds if query_seconds else None,
+        "wall_seconds": wall,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def run_in_subprocess(script, size, queries, env):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result_file:
+        result_path = result_file.name
+    try:
+        completed = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--run-one",
+                str(script),
+                str(size),
+                str(queries),
+                result_path,
+            ],
+            env=env,
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()[-1:] or ["unknown error"]
+            return {"script": script, "size": size, "error": error[0]}
+        with open(result_path) as file:
+            return json.load(file)
+    finally:
+        os.remove(result_path)
+
+
+@contextmanager
+def chroma_server():
+    """Throwaway `chroma run` server. Yields (host, port)."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    path = tempfile.mkdtemp(prefix="bench_chroma_")
+    process = subprocess.Popen(
+        ["chroma", "run", "--path", path, "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or process.poll() is not None:
+                    raise RuntimeError("chroma server did not start")
+                time.sleep(0.2)
+        yield "127.0.0.1", port
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Stages that got more than `tolerance` slower than the baseline run"""
+    previous = {(r["script"], r["size"]): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    for result in results:
+        before = previous.get((result["script"], result["size"]))
+        if before is None or "error" in result:
+            continue
+        for stage in STAGES:
+            old, new = before["stages"].get(stage, 0.0), result["stages"][stage]
+            # Ignore stages too short to measure reliably
+            if old > 0.001 and new > old * (1 + tolerance):
+                regressions.append((result["script"], result["size"], stage, old, new))
+    return regressions
+
+
+def print_results(results):
+    header = f"{'script':>6} {'size':>5} {'chunks':>7} " + " ".join(f"{s:>9}" for s in STAGES)
+    print(header + f" {'chunks/s':>9} {'q/s':>7} {'rss MB':>7}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['script']:>6} {r['size']:>5} error: {r['error']}")
+            continue
+        stages = " ".join(f"{r['stages'][s]:>9.3f}" for s in STAGES)
+        ingest = r["ingest_chunks_per_second"] or 0.0
+        qps = r["queries_per_second"] or 0.0
+        print(
+            f"{r['script']:>6} {r['size']:>5} {r['chunks']:>7} {stages} "
+            f"{ingest:>9.1f} {qps:>7.2f} {r['peak_rss_mb']:>7.1f}"
+        )
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run-one":
+        script, size, queries, result_path = sys.argv[2:6]
+        result = run_one(int(script), int(size), int(queries))
+        with open(result_path, "w") as file:
+            json.dump(result, file)
+        return
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument("--scripts", default="1,2,3,4,5,6,7,8", help="comma separated")
+    parser.add_argument("--sizes", default="1,4,16", help="corpus multipliers, comma separated")
+    parser.add_argument("--queries", type=int, default=5, help="queries per scenario")
+    parser.add_argument("--embed-latency-ms", type=float, default=10.0)
+    parser.add_argument("--embed-per-item-ms", type=float, default=0.5)
+    parser.add_argument("--first-token-ms", type=float, default=50.0)
+    parser.add_argument("--token-ms", type=float, default=5.0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to check for regressions")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed slowdown vs baseline (0.2 = 20%%)"
+    )
+    args = parser.parse_args()
+
+    scripts = [int(s) for s in args.scripts.split(",")]
+    sizes = [int(s) for s in args.sizes.split(",")]
+    latency = fake_backends.FakeLatency(
+        args.embed_latency_ms, args.embed_per_item_ms, args.first_token_ms, args.token_ms
+    )
+    backends = fake_backends.start_fake_backends(latency=latency)
+    backend_url = f"http://127.0.0.1:{backends.server_address[1]}"
+    env = dict(
+        os.environ,
+        GEMINI_API_KEY="fake",
+        GEMINI_BASE_URL=backend_url,
+        OLLAMA_HOST=backend_url,
+        ANONYMIZED_TELEMETRY="False",
+    )
+
+    results = []
+    with chroma_server() if PERSISTED_SCRIPTS & set(scripts) else _nothing() as chroma:
+        if chroma:
+            env["CHROMA_HOST"], env["CHROMA_PORT"] = chroma[0], str(chroma[1])
+        for script in scripts:
+            for size in sizes:
+                print(f"script {script}, size {size}...", file=sys.stderr)
+                results.append(run_in_subprocess(script, size, args.queries, env))
+    backends.shutdown()
+
+    print_results(results)
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "git_commit": _git_commit(),
+        "fake_latency_ms": {
+            "embed": args.embed_latency_ms,
+            "embed_per_item": args.embed_per_item_ms,
+            "first_token": args.first_token_ms,
+            "token": args.token_ms,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        for script, size, stage, old, new in regressions:
+            print(f"REGRESSION script {script} size {size} {stage}: {old:.3f}s -> {new:.3f}s")
+        if regressions:
+            sys.exit(1)
+
+
+@contextmanager
+def _nothing():
+    yield None
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    main()
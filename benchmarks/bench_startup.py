@@ -0,0 +1,108 @@
+"""Startup time of the scripts in iterations/.
+
+Each script is imported in a fresh interpreter (without running main()) a few times and
+the median wall time is reported next to a bare `python -c pass`. It also lists any heavy
+library (chromadb, langchain, the model SDKs, ...) that got imported along the way; those
+are meant to load only when a script actually uses them. Exits non-zero if one did, or if
+a script is slower than --budget-ms.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --budget-ms 400 --output startup.json
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+ITERATIONS_DIR = REPO_ROOT / "iterations"
+
+# Libraries that take hundreds of milliseconds or more to import
+HEAVY_MODULES = [
+    "chromadb",
+    "google.genai",
+    "langchain_core",
+    "langchain_ollama",
+    "langchain_text_splitters",
+    "ollama",
+    "onnxruntime",
+    "PyPDF2",
+]
+
+# Imports a script the way `python script.py` would, minus the `if __name__ == "__main__"`
+# part, then prints which heavy modules ended up loaded
+IMPORT_PROGRAM = """\
+import importlib.util, json, sys
+sys.path.insert(0, {iterations!r})
+spec = importlib.util.spec_from_file_location("startup_probe", {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+"""
+
+
+def time_import(path, runs):
+    """Median seconds to import `path` in a new interpreter, and the heavy modules it loaded"""
+    program = IMPORT_PROGRAM.format(
+        iterations=str(ITERATIONS_DIR), path=str(path), heavy=HEAVY_MODULES
+    )
+    samples = []
+    heavy = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", program],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        samples.append(time.perf_counter() - start)
+        heavy = json.loads(result.stdout.splitlines()[-1])
+    return statistics.median(samples), heavy
+
+
+def time_interpreter(runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__
+    )
+    parser.add_argument("--runs", type=int, default=5, help="imports per file")
+    parser.add_argument("--budget-ms", type=float, help="fail if any file takes longer")
+    parser.add_argument("--output", help="write results here as JSON")
+    args = parser.parse_args()
+
+    paths = sorted(ITERATIONS_DIR.glob("[0-9]*.py"), key=lambda p: int(p.name.split("_")[0]))
+    baseline = time_interpreter(args.runs)
+    print(f"{'python -c pass':<58} {baseline * 1000:7.0f} ms")
+
+    results = []
+    failed = False
+    for path in paths:
+        seconds, heavy = time_import(path, args.runs)
+        over_budget = args.budget_ms is not None and seconds * 1000 > args.budget_ms
+        failed = failed or bool(heavy) or over_budget
+        note = f"  loads {', '.join(heavy)}" if heavy else ""
+        note += "  over budget" if over_budget else ""
+        print(f"{path.name:<58} {seconds * 1000:7.0f} ms{note}")
+        results.append({"file": path.name, "seconds": seconds, "heavy_imports": heavy})
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"interpreter_seconds": baseline, "files": results}, file, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Deterministic local stand-ins for the Ollama and Gemini HTTP APIs.
+
+One server answers both APIs (their routes don't overlap), so the scripts can be pointed at
+it with OLLAMA_HOST and GEMINI_BASE_URL. Embeddings are derived from a hash of the text so
+the same text always gets the same vector, and every request sleeps for a configurable
+amount of time to stand in for the model.
+
+    python benchmarks/fake_backends.py --port 8081 --embed-latency-ms 20
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+FAKE_ANSWER = "Escondido was settled by people who came looking for a quiet valley to farm."
+
+
+class FakeLatency:
+    """Seconds each kind of request takes. Embedding cost grows with the number of texts."""
+
+    def __init__(self, embed_ms=10.0, embed_per_item_ms=0.5, first_token_ms=50.0, token_ms=5.0):
+        self.embed = embed_ms / 1000
+        self.embed_per_item = embed_per_item_ms / 1000
+        self.first_token = first_token_ms / 1000
+        self.token = token_ms / 1000
+
+
+def fake_embedding(text, dimensions):
+    """Unit vector seeded from the text, so it's the same on every run"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_tokens(answer=FAKE_ANSWER):
+    return re.findall(r"\S+\s*", answer)
+
+
+def make_handler(latency, dimensions):
+    class FakeBackendHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            # ollama's client and health checks
+            if self.path.startswith("/api/version"):
+                return self._json({"version": "0.0.0-fake"})
+            self._json({"error": f"{self.path} not found"}, status=404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = self.path.split("?")[0]
+
+            if path == "/api/embed":
+                texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                return self._ollama_embed(body["model"], texts)
+            if path == "/api/generate":
+                return self._ollama_generate(body["model"], body.get("stream", True))
+            if path.endswith(":batchEmbedContents"):
+                texts = [r["content"]["parts"][0]["text"] for r in body["requests"]]
+                return self._gemini_embed(texts, batch=True)
+            if path.endswith(":embedContent"):
+                return self._gemini_embed([body["content"]["parts"][0]["text"]], batch=False)
+            if path.endswith(":streamGenerateContent"):
+                return self._gemini_generate(stream=True)
+            if path.endswith(":generateContent"):
+                return self._gemini_generate(stream=False)
+            self._json({"error": f"{path} not found"}, status=404)
+
+        def _ollama_embed(self, model, texts):
+            time.sleep(latency.embed + latency.embed_per_item * len(texts))
+            embeddings = [fake_embedding(text, dimensions) for text in texts]
+            self._json({"model": model, "embeddings": embeddings})
+
+        def _ollama_generate(self, model, stream):
+            tokens = fake_tokens()
+            if not stream:
+                time.sleep(latency.first_token + latency.token * len(tokens))
+                return self._json({"model": model, "response": "".join(tokens), "done": True})
+
+            self._start_chunked("application/x-ndjson")
+            time.sleep(latency.first_token)
+            for token in tokens:
+                self._chunk(json.dumps({"model": model, "response": token, "done": False}) + "\n")
+                time.sleep(latency.token)
+            done = {"model": model, "response": "", "done": True, "done_reason": "stop"}
+            self._chunk(json.dumps(done) + "\n")
+            self._chunk("")
+
+        def _gemini_embed(self, texts, batch):
+            time.sleep(latency.embed + latency.embed_per_item * len(texts))
+            embeddings = [{"values": fake_embedding(text, dimensions)} for text in texts]
+            self._json({"embeddings": embeddings} if batch else {"embedding": embeddings[0]})
+
+        def _gemini_generate(self, stream):
+            tokens = fake_tokens()
+
+            def response(text, count):
+                return {
+                    "candidates": [
+                        {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+                    ],
+                    "usageMetadata": {"candidatesTokenCount": count},
+                }
+
+            if not stream:
+                time.sleep(latency.first_token + latency.token * len(tokens))
+                return self._json(response("".join(tokens), len(tokens)))
+
+            self._start_chunked("text/event-stream")
+            time.sleep(latency.first_token)
+            for i, token in enumerate(tokens, start=1):
+                self._chunk(f"data: {json.dumps(response(token, i))}\r\n\r\n")
+                time.sleep(latency.token)
+            self._chunk("")
+
+        def _json(self, payload, status=200):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _start_chunked(self, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def _chunk(self, text):
+            data = text.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return FakeBackendHandler
+
+
+def start_fake_backends(host="127.0.0.1", port=0, latency=None, dimensions=768):
+    """Start the fake server on a background thread. Returns the server; its address is
+    server.server_address and server.shutdown() stops it."""
+    handler = make_handler(latency or FakeLatency(), dimensions)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--embed-latency-ms", type=float, default=10.0)
+    parser.add_argument("--embed-per-item-ms", type=float, default=0.5)
+    parser.add_argument("--first-token-ms", type=float, default=50.0)
+    parser.add_argument("--token-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    latency = FakeLatency(
+        args.embed_latency_ms, args.embed_per_item_ms, args.first_token_ms, args.token_ms
+    )
+    server = start_fake_backends(args.host, args.port, latency, args.dimensions)
+    print(f"Fake Ollama/Gemini listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
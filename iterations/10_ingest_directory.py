@@ -0,0 +1,133 @@
+import argparse
+import textwrap
+
+import python_rag_common
+import python_rag_ingest
+import python_rag_shard
+from dotenv import load_dotenv
+
+DESC = textwrap.dedent(
+    """\
+Ingest a whole tree of .txt and .pdf files into a PERSISTED instance of ChromaDB.
+Files are read and split in a process pool while one thread embeds the chunks in batches
+and several write them to the server at once. Finished files are checkpointed in a
+manifest, so re-running only picks up new and changed files (and an interrupted run
+resumes where it stopped).
+
+    python iterations/10_ingest_directory.py data "more_docs/**/*.pdf"
+
+* Where does the search corpus come from? Directories and globs of text files and PDFs
+* How does it create embeddings? Gemini
+* What model does it use for a response? None, query it with script 7
+
+With --shards N the chunks are spread over N collections (on several servers if
+CHROMA_SHARD_HOSTS lists them), written to all of them at once.
+"""
+)
+
+EPILOG = textwrap.dedent(
+    """\
+Requirements
+"GEMINI_API_KEY", "CHROMA_HOST", "CHROMA_PORT" set in ".env" file at root.
+"""
+)
+
+
+def ingest(
+    patterns,
+    collection_name,
+    manifest_path,
+    processes,
+    batch_size,
+    embed_concurrency,
+    write_concurrency,
+    shards=1,
+):
+    load_dotenv()
+    sources = python_rag_ingest.find_sources(patterns)
+    print(f"Found {len(sources)} files")
+
+    if shards > 1:
+        collection = python_rag_shard.chroma_shards(collection_name, shards, create=True)
+    else:
+        chroma_client = python_rag_common.get_chroma_http_client()
+        collection = chroma_client.get_or_create_collection(name=collection_name)
+    embedding_cache = python_rag_common.get_embedding_cache()
+
+    def embed_fn(texts):
+        return python_rag_common.embed_texts_gemini(
+            texts, max_concurrency=embed_concurrency, cache=embedding_cache
+        )
+
+    done = 0
+
+    def on_file_done(source, fingerprint, chunks):
+        nonlocal done
+        done += 1
+        print(f"[{done}] {source}: {chunks} chunks")
+
+    # A different number of shards is a different place for the chunks to go, so it gets
+    # its own checkpoints
+    sharding = f"_{shards}_shards" if shards > 1 else ""
+    manifest = python_rag_ingest.IngestManifest(
+        manifest_path or f".cache/ingest_{collection_name}{sharding}.jsonl"
+    )
+    try:
+        with python_rag_common.span("ingest", files=len(sources)):
+            totals = python_rag_ingest.ingest_files(
+                collection,
+                sources,
+                manifest,
+                embed_fn=embed_fn,
+                processes=processes,
+                batch_size=batch_size,
+                on_file_done=on_file_done,
+                write_concurrency=write_concurrency,
+            )
+    finally:
+        manifest.close()
+    print(f"Ingested: {totals}")
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    print(f"{collection.count()} chunks in {collection_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESC, epilog=EPILOG
+    )
+    parser.add_argument("paths", nargs="+", help="directories and/or glob patterns")
+    parser.add_argument("--collection", default="5_gemini", help="collection to write to")
+    parser.add_argument(
+        "--manifest", help="checkpoint file (default .cache/ingest_<collection>.jsonl)"
+    )
+    parser.add_argument(
+        "--processes", type=int, help="processes reading and splitting files (default: CPUs)"
+    )
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks embedded per batch")
+    parser.add_argument(
+        "--embed-concurrency", type=int, default=4, help="max embedding requests in flight"
+    )
+    parser.add_argument(
+        "--write-concurrency", type=int, default=4, help="max write requests to chroma in flight"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="hash-partition the chunks over this many collections (query with 7 --shards)",
+    )
+    args = parser.parse_args()
+    ingest(
+        args.paths,
+        args.collection,
+        args.manifest,
+        args.processes,
+        args.batch_size,
+        args.embed_concurrency,
+        args.write_concurrency,
+        args.shards,
+    )
+
+
+if __name__ == "__main__":
+    main()
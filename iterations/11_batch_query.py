@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import json
+import sys
+import textwrap
+
+import python_rag_pipeline
+from dotenv import load_dotenv
+
+DESC = textwrap.dedent(
+    """\
+Answer a whole file of questions (an evaluation set, say) and write the answers as JSON
+lines. Questions are embedded and searched in batches while earlier answers are still
+being generated, with several generate calls in flight at once.
+
+Questions are read one per line, either as plain text or as {"question": ...} JSON:
+
+    python iterations/11_batch_query.py questions.txt --output answers.jsonl
+
+Each answer line has the question's "index" (its position in the input), since answers
+are written as they finish rather than in input order.
+
+* Where does the search corpus come from? Text file or PDF
+* How does it create embeddings? ChromaDB built-in (ollama backend) or Gemini
+* What model does it use for a response? Local ollama or Gemini
+"""
+)
+
+EPILOG = textwrap.dedent(
+    """\
+Requirements
+"GEMINI_API_KEY" set in ".env" file at root for the gemini backend.
+"""
+)
+
+
+def read_questions(file):
+    questions = []
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        questions.append(json.loads(line)["question"] if line.startswith("{") else line)
+    return questions
+
+
+async def answer_all(pipeline, questions, out, max_concurrency, batch_size):
+    answered = 0
+    async for answer in pipeline.answer_batch(questions, max_concurrency, batch_size):
+        out.write(json.dumps(answer) + "\n")
+        out.flush()
+        answered += 1
+        if answered % 100 == 0:
+            print(f"{answered}/{len(questions)} answered", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESC, epilog=EPILOG
+    )
+    parser.add_argument(
+        "questions", nargs="?", default="-", help="file of questions (default: stdin)"
+    )
+    parser.add_argument("--output", default="-", help="where to write answers (default: stdout)")
+    python_rag_pipeline.add_pipeline_arguments(parser)
+    parser.add_argument(
+        "--max-concurrency", type=int, default=4, help="answers generated at the same time"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="questions embedded and searched together"
+    )
+    args = parser.parse_args()
+
+    if args.questions == "-":
+        questions = read_questions(sys.stdin)
+    else:
+        with open(args.questions) as file:
+            questions = read_questions(file)
+
+    load_dotenv()
+    pipeline = python_rag_pipeline.pipeline_from_args(args)
+    print(
+        f"Indexed {pipeline.collection.count()} chunks from {args.source}, "
+        f"answering {len(questions)} questions",
+        file=sys.stderr,
+    )
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        asyncio.run(answer_all(pipeline, questions, out, args.max_concurrency, args.batch_size))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,5 @@
 import textwrap
-from pprint import pprint
 
-import chromadb
 import python_rag_common
 
 DESC = textwrap.dedent(
@@ -16,7 +14,7 @@ It instantiates chromaDB as an ephemeral instance.
 )
 
 
-def populate_and_query_chroma_embeddings(is_interactive=False):
+def populate_and_query_chroma_embeddings(is_interactive=False, vector_store="chroma"):
     # This will use ChromaDBs embeddings. It performs better in my testing than the
     # ollama model nomic-embed-text that I have locally. However, it's still not
     # amazing.
@@ -25,10 +23,9 @@ def populate_and_query_chroma_embeddings(is_interactive=False):
         "This is a document about oranges",
     ]
 
-    chroma_client = chromadb.Client()
     embed_func = python_rag_common.get_chromadb_embedding_function()
-    collection = chroma_client.create_collection(
-        name="my_collection", embedding_function=embed_func
+    collection = python_rag_common.create_ephemeral_collection(
+        "my_collection", embed_func, vector_store
     )
 
     collection.add(documents=documents, ids=["id-pineapple", "id-oranges"])
@@ -46,15 +43,18 @@ def populate_and_query_chroma_embeddings(is_interactive=False):
             query_texts=query,
             n_results=2,  # how many results to return
         )
-        pprint(results)
+        python_rag_common.detail("results", results)
+        print(f"Closest: {results['documents'][0]}")
         if not is_interactive:
             break
 
 
 def main():
     parser = python_rag_common.init_parser(DESC)
+    python_rag_common.add_vector_store_argument(parser)
     args = parser.parse_args()
-    populate_and_query_chroma_embeddings(args.interactive)
+    python_rag_common.setup_instrumentation(args)
+    populate_and_query_chroma_embeddings(args.interactive, args.vector_store)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,5 @@
 import textwrap
-from pprint import pprint
 
-import chromadb
-import ollama
 import python_rag_common
 
 DESC = textwrap.dedent(
@@ -21,12 +18,15 @@ i.e.: the default model is "nomic-embed-text": https://ollama.com/library/nomic-
 
 
 def get_embeddings_for_input(input, model):
-    response = ollama.embed(model=model, input=input)
+    with python_rag_common.span("embed", backend="ollama", items=1):
+        response = python_rag_common.get_ollama_client().embed(model=model, input=input)
 
     return response.embeddings[0]
 
 
-def populate_and_query_ollama_embeddings(is_interactive=False, model="nomic-embed-text"):
+def populate_and_query_ollama_embeddings(
+    is_interactive=False, model="nomic-embed-text", vector_store="chroma"
+):
     # This function gets embeddings from a local ollama model (nomic-embed-text). It doesn't
     # appear to be as good as ChromaDB's built in embeddings.
 
@@ -36,10 +36,13 @@ def populate_and_query_ollama_embeddings(is_interactive=False, model="nomic-embe
     ]
 
     ids = ["id-pineapple", "id-oranges"]
-    embeddings = [get_embeddings_for_input(doc, model) for doc in documents]
+    embeddings = python_rag_common.embed_texts_ollama(
+        documents, model, cache=python_rag_common.get_embedding_cache()
+    )
 
-    chroma_client = chromadb.Client()
-    collection = chroma_client.create_collection(name="my_collection")
+    collection = python_rag_common.create_ephemeral_collection(
+        "my_collection", vector_store=vector_store
+    )
 
     # I prefer passing embeddings instead of the embedding functions because this way demonstrates
     # a greater separation of concerns. Perhaps there are preformance reasons not to do this in
@@ -62,7 +65,8 @@ def populate_and_query_ollama_embeddings(is_interactive=False, model="nomic-embe
             query_embeddings=embeddings_for_query,
             n_results=2,  # how many results to return
         )
-        pprint(results)
+        python_rag_common.detail("results", results)
+        print(f"Closest: {results['documents'][0]}")
         if not is_interactive:
             break
 
@@ -70,8 +74,10 @@ def populate_and_query_ollama_embeddings(is_interactive=False, model="nomic-embe
 def main():
     parser = python_rag_common.init_parser(DESC)
     parser.add_argument("--ollama-model", default="nomic-embed-text", help="Ollama model to use")
+    python_rag_common.add_vector_store_argument(parser)
     args = parser.parse_args()
-    populate_and_query_ollama_embeddings(args.interactive, args.ollama_model)
+    python_rag_common.setup_instrumentation(args)
+    populate_and_query_ollama_embeddings(args.interactive, args.ollama_model, args.vector_store)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,10 @@
+import functools
 import textwrap
-from pprint import pprint
 
-import chromadb
 import python_rag_common
-from langchain_ollama.llms import OllamaLLM
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import python_rag_ingest
+import python_rag_pipeline
+import python_rag_snapshot
 
 DESC = textwrap.dedent(
     """\
@@ -20,86 +20,90 @@ It instantiates chromaDB as an ephemeral instance
 """
 )
 
-PROMPT_TEMPLATE = """\
-Answer the question based only on the following context:
 
-{context}
-
----
-
-Answer the question based on the above context: {question}
-"""
-
-
-def populate_and_query_chroma_embeddings(is_interactive=False, model_name="deepseek-r1:8b"):
+def populate_and_query_chroma_embeddings(
+    args,
+    model_name="deepseek-r1:8b",
+    vector_store="chroma",
+    snapshot_path=None,
+):
     # This will use ChromaDBs embeddings. It performs better in my testing than the
     # ollama model nomic-embed-text that I have locally. However, it's still not
     # amazing
 
-    # Open the file in read mode
-    with open("data/escondido.txt", "r") as file:
-        # Read the entire file content
-        content = file.read()
-
-    # This is used to split up large blocks of texts into more manageable chunks.
-    # This tool is nice as it allows many different splitting strategies and will do
-    # nice things like try to keep paragraphs together. You could easily implement on
-    # your own but this is handy.
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    texts = text_splitter.split_text(content)
-
-    # This is how the cool kids do it I guess? This syntax will take some getting used to.
-    # texts_with_ids = [(i, segment) for i, segment in enumerate(texts, start=1)]
-
-    ids = []
-    for i, _ in enumerate(texts, start=1):
-        ids.append(str(i))
-
-    # print(texts)
+    # The cache means unchanged chunks don't go through the model again on the next run
+    embedding_cache = python_rag_common.get_embedding_cache()
+    embed_func = python_rag_common.get_chromadb_embedding_function(cache=embedding_cache)
+    collection = python_rag_common.create_ephemeral_collection(
+        "my_collection", embed_func, vector_store
+    )
 
-    chroma_client = chromadb.Client()
-    embed_func = python_rag_common.get_chromadb_embedding_function()
-    collection = chroma_client.create_collection(
-        name="my_collection", embedding_function=embed_func
+    def build(writer):
+        # Open the file in read mode
+        with open("data/escondido.txt", "r") as file:
+            # Read the entire file content
+            content = file.read()
+
+        # This is used to split up large blocks of texts into more manageable chunks.
+        # This tool is nice as it allows many different splitting strategies and will do
+        # nice things like try to keep paragraphs together. You could easily implement on
+        # your own but this is handy.
+        text_splitter = python_rag_ingest.make_text_splitter()
+        with python_rag_common.span("split"):
+            texts = text_splitter.split_text(content)
+        python_rag_common.count("chunks", len(texts))
+
+        # IDs come from the source path and each chunk's content (rather than its position)
+        # so editing the file doesn't shift the ID of every chunk after the edit.
+        ids = python_rag_ingest.chunk_ids("data/escondido.txt", texts)
+
+        # print(texts)
+
+        with python_rag_common.span("add", items=len(ids)):
+            writer.add(documents=texts, ids=ids, embeddings=embed_func(texts))
+
+    # The chunks and their embeddings are kept in a snapshot, so the next start loads
+    # them in one step and only splits and embeds the file again if it (or the model)
+    # changed
+    python_rag_snapshot.restore_or_build(
+        collection,
+        snapshot_path,
+        python_rag_common.chromadb_embedding_model_name(),
+        ["data/escondido.txt"],
+        build,
     )
 
-    collection.add(documents=texts, ids=ids)
     python_rag_common.print_collection(collection)
-    model = OllamaLLM(model=model_name)
-
-    default_query = "Who settled Escondido?"
-    print(f"\nExample: {default_query}")
-
-    while True:
-        query = (
-            input(f"\nQuery [{model_name}] (or q/quit to quit): ")
-            if is_interactive
-            else default_query
-        )
-        if query.lower() in ["q", "quit"]:
-            break
-
-        results = collection.query(
-            query_texts=query,
-            n_results=4,
-        )
-        pprint(results)
-
-        formatted_prompt = PROMPT_TEMPLATE.format(context=str(results["documents"]), question=query)
-        print(formatted_prompt)
-
-        response_text = model.invoke(formatted_prompt)
-        print("ANSWER")
-        print(response_text)
-        if not is_interactive:
-            break
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    model = python_rag_common.get_ollama_llm(model_name)
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        args,
+        collection,
+        model.invoke,
+        lambda query: embed_func([query])[0],
+        functools.partial(python_rag_common.stream_ollama_answer, model_name),
+    )
+    python_rag_pipeline.ask_questions(
+        pipeline, "Who settled Escondido?", args.interactive, args.stream, f"Query [{model_name}]"
+    )
 
 
 def main():
     parser = python_rag_common.init_parser(DESC)
     parser.add_argument("--ollama-model", default="deepseek-r1:8b", help="Ollama model to use")
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    python_rag_common.add_vector_store_argument(parser)
+    python_rag_snapshot.add_snapshot_arguments(parser)
     args = parser.parse_args()
-    populate_and_query_chroma_embeddings(args.interactive, args.ollama_model)
+    python_rag_common.setup_instrumentation(args)
+    populate_and_query_chroma_embeddings(
+        args,
+        args.ollama_model,
+        args.vector_store,
+        python_rag_snapshot.snapshot_path_from_args(
+            args, ["data/escondido.txt"], python_rag_common.chromadb_embedding_model_name()
+        ),
+    )
 
 
 if __name__ == "__main__":
@@ -1,11 +1,7 @@
-import os
 import textwrap
-from pprint import pprint
 
-import chromadb
 import python_rag_common
 from dotenv import load_dotenv
-from google import genai
 
 DESC = textwrap.dedent(
     """\
@@ -27,16 +23,16 @@ Requirements
 
 
 def get_embeddings_for_input(input):
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = python_rag_common.get_gemini_client()
 
-    result = client.models.embed_content(model="text-embedding-004", contents=input)
+    with python_rag_common.span("embed", backend="gemini", items=1):
+        result = client.models.embed_content(model="text-embedding-004", contents=input)
 
-    print(result.embeddings[0].values)
+    python_rag_common.detail("embedding", result.embeddings[0].values)
     return result.embeddings[0].values
 
 
-def populate_and_query_gemini_embeddings(is_interactive=False):
+def populate_and_query_gemini_embeddings(is_interactive=False, vector_store="chroma"):
     # This function gets embeddings from gemini.
     load_dotenv()
 
@@ -48,8 +44,9 @@ def populate_and_query_gemini_embeddings(is_interactive=False):
     ids = ["id-pineapple", "id-oranges"]
     embeddings = [get_embeddings_for_input(doc) for doc in documents]
 
-    chroma_client = chromadb.Client()
-    collection = chroma_client.create_collection(name="my_collection")
+    collection = python_rag_common.create_ephemeral_collection(
+        "my_collection", vector_store=vector_store
+    )
 
     # I prefer passing embeddings instead of the embedding functions because this way demonstrates
     # a greater separation of concerns. Perhaps there are preformance reasons not to do this in
@@ -70,15 +67,18 @@ def populate_and_query_gemini_embeddings(is_interactive=False):
             query_embeddings=embeddings_for_query,
             n_results=2,  # how many results to return
         )
-        pprint(results)
+        python_rag_common.detail("results", results)
+        print(f"Closest: {results['documents'][0]}")
         if not is_interactive:
             break
 
 
 def main():
     parser = python_rag_common.init_parser(DESC, EPILOG)
+    python_rag_common.add_vector_store_argument(parser)
     args = parser.parse_args()
-    populate_and_query_gemini_embeddings(args.interactive)
+    python_rag_common.setup_instrumentation(args)
+    populate_and_query_gemini_embeddings(args.interactive, args.vector_store)
 
 
 if __name__ == "__main__":
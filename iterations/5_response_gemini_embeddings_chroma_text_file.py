@@ -1,13 +1,10 @@
-import os
 import textwrap
-import uuid
-from pprint import pprint
 
-import chromadb
 import python_rag_common
+import python_rag_ingest
+import python_rag_pipeline
+import python_rag_snapshot
 from dotenv import load_dotenv
-from google import genai
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 DESC = textwrap.dedent(
     """\
@@ -28,85 +25,97 @@ Requirements
 """
 )
 
-PROMPT_TEMPLATE = """\
-Answer the question based only on the following context:
-
-{context}
-
----
-
-Answer the question based on the above context: {question}
-"""
+GEMINI_EMBEDDING_MODEL = "text-embedding-004"
 
 
 def get_embeddings_for_input(input):
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = python_rag_common.get_gemini_client()
 
-    result = client.models.embed_content(model="text-embedding-004", contents=input)
+    with python_rag_common.span("embed", backend="gemini", items=1):
+        result = client.models.embed_content(model=GEMINI_EMBEDDING_MODEL, contents=input)
 
-    print(len(result.embeddings[0].values))
     return result.embeddings[0].values
 
 
-def gemini_query(is_interactive=False):
+def gemini_query(
+    args,
+    embed_concurrency=4,
+    vector_store="chroma",
+    snapshot_path=None,
+):
     load_dotenv()
 
-    # Open the file in read mode
-    with open("data/escondido.txt", "r") as file:
-        # Read the entire file content
-        content = file.read()
-
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    texts = text_splitter.split_text(content)
+    collection = python_rag_common.create_ephemeral_collection(
+        "5_gemini", vector_store=vector_store
+    )
+
+    def build(writer):
+        # Open the file in read mode
+        with open("data/escondido.txt", "r") as file:
+            # Read the entire file content
+            content = file.read()
+
+        text_splitter = python_rag_ingest.make_text_splitter()
+        with python_rag_common.span("split"):
+            texts = text_splitter.split_text(content)
+        python_rag_common.count("chunks", len(texts))
+
+        # One request per chunk is thousands of round trips on a real corpus, so the chunks
+        # get sent in batches with a few requests in flight at a time. Chunks that were
+        # embedded on a previous run come out of the cache instead.
+        embedding_cache = python_rag_common.get_embedding_cache()
+        embeddings = python_rag_common.embed_texts_gemini(
+            texts,
+            model=GEMINI_EMBEDDING_MODEL,
+            max_concurrency=embed_concurrency,
+            cache=embedding_cache,
+        )
+        print(f"Embedding cache: {embedding_cache.stats()}")
+        ids = python_rag_ingest.chunk_ids("data/escondido.txt", texts)
 
-    ids = []
-    embeddings = []
+        # print(texts)
 
-    for text_chunk in texts:
-        embeddings.append(get_embeddings_for_input(text_chunk))
-        ids.append(str(uuid.uuid4()))
+        with python_rag_common.span("add", items=len(ids)):
+            writer.add(documents=texts, embeddings=embeddings, ids=ids)
 
-    # print(texts)
+    # A snapshot of the chunks and their embeddings from an earlier run is loaded in one
+    # step instead, as long as the file hasn't changed
+    python_rag_snapshot.restore_or_build(
+        collection, snapshot_path, GEMINI_EMBEDDING_MODEL, ["data/escondido.txt"], build
+    )
 
-    chroma_client = chromadb.Client()
-    collection = chroma_client.create_collection(name="5_gemini")
-    collection.add(documents=texts, embeddings=embeddings, ids=ids)
     python_rag_common.print_collection(collection)
 
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
-
-    default_query = "Who settled Escondido?"
-    print(f"\nExample: {default_query}")
-
-    while True:
-        query = input("\nQuery (or q/quit to quit): ") if is_interactive else default_query
-        if query.lower() in ["q", "quit"]:
-            break
-
-        results = collection.query(
-            query_embeddings=get_embeddings_for_input(query),
-            n_results=4,
-        )
-        pprint(results)
-
-        formatted_prompt = PROMPT_TEMPLATE.format(context=str(results["documents"]), question=query)
-        pprint(formatted_prompt)
-
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", contents=[formatted_prompt]
-        )
-        print("ANSWER")
-        print(response.text)
-        if not is_interactive:
-            break
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        args,
+        collection,
+        python_rag_common.generate_gemini_answer,
+        get_embeddings_for_input,
+        python_rag_common.stream_gemini_answer,
+    )
+    python_rag_pipeline.ask_questions(
+        pipeline, "Who settled Escondido?", args.interactive, args.stream
+    )
 
 
 def main():
     parser = python_rag_common.init_parser(DESC, EPILOG)
+    parser.add_argument(
+        "--embed-concurrency", type=int, default=4, help="max embedding requests in flight"
+    )
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    python_rag_common.add_vector_store_argument(parser)
+    python_rag_snapshot.add_snapshot_arguments(parser)
     args = parser.parse_args()
-    gemini_query(args.interactive)
+    python_rag_common.setup_instrumentation(args)
+    gemini_query(
+        args,
+        args.embed_concurrency,
+        args.vector_store,
+        python_rag_snapshot.snapshot_path_from_args(
+            args, ["data/escondido.txt"], GEMINI_EMBEDDING_MODEL
+        ),
+    )
 
 
 if __name__ == "__main__":
@@ -1,13 +1,10 @@
-import os
 import textwrap
-import uuid
-from pprint import pprint
 
-import chromadb
 import python_rag_common
+import python_rag_ingest
+import python_rag_pipeline
+import python_rag_shard
 from dotenv import load_dotenv
-from google import genai
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 DESC = textwrap.dedent(
     """\
@@ -28,91 +25,94 @@ Requirements
 """
 )
 
-PROMPT_TEMPLATE = """\
-Answer the question based only on the following context:
-
-{context}
-
----
-
-Answer the question based on the above context: {question}
-"""
+SOURCE_PATH = "data/escondido.txt"
 
 
 def get_embeddings_for_input(input):
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = python_rag_common.get_gemini_client()
 
-    result = client.models.embed_content(model="text-embedding-004", contents=input)
+    with python_rag_common.span("embed", backend="gemini", items=1):
+        result = client.models.embed_content(model="text-embedding-004", contents=input)
 
-    print(len(result.embeddings[0].values))
     return result.embeddings[0].values
 
 
-def gemini_query(is_interactive=False):
+def gemini_query(args, embed_concurrency=4, write_concurrency=4, shards=1):
     load_dotenv()
     # Open the file in read mode
-    with open("data/escondido.txt", "r") as file:
+    with open(SOURCE_PATH, "r") as file:
         # Read the entire file content
         content = file.read()
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    texts = text_splitter.split_text(content)
-
-    ids = []
-    embeddings = []
-
-    for text_chunk in texts:
-        embeddings.append(get_embeddings_for_input(text_chunk))
-        ids.append(str(uuid.uuid4()))
+    text_splitter = python_rag_ingest.make_text_splitter()
+    with python_rag_common.span("split"):
+        texts = text_splitter.split_text(content)
+    python_rag_common.count("chunks", len(texts))
 
     # print(texts)
 
-    chroma_host = os.environ.get("CHROMA_HOST")
-    chroma_port = os.environ.get("CHROMA_PORT")
-    chroma_client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
-    collection = chroma_client.create_collection(name="5_gemini")
-
-    print(len(ids))
-    print(len(embeddings))
-
-    collection.add(documents=texts, embeddings=embeddings, ids=ids)
-    python_rag_common.print_collection(collection)
-    print("collection added")
-
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
-
-    default_query = "Who settled Escondido?"
-    print(f"\nExample: {default_query}")
-
-    while True:
-        query = input("\nQuery (or q/quit to quit): ") if is_interactive else default_query
-        if query.lower() in ["q", "quit"]:
-            break
-
-        results = collection.query(
-            query_embeddings=get_embeddings_for_input(query),
-            n_results=4,
+    # Several shards spread the writes and the query work over more than one collection
+    # (and server, with CHROMA_SHARD_HOSTS)
+    if shards > 1:
+        collection = python_rag_shard.chroma_shards("5_gemini", shards, create=True)
+    else:
+        chroma_client = python_rag_common.get_chroma_http_client()
+        collection = chroma_client.get_or_create_collection(name="5_gemini")
+
+    # One request per chunk is thousands of round trips on a real corpus, so the chunks
+    # get sent in batches with a few requests in flight at a time. Chunks that were
+    # embedded on a previous run come out of the cache instead.
+    embedding_cache = python_rag_common.get_embedding_cache()
+
+    def embed_fn(new_texts):
+        return python_rag_common.embed_texts_gemini(
+            new_texts, max_concurrency=embed_concurrency, cache=embedding_cache
         )
-        pprint(results)
-
-        formatted_prompt = PROMPT_TEMPLATE.format(context=str(results["documents"]), question=query)
-        pprint(formatted_prompt)
 
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", contents=[formatted_prompt]
+    # Chunk IDs are derived from the source and the chunk's content, so re-running this
+    # only upserts new/edited chunks and deletes ones that are gone from the file. They're
+    # written in batches the server accepts, a few requests at a time.
+    with python_rag_ingest.BulkWriter(collection, max_concurrency=write_concurrency) as writer:
+        changes = python_rag_ingest.sync_collection(
+            collection, SOURCE_PATH, texts, embed_fn, writer
         )
-        print("ANSWER")
-        print(response.text)
-        if not is_interactive:
-            break
+    print(f"Synced collection: {changes}")
+    print(f"Writes: {writer.stats()}")
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    python_rag_common.print_collection(collection)
+
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        args,
+        collection,
+        python_rag_common.generate_gemini_answer,
+        get_embeddings_for_input,
+        python_rag_common.stream_gemini_answer,
+    )
+    python_rag_pipeline.ask_questions(
+        pipeline, "Who settled Escondido?", args.interactive, args.stream
+    )
 
 
 def main():
     parser = python_rag_common.init_parser(DESC, EPILOG)
+    parser.add_argument(
+        "--embed-concurrency", type=int, default=4, help="max embedding requests in flight"
+    )
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    parser.add_argument(
+        "--write-concurrency", type=int, default=4, help="max write requests to chroma in flight"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=1, help="hash-partition the chunks over this many collections"
+    )
     args = parser.parse_args()
-    gemini_query(args.interactive)
+    python_rag_common.setup_instrumentation(args)
+    gemini_query(
+        args,
+        args.embed_concurrency,
+        args.write_concurrency,
+        args.shards,
+    )
 
 
 if __name__ == "__main__":
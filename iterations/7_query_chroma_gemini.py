@@ -6,67 +6,56 @@
 
 # "GEMINI_API_KEY", "CHROMA_HOST", "CHROMA_PORT" set in ".env" file at root.
 
-import os
-
-import chromadb
+import python_rag_common
+import python_rag_pipeline
+import python_rag_shard
 from dotenv import load_dotenv
-from google import genai
 
 
 def get_embeddings_for_input(input):
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = python_rag_common.get_gemini_client()
 
-    result = client.models.embed_content(model="text-embedding-004", contents=input)
+    with python_rag_common.span("embed", backend="gemini", items=1):
+        result = client.models.embed_content(model="text-embedding-004", contents=input)
 
-    print(len(result.embeddings[0].values))
     return result.embeddings[0].values
 
 
-def gemini_query():
+def gemini_query(args, shards=1):
     load_dotenv()
-    chroma_host = os.environ.get("CHROMA_HOST")
-    chroma_port = os.environ.get("CHROMA_PORT")
-    chroma_client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
 
     print("getting collection")
 
-    collection = chroma_client.get_collection(name="5_gemini")
+    if shards > 1:
+        # Every shard is searched at the same time and the best hits of all of them kept
+        collection = python_rag_shard.chroma_shards("5_gemini", shards)
+    else:
+        chroma_client = python_rag_common.get_chroma_http_client()
+        collection = chroma_client.get_collection(name="5_gemini")
 
     print("collection found")
 
-    question = "Who settled Escondido?"
-
-    results = collection.query(
-        query_embeddings=get_embeddings_for_input(question),
-        n_results=4,
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        args,
+        collection,
+        python_rag_common.generate_gemini_answer,
+        get_embeddings_for_input,
+        python_rag_common.stream_gemini_answer,
+    )
+    python_rag_pipeline.ask_questions(
+        pipeline, "Who settled Escondido?", args.interactive, args.stream
     )
-    print(results)
-    print("done")
-
-    PROMPT_TEMPLATE = """
-    Answer the question based only on the following context:
-
-    {context}
-
-    ---
-
-    Answer the question based on the above context: {question}
-    """
-
-    formatted_prompt = PROMPT_TEMPLATE.format(context=str(results["documents"]), question=question)
-    print(formatted_prompt)
-
-    gemini_api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
-
-    response = client.models.generate_content(model="gemini-2.0-flash", contents=[formatted_prompt])
-    print("ANSWER")
-    print(response.text)
 
 
 def main():
-    gemini_query()
+    parser = python_rag_common.init_parser("Search an existing corpus and get an answer")
+    parser.add_argument(
+        "--shards", type=int, default=1, help="collections the corpus was sharded over by 6 or 10"
+    )
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    args = parser.parse_args()
+    python_rag_common.setup_instrumentation(args)
+    gemini_query(args, args.shards)
 
 
 if __name__ == "__main__":
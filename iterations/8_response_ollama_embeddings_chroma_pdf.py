@@ -1,12 +1,11 @@
+import functools
 import textwrap
 from pathlib import Path
-from pprint import pprint
 
-import chromadb
-import PyPDF2
 import python_rag_common
-from langchain_ollama.llms import OllamaLLM
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import python_rag_ingest
+import python_rag_pipeline
+import python_rag_snapshot
 
 DESC = textwrap.dedent(
     """\
@@ -18,103 +17,85 @@ Search a PDF, get an answer.
 """
 )
 
-PROMPT_TEMPLATE = """\
-Answer the question based only on the following context:
-
-{context}
-
----
-
-Answer the question based on the above context: {question}
-"""
-
-
-def extract_text_from_pdf(pdf_path):
-    # Open the PDF file in binary read mode
-    with open(pdf_path, "rb") as file:
-        # Create a PDF reader object
-        pdf_reader = PyPDF2.PdfReader(file)
-
-        # Initialize a variable to store the extracted text
-        extracted_text = ""
-
-        # Iterate through each page in the PDF
-        for page in pdf_reader.pages:
-            # Extract text from the page and append it to the extracted_text variable
-            extracted_text += page.extract_text()
-
-    return extracted_text
-
 
 def populate_and_query_chroma_embeddings(
-    pdf_path, is_interactive=False, model_name="deepseek-r1:8b"
+    pdf_path,
+    args,
+    model_name="deepseek-r1:8b",
+    pdf_workers=0,
+    vector_store="chroma",
+    snapshot_path=None,
 ):
     # This will use ChromaDBs embeddings. It performs better in my testing than the
     # ollama model nomic-embed-text that I have locally. However, it's still not
     # amazing
-    text = extract_text_from_pdf(pdf_path)
-    print(text[:200])
-
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    texts = text_splitter.split_text(text)
-
-    # This is how the cool kids do it I guess? This syntax will take some getting used to.
-    # texts_with_ids = [(i, segment) for i, segment in enumerate(texts, start=1)]
-
-    ids = []
-    for i, _ in enumerate(texts, start=1):
-        ids.append(str(i))
-
-    # print(texts)
-
-    chroma_client = chromadb.Client()
-    embed_func = python_rag_common.get_chromadb_embedding_function()
-    collection = chroma_client.create_collection(
-        name="my_collection", embedding_function=embed_func
+    # The cache means unchanged chunks don't go through the model again on the next run
+    embedding_cache = python_rag_common.get_embedding_cache()
+    embed_func = python_rag_common.get_chromadb_embedding_function(cache=embedding_cache)
+    collection = python_rag_common.create_ephemeral_collection(
+        "my_collection", embed_func, vector_store
     )
 
-    collection.add(documents=texts, ids=ids)
+    def build(writer):
+        # Pages stream through splitting and into the collection in batches, so the whole
+        # document is never held in memory at once. Each chunk remembers its page number.
+        # IDs come from the source path, page and chunk content (rather than position) so
+        # editing the PDF doesn't shift the ID of every chunk after the edit.
+        text_splitter = python_rag_ingest.make_text_splitter()
+        pages = python_rag_ingest.iter_pdf_pages(pdf_path, processes=pdf_workers)
+        chunks = python_rag_ingest.iter_page_chunks(pdf_path, pages, text_splitter)
+        python_rag_ingest.add_chunks_in_batches(writer, chunks, embed_fn=embed_func)
+
+    # Extracting and embedding a PDF is slow, so the chunks and their embeddings are kept
+    # in a snapshot that later runs load instead (until the PDF or the model changes)
+    python_rag_snapshot.restore_or_build(
+        collection,
+        snapshot_path,
+        python_rag_common.chromadb_embedding_model_name(),
+        [pdf_path],
+        build,
+    )
     python_rag_common.print_collection(collection)
-    model = OllamaLLM(model=model_name)
-
-    default_query = "When does the game end?"
-    print(f"\nExample: {default_query}")
-
-    while True:
-        query = (
-            input(f"\nQuery [{model_name}] (or q/quit to quit): ")
-            if is_interactive
-            else default_query
-        )
-        if query.lower() in ["q", "quit"]:
-            break
-
-        results = collection.query(
-            query_texts=query,
-            n_results=4,
-        )
-        pprint(results)
-
-        formatted_prompt = PROMPT_TEMPLATE.format(context=str(results["documents"]), question=query)
-        print(formatted_prompt)
-
-        response_text = model.invoke(formatted_prompt)
-        print("ANSWER")
-        print(response_text)
-        if not is_interactive:
-            break
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    model = python_rag_common.get_ollama_llm(model_name)
+    pipeline = python_rag_pipeline.query_pipeline_from_args(
+        args,
+        collection,
+        model.invoke,
+        lambda query: embed_func([query])[0],
+        functools.partial(python_rag_common.stream_ollama_answer, model_name),
+    )
+    python_rag_pipeline.ask_questions(
+        pipeline, "When does the game end?", args.interactive, args.stream, f"Query [{model_name}]"
+    )
 
 
 def main():
     parser = python_rag_common.init_parser(DESC)
     parser.add_argument("pdf_path", help="source PDF")
     parser.add_argument("--ollama-model", default="deepseek-r1:8b", help="Ollama model to use")
+    parser.add_argument(
+        "--pdf-workers", type=int, default=0, help="processes used to extract PDF pages"
+    )
+    python_rag_pipeline.add_query_loop_arguments(parser)
+    python_rag_common.add_vector_store_argument(parser)
+    python_rag_snapshot.add_snapshot_arguments(parser)
     args = parser.parse_args()
+    python_rag_common.setup_instrumentation(args)
 
     pdf_path = Path(args.pdf_path)
     if not (pdf_path.exists() and pdf_path.is_file()):
         raise Exception(f"{pdf_path}: Is not an existing file")
-    populate_and_query_chroma_embeddings(pdf_path, args.interactive, args.ollama_model)
+    populate_and_query_chroma_embeddings(
+        pdf_path,
+        args,
+        args.ollama_model,
+        args.pdf_workers,
+        args.vector_store,
+        python_rag_snapshot.snapshot_path_from_args(
+            args, [pdf_path], python_rag_common.chromadb_embedding_model_name()
+        ),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import json
+import textwrap
+
+import python_rag_batching
+import python_rag_pipeline
+from dotenv import load_dotenv
+
+DESC = textwrap.dedent(
+    """\
+Serve questions from a resident process instead of re-running a script per question.
+The corpus is split, embedded and indexed once at startup. After that each question only
+costs retrieval plus generation.
+
+Questions are sent as JSON lines over TCP, one object per line:
+
+    echo '{"question": "Who settled Escondido?"}' | nc localhost 8765
+
+Each question gets one JSON line back with the answer, the documents used and timings.
+Many clients can be connected at once. Questions that arrive together have their
+embeddings computed in one call (--embed-wait-ms, 0 turns that off).
+
+* Where does the search corpus come from? Text file or PDF
+* How does it create embeddings? ChromaDB built-in (ollama backend) or Gemini
+* What model does it use for a response? Local ollama or Gemini
+"""
+)
+
+EPILOG = textwrap.dedent(
+    """\
+Requirements
+"GEMINI_API_KEY" set in ".env" file at root for the gemini backend.
+"""
+)
+
+
+async def handle_client(reader, writer, pipeline, generation_limit):
+    """Answer each JSON line a client sends, in order, until it disconnects"""
+    while line := await reader.readline():
+        try:
+            question = json.loads(line)["question"]
+            # Retrieval and generation block, so they run in a worker thread while the
+            # event loop keeps serving other clients.
+            async with generation_limit:
+                response = await asyncio.to_thread(pipeline.answer, question)
+        except Exception as e:
+            response = {"error": str(e)}
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def serve(pipeline, host, port, max_concurrency):
+    generation_limit = asyncio.Semaphore(max_concurrency)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client(reader, writer, pipeline, generation_limit),
+        host,
+        port,
+    )
+    print(f"Listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESC, epilog=EPILOG
+    )
+    python_rag_pipeline.add_pipeline_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--max-concurrency", type=int, default=4, help="questions answered at the same time"
+    )
+    # Questions from different clients share embedding calls by default here
+    parser.set_defaults(embed_wait_ms=python_rag_batching.MICRO_BATCH_WAIT_MS)
+    args = parser.parse_args()
+
+    load_dotenv()
+    pipeline = python_rag_pipeline.pipeline_from_args(args)
+    print(f"Indexed {pipeline.collection.count()} chunks from {args.source}")
+    asyncio.run(serve(pipeline, args.host, args.port, args.max_concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import os
+import time
+from array import array
+
+import numpy as np
+
+# Until a store has this many rows exact search is fast enough, so the index isn't trained
+MIN_TRAIN_ROWS = 10_000
+# k-means is trained on a sample of about this many rows per list, like faiss does
+TRAIN_ROWS_PER_LIST = 40
+KMEANS_ITERATIONS = 10
+# The index is retrained once the store has grown to this many times the rows it was
+# trained on, so lists don't keep growing while their number stays the same
+RETRAIN_GROWTH = 2
+# Queries scored against every row at once by recall_at_k()
+TRUTH_BATCH = 64
+# Lists searched per query. More lists is slower but finds more of the true neighbours.
+DEFAULT_NPROBE = 8
+# Rows assigned to lists at once while training or bulk adding
+ASSIGN_BLOCK_ROWS = 16384
+
+
+class IVFFlatIndex:
+    """Approximate nearest neighbour index for NumpyVectorStore and MappedVectorStore.
+
+    The vectors are partitioned into `nlist` clusters with k-means, and the index keeps
+    each cluster's row numbers (an inverted list). A query is compared with the cluster
+    centres first and only the rows in the `nprobe` closest clusters are scored, so
+    it touches roughly nprobe / nlist of the store instead of all of it. The vectors stay
+    in the store; the index is only the centres and the lists.
+
+    Rows are added as the store grows. Below `min_train_rows` the store keeps using exact
+    search. Once it gets there the index is trained on what's in the store, and after that
+    new rows just go into the list of their nearest centre. When the store reaches
+    RETRAIN_GROWTH times the rows it was trained on it's trained again, with more lists
+    (unless `nlist` was given) and centres that fit what was added since. Call train()
+    yourself after the corpus has changed a lot without growing. recall_at_k() shows what
+    a given nprobe costs in accuracy."""
+
+    def __init__(self, nlist=None, nprobe=DEFAULT_NPROBE, min_train_rows=MIN_TRAIN_ROWS, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.seed = seed
+        self.centroids = None
+        # Rows in the store when the index was last trained
+        self.trained_rows = 0
+        self._fixed_nlist = nlist
+        self._lists = []
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def add(self, matrix, start, stop):
+        """Index rows [start, stop) of `matrix`, training first if there are enough of them"""
+        if self.is_trained and stop < self.trained_rows * RETRAIN_GROWTH:
+            self._assign(matrix, start, stop)
+        elif stop >= self.min_train_rows:
+            self.train(matrix[:stop])
+
+    def train(self, matrix):
+        """k-means on (a sample of) the normalized rows of `matrix`, then index all of them"""
+        rows = len(matrix)
+        nlist = min(self._fixed_nlist or max(1, int(4 * np.sqrt(rows))), rows)
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(rows, nlist * TRAIN_ROWS_PER_LIST)
+        sample = np.asarray(matrix[np.sort(rng.choice(rows, sample_size, replace=False))])
+        self.centroids = _kmeans(sample, nlist, rng)
+        self.nlist = nlist
+        self.trained_rows = rows
+        self._lists = [array("i") for _ in range(nlist)]
+        self._assign(matrix, 0, rows)
+
+    def probe(self, queries, nprobe=None, min_rows=0):
+        """Rows to score for each query: the lists of its `nprobe` nearest centres, plus
+        more lists if that's fewer than `min_rows` rows. Rows come back sorted."""
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        centre_scores = queries @ self.centroids.T
+        probed = []
+        for scores in centre_scores:
+            order = np.argsort(-scores)
+            lists = [self._lists[c] for c in order[:nprobe]]
+            found = sum(len(rows) for rows in lists)
+            for c in order[nprobe:]:
+                if found >= min_rows:
+                    break
+                lists.append(self._lists[c])
+                found += len(self._lists[c])
+            rows = np.concatenate([np.frombuffer(rows, dtype=np.int32) for rows in lists])
+            probed.append(np.sort(rows))
+        return probed
+
+    def remap(self, keep):
+        """Follow a store that dropped rows: `keep` is the old row numbers that are left,
+        in their new order"""
+        if not self.is_trained:
+            return
+        new_rows = np.full(max(keep, default=-1) + 1, -1, dtype=np.int64)
+        new_rows[keep] = np.arange(len(keep))
+        for c, rows in enumerate(self._lists):
+            old = np.frombuffer(rows, dtype=np.int32)
+            old = old[old < len(new_rows)]
+            moved = new_rows[old]
+            self._lists[c] = array("i", moved[moved >= 0].astype(np.int32).tobytes())
+
+    def list_sizes(self):
+        return np.array([len(rows) for rows in self._lists])
+
+    def save(self, path):
+        """Write the index as one .npz: centres, lists concatenated and list offsets"""
+        lists = [np.frombuffer(rows, dtype=np.int32) for rows in self._lists]
+        np.savez(
+            path,
+            centroids=self.centroids,
+            offsets=np.cumsum([0] + [len(rows) for rows in lists]),
+            rows=np.concatenate(lists or [np.empty(0, dtype=np.int32)]),
+            params=np.array(
+                [
+                    self.nprobe,
+                    self.min_train_rows,
+                    self.seed,
+                    self.trained_rows,
+                    self._fixed_nlist or 0,
+                ]
+            ),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            nprobe, min_train_rows, seed, trained_rows, fixed_nlist = data["params"].tolist()
+            index = cls(fixed_nlist or None, nprobe, min_train_rows, seed)
+            index.nlist = len(data["centroids"])
+            index.trained_rows = trained_rows
+            index.centroids = data["centroids"]
+            offsets = data["offsets"]
+            rows = data["rows"].astype(np.int32)
+            index._lists = [
+                array("i", rows[offsets[c] : offsets[c + 1]].tobytes()) for c in range(index.nlist)
+            ]
+        return index
+
+    def _assign(self, matrix, start, stop):
+        for block_start in range(start, stop, ASSIGN_BLOCK_ROWS):
+            block = np.asarray(matrix[block_start : min(stop, block_start + ASSIGN_BLOCK_ROWS)])
+            nearest = np.argmax(block @ self.centroids.T, axis=1)
+            # Grouped by list, so each list gets one extend per block
+            order = np.argsort(nearest, kind="stable")
+            rows = (order + block_start).astype(np.int32)
+            bounds = np.searchsorted(nearest[order], np.arange(self.nlist + 1))
+            for c in np.flatnonzero(np.diff(bounds)):
+                self._lists[c].frombytes(rows[bounds[c] : bounds[c + 1]].tobytes())
+
+
+def _kmeans(vectors, k, rng, iterations=KMEANS_ITERATIONS):
+    """Spherical k-means: centres are normalized, so nearest means highest dot product"""
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = np.concatenate(
+            [
+                np.argmax(vectors[i : i + ASSIGN_BLOCK_ROWS] @ centroids.T, axis=1)
+                for i in range(0, len(vectors), ASSIGN_BLOCK_ROWS)
+            ]
+        )
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, vectors)
+        counts = np.bincount(nearest, minlength=k)
+        # A centre that lost all its rows restarts on a random row
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def recall_at_k(store, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """How many of the true top `k` the store finds at each nprobe, and how long a query
+    takes. The truth is a brute force scan of the store's float32 vectors, done here rather
+    than with the store's own search, which for an int8 or float16 MappedVectorStore scans
+    the compact copy first.
+
+    Returns [{"nprobe", "recall", "ms_per_query"}, ...], plus a row for the store's search
+    without its index (nprobe None) to compare the timings with. Its recall is 1.0 unless
+    the store searches a quantized copy."""
+    queries = np.asarray(queries, dtype=np.float32)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    index, original_nprobe = store.index, store.index.nprobe
+    k = min(k, store.count())
+    vectors = store._matrix[: store.count()]
+    truth = []
+    for start in range(0, len(queries), TRUTH_BATCH):
+        scores = queries[start : start + TRUTH_BATCH] @ vectors.T
+        truth.extend(set(np.argpartition(-row, k - 1)[:k].tolist()) for row in scores)
+
+    def measure(nprobe):
+        start = time.perf_counter()
+        found = store._top_k(queries, k)
+        seconds = time.perf_counter() - start
+        hits = sum(
+            len(rows & set(found_rows.tolist())) for rows, (found_rows, _) in zip(truth, found)
+        )
+        return {
+            "nprobe": nprobe,
+            "recall": hits / (k * len(queries)),
+            "ms_per_query": seconds * 1000 / len(queries),
+        }
+
+    try:
+        store.index = None
+        results = [measure(None)]
+        store.index = index
+        for nprobe in nprobes:
+            if nprobe > index.nlist:
+                break
+            index.nprobe = nprobe
+            results.append(measure(nprobe))
+    finally:
+        store.index = index
+        index.nprobe = original_nprobe
+    return results
+
+
+def load_index(path):
+    """The IVFFlatIndex saved in store directory `path`, or None if it doesn't have one"""
+    index_path = os.path.join(path, "ivf.npz")
+    return IVFFlatIndex.load(index_path) if os.path.exists(index_path) else None
@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from python_rag_metrics import count
+
+# A question waits at most this long for others to share its embedding call
+MICRO_BATCH_WAIT_MS = 5
+MICRO_BATCH_SIZE = 32
+
+
+class MicroBatchEmbedder:
+    """Embeds one text at a time for many threads, but with one embedding call per batch.
+
+    Every question a server answers needs its own query embedding, and with many users
+    they arrive together: twenty questions in the same few milliseconds are twenty Gemini
+    or ollama requests. Here each caller queues its text and waits. A worker thread takes
+    the first text, collects whatever else arrives in the next `max_wait_ms` (up to
+    `max_batch` texts), embeds them all with one `embed_fn(texts)` call and hands each
+    caller its own embedding. Identical texts in a batch are embedded once.
+
+    A single caller pays at most `max_wait_ms` extra. If the call fails, every caller in
+    that batch gets the exception."""
+
+    def __init__(self, embed_fn, max_batch=MICRO_BATCH_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS):
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be at least 1, got {max_batch}")
+        self.embed_fn = embed_fn
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def __call__(self, text):
+        return self.submit(text).result()
+
+    def submit(self, text):
+        """Queue `text` and return a Future for its embedding"""
+        future = Future()
+        self._queue.put((text, future))
+        with self._lock:
+            if self._worker is None:
+                # Daemon, so a server that exits doesn't wait on an idle worker
+                self._worker = threading.Thread(
+                    target=self._run, name="micro-batch-embedder", daemon=True
+                )
+                self._worker.start()
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._embed(batch)
+
+    def _embed(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        # Texts per batch is micro_batched_texts / micro_batches
+        count("micro_batches")
+        count("micro_batched_texts", len(batch))
+        try:
+            embeddings = dict(zip(texts, self.embed_fn(texts)))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for text, future in batch:
+            future.set_result(embeddings[text])
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+import python_rag_metrics
+
+DEFAULT_EMBEDDING_CACHE_PATH = ".cache/embeddings.sqlite3"
+# Hits whose last-used time is written to the file at once. Until then it's only in memory,
+# so a lookup doesn't have to write and commit.
+TOUCH_BATCH = 1000
+
+
+def text_hash(text):
+    """Content hash used as the cache key for a chunk of text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model name, chunk text hash).
+
+    Entries live in a small SQLite file so they survive between runs. Once there are more
+    than `max_entries` the least recently used entries are evicted. Hits only note when
+    an entry was used; that's written with the next store, every TOUCH_BATCH hits or on
+    close(). `hits` and `misses` count lookups since the cache was opened."""
+
+    def __init__(self, path=DEFAULT_EMBEDDING_CACHE_PATH, max_entries=200_000):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self._db.commit()
+        # Rows in the table, kept up to date by _store() instead of counted every time
+        (self._entries,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        # Last-used times of hits that aren't written yet, by (model, text hash)
+        self._touched = {}
+
+    def get_or_embed(self, model, texts, embed_fn):
+        """Embeddings for `texts`, calling `embed_fn(list_of_texts)` only for cache misses"""
+        hashes = [text_hash(text) for text in texts]
+        with self._lock:
+            found = self._lookup(model, set(hashes))
+
+            # Identical chunks only need to be embedded once
+            missing = {}
+            for text, key in zip(texts, hashes):
+                if key not in found and key not in missing:
+                    missing[key] = text
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        python_rag_metrics.count("embedding_cache_hits", len(texts) - len(missing))
+        python_rag_metrics.count("embedding_cache_misses", len(missing))
+
+        if missing:
+            new_embeddings = embed_fn(list(missing.values()))
+            # Round trip through float32 so a fresh result matches what a later hit returns
+            found.update(zip(missing.keys(), (array("f", e).tolist() for e in new_embeddings)))
+            with self._lock:
+                self._store(model, {key: found[key] for key in missing})
+
+        return [found[key] for key in hashes]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self._entries}
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
+
+    def _lookup(self, model, hashes):
+        found = {}
+        keys = list(hashes)
+        # Stay well under SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            rows = self._db.execute(
+                f"SELECT text_hash, embedding FROM embeddings WHERE model = ? "
+                f"AND text_hash IN ({','.join('?' * len(batch))})",
+                [model, *batch],
+            )
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        now = time.time()
+        self._touched.update(((model, key), now) for key in found)
+        if len(self._touched) >= TOUCH_BATCH:
+            self._write_touched()
+            self._db.commit()
+        return found
+
+    def _store(self, model, embeddings):
+        now = time.time()
+        before = self._db.total_changes
+        # Another process may have stored the same text since the lookup. Its embedding is
+        # the same, so that row is kept and doesn't count as a new one.
+        self._db.executemany(
+            "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)",
+            [(model, key, array("f", e).tobytes(), now) for key, e in embeddings.items()],
+        )
+        self._entries += self._db.total_changes - before
+        if self._entries > self.max_entries:
+            # Eviction goes by last-used time, so that has to be up to date first
+            self._write_touched()
+            before = self._db.total_changes
+            self._db.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (self._entries - self.max_entries,),
+            )
+            self._entries -= self._db.total_changes - before
+        self._db.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(now, model, key) for (model, key), now in self._touched.items()],
+            )
+            self._touched.clear()
+
+
+def collection_version(collection):
+    """Cheap fingerprint of a collection's contents, used to notice that it changed"""
+    return (str(collection.id), collection.count())
+
+
+class AnswerCache:
+    """In-memory cache of LLM answers keyed by the question's embedding.
+
+    A question whose embedding has a cosine similarity of at least `threshold` with a
+    cached question gets that question's answer, so repeated and near-duplicate questions
+    skip retrieval and generation. Entries expire after `ttl` seconds and past
+    `max_entries` the least recently used entry is dropped. Passing the collection to
+    get()/put() empties the cache whenever the collection changes; call invalidate() for
+    changes a count can't see (e.g. an upsert that replaced chunks one for one)."""
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, embedding, collection=None):
+        """Cached answer for the most similar question, or None"""
+        with self._lock:
+            self._check_version(collection)
+            self._expire()
+            best_key, best_score = None, self.threshold
+            query = _unit(embedding)
+            for key, (vector, _, _) in self._entries.items():
+                score = float(np.dot(query, vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                python_rag_metrics.count("answer_cache_misses")
+                return None
+            self.hits += 1
+            python_rag_metrics.count("answer_cache_hits")
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][1]
+
+    def put(self, embedding, answer, collection=None):
+        with self._lock:
+            self._check_version(collection)
+            self._entries[self._next_key] = (_unit(embedding), answer, time.time() + self.ttl)
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _check_version(self, collection):
+        if collection is None:
+            return
+        version = collection_version(collection)
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _expire(self):
+        now = time.time()
+        for key in [key for key, (_, _, expires) in self._entries.items() if expires < now]:
+            del self._entries[key]
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,31 +1,115 @@
 import argparse
-import platform
+import atexit
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from chromadb.utils import embedding_functions
-from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+import python_rag_metrics
+from python_rag_cache import DEFAULT_EMBEDDING_CACHE_PATH, EmbeddingCache
+from python_rag_metrics import METRICS, add_sink, count, detail, span  # noqa: F401
 
+# chromadb, the model SDKs and langchain take seconds to import between them, so they're
+# imported in the functions that use them. That keeps --help and runs that never touch a
+# given backend from paying for it. benchmarks/bench_startup.py keeps an eye on this.
 
-def get_chromadb_embedding_function():
-    """Intel Mac work-around for chroma ONNXRuntimeError.
+# Rate limited and transient server errors are worth another try. Anything else
+# (bad key, bad model name, etc.) won't get better by waiting.
+RETRYABLE_STATUS_CODES = {429, 500, 503}
 
-    See: https://github.com/chroma-core/chroma/issues/2731"""
-    ef = embedding_functions.DefaultEmbeddingFunction()
-    if platform.system() == "Darwin" and platform.processor() == "i386":
-        ef = ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+# Cache key for chroma's built-in embedding model
+CHROMADB_DEFAULT_EMBEDDING_MODEL = "chroma-all-MiniLM-L6-v2"
+
+
+def get_chromadb_embedding_function(cache=None):
+    """chroma's built-in embedding model on CPU, tuned for batches (see
+    TunedOnnxEmbeddingFunction). Pinning the CPU provider also works around the Intel Mac
+    ONNXRuntimeError, see: https://github.com/chroma-core/chroma/issues/2731
+
+    Pass an EmbeddingCache to skip the model for text it has already embedded.
+
+    Tuned with environment variables, since it's shared by every script:
+    ONNX_THREADS (threads per inference call, default one per core), ONNX_INTER_OP_THREADS,
+    ONNX_BATCH_SIZE, ONNX_BATCH_TOKENS and ONNX_QUANTIZED=1 for the int8 model."""
+    from python_rag_embeddings import (
+        ONNX_BATCH_SIZE,
+        ONNX_BATCH_TOKENS,
+        CachedEmbeddingFunction,
+        TunedOnnxEmbeddingFunction,
+    )
+
+    quantized = _quantized()
+    ef = TunedOnnxEmbeddingFunction(
+        intra_op_threads=_int_env("ONNX_THREADS"),
+        inter_op_threads=_int_env("ONNX_INTER_OP_THREADS"),
+        batch_size=_int_env("ONNX_BATCH_SIZE") or ONNX_BATCH_SIZE,
+        batch_tokens=_int_env("ONNX_BATCH_TOKENS") or ONNX_BATCH_TOKENS,
+        quantized=quantized,
+    )
+    if cache is not None:
+        ef = CachedEmbeddingFunction(ef, cache, chromadb_embedding_model_name())
     return ef
 
 
+def chromadb_embedding_model_name():
+    """Name of the model get_chromadb_embedding_function() embeds with, for keying stored
+    embeddings. The int8 model gets its own name, since its embeddings differ slightly."""
+    return CHROMADB_DEFAULT_EMBEDDING_MODEL + ("-int8" if _quantized() else "")
+
+
+def _quantized():
+    return os.environ.get("ONNX_QUANTIZED", "") not in ("", "0")
+
+
+def _int_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+@functools.cache
+def get_embedding_cache():
+    """Shared on-disk embedding cache. EMBEDDING_CACHE_PATH overrides where it lives."""
+    cache = EmbeddingCache(os.environ.get("EMBEDDING_CACHE_PATH", DEFAULT_EMBEDDING_CACHE_PATH))
+    # Writes the last-used times of hits it's still holding
+    atexit.register(cache.close)
+    return cache
+
+
 def init_parser(desc, epilog=None):
-    """Reusable arg parser that supports --interactive flag"""
+    """Reusable arg parser that supports --interactive flag and the instrumentation flags"""
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter, description=desc, epilog=epilog
     )
     parser.add_argument(
         "-i", "--interactive", default=False, action="store_true", help="prompt user for query"
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="print search results, prompts and stage timings",
+    )
+    parser.add_argument("--metrics-file", help="append span/counter events here as JSON lines")
+    parser.add_argument("--prometheus-file", help="write metric totals here on exit")
     return parser
 
 
+def setup_instrumentation(args):
+    """Hook up the sinks asked for by the init_parser() flags"""
+    if args.verbose:
+        add_sink(python_rag_metrics.print_sink)
+    if args.metrics_file:
+        metrics_file = open(args.metrics_file, "a")
+        atexit.register(metrics_file.close)
+        add_sink(python_rag_metrics.json_lines_sink(metrics_file))
+    if args.prometheus_file:
+        atexit.register(python_rag_metrics.write_prometheus, args.prometheus_file)
+
+
 def print_collection(collection):
     """Helper method that prints details of ChromaDB collection"""
     result = collection.peek()
@@ -35,3 +119,213 @@ def print_collection(collection):
     print(f"Found {count} embeddings in ChromaDB. Showing first {limit}")
     for i in range(0, limit):
         print(f"{i}: id={result["ids"][i]:<15} doc={result["documents"][i]}")
+
+
+def add_vector_store_argument(parser):
+    parser.add_argument(
+        "--vector-store",
+        choices=["chroma", "numpy", "ivf"],
+        default="chroma",
+        help="where the throwaway index lives: an ephemeral chroma collection, a numpy matrix "
+        "or a numpy matrix with an approximate (IVF) index once it's big enough",
+    )
+
+
+def create_ephemeral_collection(name, embedding_function=None, vector_store="chroma"):
+    """Collection that only lives for this run.
+
+    "numpy" skips chroma's client, sqlite and HNSW setup and keeps the vectors in memory
+    instead. Exact search over a few thousand chunks is a single matrix multiply, which is
+    faster to build and query than the HNSW index at this size. "ivf" is the same store
+    with a python_rag_ann.IVFFlatIndex, which takes over from exact search as it grows."""
+    if vector_store in ("numpy", "ivf"):
+        import python_rag_store
+        from python_rag_ann import IVFFlatIndex
+
+        index = IVFFlatIndex() if vector_store == "ivf" else None
+        return python_rag_store.NumpyVectorStore(name, embedding_function, index=index)
+    import chromadb
+
+    if embedding_function is None:
+        return chromadb.Client().create_collection(name=name)
+    return chromadb.Client().create_collection(name=name, embedding_function=embedding_function)
+
+
+# Client provider. Each backend client is built once per process and then shared so
+# its HTTP connections stay open between calls instead of paying for a new connection
+# (and TLS handshake) on every embed/generate/query. Call these after load_dotenv().
+
+
+def _shared(build):
+    """functools.cache that's safe to call from several threads at once. Two threads that
+    both built a client would each get their own, and the one that's dropped closes its
+    connections, which can be in use by then."""
+    cached = functools.cache(build)
+    lock = threading.Lock()
+
+    @functools.wraps(build)
+    def get(*args):
+        with lock:
+            return cached(*args)
+
+    return get
+
+
+@_shared
+def get_gemini_client():
+    """Shared Gemini client configured from the environment.
+
+    GEMINI_BASE_URL is optional and points the SDK at another server (e.g. a local fake)."""
+    from google import genai
+
+    base_url = os.environ.get("GEMINI_BASE_URL")
+    http_options = genai.types.HttpOptions(base_url=base_url) if base_url else None
+    return genai.Client(api_key=os.environ.get("GEMINI_API_KEY"), http_options=http_options)
+
+
+@_shared
+def get_ollama_client():
+    """Shared Ollama client (used for embeddings). Honors OLLAMA_HOST."""
+    import ollama
+
+    return ollama.Client(host=os.environ.get("OLLAMA_HOST"))
+
+
+@_shared
+def get_ollama_llm(model_name):
+    """Shared langchain Ollama LLM, one per model name. Honors OLLAMA_HOST."""
+    from langchain_ollama.llms import OllamaLLM
+
+    return OllamaLLM(model=model_name, base_url=os.environ.get("OLLAMA_HOST"))
+
+
+@_shared
+def get_chroma_http_client():
+    """Shared client for the persisted ChromaDB server at CHROMA_HOST:CHROMA_PORT."""
+    import chromadb
+
+    return chromadb.HttpClient(
+        host=os.environ.get("CHROMA_HOST"), port=os.environ.get("CHROMA_PORT")
+    )
+
+
+def embed_texts_gemini(
+    texts,
+    model="text-embedding-004",
+    batch_size=100,
+    max_concurrency=4,
+    max_retries=5,
+    initial_backoff=1.0,
+    cache=None,
+):
+    """Embed many texts with Gemini using batched, concurrent requests.
+
+    Texts are packed into embed_content calls of up to `batch_size` items with at most
+    `max_concurrency` calls in flight. Rate limits are retried with exponential backoff.
+    The embeddings come back in the same order as `texts`. With a `cache` only the
+    texts it hasn't seen are sent to Gemini."""
+    if cache is not None:
+        return cache.get_or_embed(
+            model,
+            texts,
+            lambda missing: embed_texts_gemini(
+                missing, model, batch_size, max_concurrency, max_retries, initial_backoff
+            ),
+        )
+
+    from google.genai import errors
+
+    client = get_gemini_client()
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    def embed_batch(batch):
+        for attempt in range(max_retries + 1):
+            try:
+                result = client.models.embed_content(model=model, contents=batch)
+                return [embedding.values for embedding in result.embeddings]
+            except errors.APIError as e:
+                if e.code not in RETRYABLE_STATUS_CODES or attempt == max_retries:
+                    raise
+                count("embed_retries")
+                # The jitter keeps the workers from all retrying at the same moment
+                time.sleep(initial_backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+    # .map() hands results back in submission order, no matter which batch finishes first
+    with span("embed", backend="gemini", items=len(texts)):
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            embeddings = [e for batch in executor.map(embed_batch, batches) for e in batch]
+    count("embedded_texts", len(texts))
+    return embeddings
+
+
+def embed_texts_ollama(texts, model="nomic-embed-text", cache=None):
+    """Embed many texts with a single Ollama embed call (optionally through a cache)"""
+    if cache is not None:
+        return cache.get_or_embed(model, texts, lambda missing: embed_texts_ollama(missing, model))
+    with span("embed", backend="ollama", items=len(texts)):
+        embeddings = get_ollama_client().embed(model=model, input=texts).embeddings
+    count("embedded_texts", len(texts))
+    return embeddings
+
+
+def generate_gemini_answer(prompt, model="gemini-2.0-flash"):
+    """The whole answer from Gemini in one piece"""
+    return get_gemini_client().models.generate_content(model=model, contents=[prompt]).text
+
+
+def stream_ollama_answer(model_name, prompt):
+    """Stream an answer from a local ollama model as (text, token_count) pieces.
+
+    Ollama streams one token per piece."""
+    for text in get_ollama_llm(model_name).stream(prompt):
+        yield text, 1
+
+
+def stream_gemini_answer(prompt, model="gemini-2.0-flash"):
+    """Stream an answer from Gemini as (text, token_count) pieces"""
+    tokens_so_far = 0
+    for chunk in get_gemini_client().models.generate_content_stream(model=model, contents=[prompt]):
+        # Gemini reports a running total of generated tokens rather than a per chunk count
+        usage = chunk.usage_metadata
+        total = usage.candidates_token_count if usage and usage.candidates_token_count else 0
+        token_count = max(total - tokens_so_far, 0)
+        tokens_so_far = max(total, tokens_so_far)
+        yield chunk.text or "", token_count
+
+
+def print_streamed_answer(pieces, out=sys.stdout):
+    """Print an answer as it streams in. Returns the full answer and timing stats:
+    time to first token, total time, tokens and tokens/sec."""
+    start = time.perf_counter()
+    first_token_at = None
+    parts = []
+    tokens = 0
+    for text, token_count in pieces:
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        parts.append(text)
+        tokens += token_count
+        out.write(text)
+        out.flush()
+    end = time.perf_counter()
+    out.write("\n")
+
+    first_token_at = first_token_at or end
+    generating = end - first_token_at
+    stats = {
+        "time_to_first_token": first_token_at - start,
+        "seconds": end - start,
+        "tokens": tokens,
+        "tokens_per_second": tokens / generating if generating > 0 else 0.0,
+    }
+    METRICS.record("first_token", stats["time_to_first_token"])
+    METRICS.record("generate", stats["seconds"], stream=True, tokens=tokens)
+    count("generated_tokens", tokens)
+    return "".join(parts), stats
+
+
+def print_stream_stats(stats):
+    print(
+        f"[first token after {stats['time_to_first_token']:.2f}s, {stats['tokens']} tokens "
+        f"in {stats['seconds']:.2f}s, {stats['tokens_per_second']:.1f} tokens/sec]"
+    )
@@ -0,0 +1,92 @@
+import math
+
+from python_rag_metrics import count, span
+
+# Room for retrieved text in the prompt. Four 500 character chunks are ~500 tokens, so this
+# only bites when more (or longer) chunks are retrieved.
+DEFAULT_CONTEXT_TOKENS = 1024
+# Roughly how many characters make up a token for English text with the Gemini and Llama
+# style tokenizers. Close enough for budgeting without loading a tokenizer.
+CHARS_PER_TOKEN = 4
+# The splitter overlaps neighbouring chunks by up to 100 characters. Shorter matches than
+# this are more likely to be a coincidence (a repeated word) than a real overlap.
+MIN_OVERLAP = 20
+PASSAGE_SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def build_context(documents, max_tokens=DEFAULT_CONTEXT_TOKENS):
+    """Prompt context from retrieved chunks, most relevant first.
+
+    Neighbouring chunks that overlap (the splitter repeats the end of one chunk at the start
+    of the next) are stitched back into one passage so the shared text only appears once.
+    Passages are added in order of their best ranked chunk until `max_tokens` is used up.
+    The first passage is cut to fit rather than dropped, so there's always some context."""
+    with span("context", chunks=len(documents)):
+        passages = merge_overlapping([document for document in documents if document])
+        selected = []
+        used = 0
+        for passage in passages:
+            separator = estimate_tokens(PASSAGE_SEPARATOR) if selected else 0
+            tokens = estimate_tokens(passage) + separator
+            if used + tokens > max_tokens:
+                if not selected:
+                    selected.append(passage[: max_tokens * CHARS_PER_TOKEN])
+                    used = max_tokens
+                continue
+            selected.append(passage)
+            used += tokens
+    count("context_tokens", used)
+    return PASSAGE_SEPARATOR.join(selected)
+
+
+def merge_overlapping(passages, min_overlap=MIN_OVERLAP):
+    """Join passages whose end and start overlap, and drop ones contained in another.
+    Results stay in rank order, a merged passage taking the rank of its best part."""
+    merged = []
+    for rank, passage in enumerate(passages):
+        passage = passage.strip()
+        # A merge can make the passage overlap another one that's already been kept (a
+        # chunk that bridges two others), so keep going until nothing else joins
+        joined_any = True
+        while joined_any:
+            joined_any = False
+            for i, (other_rank, other) in enumerate(merged):
+                joined = _join(other, passage, min_overlap)
+                if joined is not None:
+                    del merged[i]
+                    passage, rank = joined, min(rank, other_rank)
+                    joined_any = True
+                    break
+        merged.append((rank, passage))
+    return [passage for _, passage in sorted(merged)]
+
+
+def _join(first, second, min_overlap):
+    if second in first:
+        return first
+    if first in second:
+        return second
+    overlap = _overlap(first, second, min_overlap)
+    if overlap:
+        return first + second[overlap:]
+    overlap = _overlap(second, first, min_overlap)
+    if overlap:
+        return second + first[overlap:]
+    return None
+
+
+def _overlap(first, second, min_overlap):
+    """Length of the longest end of `first` that's also the start of `second`"""
+    head = second[:min_overlap]
+    if len(head) < min_overlap:
+        return 0
+    start = max(0, len(first) - len(second))
+    while (position := first.find(head, start)) != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        start = position + 1
+    return 0
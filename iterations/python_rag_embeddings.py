@@ -0,0 +1,179 @@
+import functools
+import os
+from functools import cached_property
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+from python_rag_metrics import count, span
+
+# A batch holds up to this many chunks...
+ONNX_BATCH_SIZE = 256
+# ...and up to this many tokens, padding included, so batches of short chunks are bigger
+ONNX_BATCH_TOKENS = 16384
+# Written next to chroma's model.onnx the first time the quantized model is asked for
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """Puts an EmbeddingCache in front of a ChromaDB embedding function"""
+
+    def __init__(self, embedding_function, cache, model_name):
+        self._embedding_function = embedding_function
+        self._cache = cache
+        self._model_name = model_name
+
+    def __call__(self, input):
+        return self._cache.get_or_embed(self._model_name, list(input), self._embedding_function)
+
+    def name(self):
+        return self._embedding_function.name()
+
+    def get_config(self):
+        return self._embedding_function.get_config()
+
+    def default_space(self):
+        return self._embedding_function.default_space()
+
+    def supported_spaces(self):
+        return self._embedding_function.supported_spaces()
+
+    def is_legacy(self):
+        return self._embedding_function.is_legacy()
+
+
+class TunedOnnxEmbeddingFunction(ONNXMiniLM_L6_V2):
+    """chroma's built-in all-MiniLM-L6-v2 model, set up for embedding lots of chunks on CPU.
+
+    The stock version pads every chunk to 256 tokens and runs 32 chunks per call with
+    onnxruntime's default threading. This one sorts chunks by length and pads each batch
+    only to its own longest chunk, so short chunks aren't paying for 256 tokens each, and
+    sizes batches by tokens rather than a fixed count. Thread counts are configurable, and
+    everything in a process shares one session per model and thread setting.
+
+    `quantized` uses an int8 copy of the model, which is faster on CPU at a small cost in
+    accuracy. Its embeddings differ slightly, so don't mix them in one index."""
+
+    def __init__(
+        self,
+        intra_op_threads=None,
+        inter_op_threads=None,
+        batch_size=ONNX_BATCH_SIZE,
+        batch_tokens=ONNX_BATCH_TOKENS,
+        quantized=False,
+    ):
+        super().__init__(preferred_providers=["CPUExecutionProvider"])
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.quantized = quantized
+
+    @cached_property
+    def tokenizer(self):
+        tokenizer = self.Tokenizer.from_file(
+            os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "tokenizer.json")
+        )
+        # Same truncation as chroma, but padding happens per batch in _forward()
+        tokenizer.enable_truncation(max_length=self.max_tokens())
+        tokenizer.no_padding()
+        return tokenizer
+
+    @cached_property
+    def model(self):
+        path = os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "model.onnx")
+        if self.quantized:
+            path = quantized_model(path)
+        return onnx_session(path, self.intra_op_threads, self.inter_op_threads)
+
+    def _forward(self, documents, batch_size=None):
+        with span("onnx_embed", texts=len(documents)):
+            encoded = self.tokenizer.encode_batch(list(documents))
+            embeddings = None
+            padding = 0
+            for rows in self._batches([len(e.ids) for e in encoded], batch_size):
+                longest = len(encoded[rows[-1]].ids)
+                input_ids = np.zeros((len(rows), longest), dtype=np.int64)
+                attention_mask = np.zeros((len(rows), longest), dtype=np.int64)
+                for i, row in enumerate(rows):
+                    ids = encoded[row].ids
+                    input_ids[i, : len(ids)] = ids
+                    attention_mask[i, : len(ids)] = 1
+                padding += attention_mask.size - int(attention_mask.sum())
+
+                last_hidden_state = self.model.run(
+                    None,
+                    {
+                        "input_ids": input_ids,
+                        "attention_mask": attention_mask,
+                        "token_type_ids": np.zeros_like(input_ids),
+                    },
+                )[0]
+                # Mean of the token vectors, ignoring padding
+                mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+                pooled = (last_hidden_state * mask).sum(1) / np.clip(mask.sum(1), 1e-9, None)
+                if embeddings is None:
+                    embeddings = np.empty((len(documents), pooled.shape[1]), dtype=np.float32)
+                embeddings[rows] = self._normalize(pooled)
+        count("onnx_padding_tokens", padding)
+        if embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return embeddings
+
+    def _batches(self, lengths, batch_size=None):
+        """Row numbers grouped into batches of similar length, shortest first"""
+        batch_size = batch_size or self.batch_size
+        batch = []
+        for row in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # Sorted, so this row sets the padded length of the batch
+            if batch and (
+                len(batch) == batch_size or (len(batch) + 1) * lengths[row] > self.batch_tokens
+            ):
+                yield batch
+                batch = []
+            batch.append(row)
+        if batch:
+            yield batch
+
+
+@functools.cache
+def onnx_session(path, intra_op_threads=None, inter_op_threads=None):
+    """One CPU inference session per model file and thread setting, shared in the process.
+    None leaves the thread count to onnxruntime (one thread per physical core)."""
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.log_severity_level = 3
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        # Only used when independent parts of the graph can run at the same time
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    return onnxruntime.InferenceSession(
+        path, providers=["CPUExecutionProvider"], sess_options=options
+    )
+
+
+def quantized_model(path):
+    """Path of an int8 copy of the ONNX model at `path`, quantized the first time it's needed.
+
+    Quantizing needs the onnx package, but only once: put a pre-quantized model.onnx copy
+    named QUANTIZED_MODEL_FILE next to the original to skip that."""
+    quantized = os.path.join(os.path.dirname(path), QUANTIZED_MODEL_FILE)
+    if os.path.exists(quantized):
+        return quantized
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError:
+        raise ValueError(
+            "Quantizing the embedding model needs the onnx package. Please install it with "
+            "`pip install onnx`"
+        )
+    # Written under another name first so a process that's starting up never loads half a
+    # model
+    partial = f"{quantized}.{os.getpid()}.tmp"
+    quantize_dynamic(path, partial, weight_type=QuantType.QInt8)
+    os.replace(partial, quantized)
+    return quantized
@@ -0,0 +1,168 @@
+import re
+from array import array
+
+import numpy as np
+from python_rag_metrics import span
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Words that show up in nearly every question and chunk, so they only add noise to scores
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in is it of on or so "
+    "that the their there this to was were what when where which who why will with you".split()
+)
+# How many results each retriever contributes before fusion
+HYBRID_CANDIDATES = 20
+
+
+def tokenize(text):
+    """Lowercase words minus stopwords, with a crude plural strip ("ends" -> "end")"""
+    return [
+        token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+class BM25Index:
+    """Keyword search over chunks with BM25 scoring.
+
+    Embeddings are good at meaning but can miss exact terms (rule names, card names,
+    numbers) that a keyword index finds easily. The index is built as chunks are added: a
+    posting list of (row, term frequency) packed in int32 arrays per term, so a query only
+    touches the lists for its own terms."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self._lengths = array("i")
+        self._postings = {}
+
+    def add(self, ids, documents):
+        for chunk_id, document in zip(ids, documents):
+            row = len(self.ids)
+            self.ids.append(chunk_id)
+            tokens = tokenize(document or "")
+            self._lengths.append(len(tokens))
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, frequency in frequencies.items():
+                rows, counts = self._postings.setdefault(token, (array("i"), array("i")))
+                rows.append(row)
+                counts.append(frequency)
+
+    def count(self):
+        return len(self.ids)
+
+    def query(self, text, n_results=10):
+        """[(id, score), ...] for the best matching chunks, best first. Chunks that share
+        no terms with the text aren't returned."""
+        if not self.ids:
+            return []
+        lengths = np.frombuffer(self._lengths, dtype=np.int32)
+        length_norm = 1 - self.b + self.b * lengths / max(lengths.mean(), 1)
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for token in set(tokenize(text)):
+            if token not in self._postings:
+                continue
+            rows, counts = (np.frombuffer(a, dtype=np.int32) for a in self._postings[token])
+            idf = np.log(1 + (len(self.ids) - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * counts * (self.k1 + 1) / (counts + self.k1 * length_norm[rows])
+
+        matched = np.flatnonzero(scores)
+        k = min(n_results, len(matched))
+        if not k:
+            return []
+        best = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        best = best[np.argsort(-scores[best])]
+        return [(self.ids[row], float(scores[row])) for row in best]
+
+    def save(self, path):
+        """Write the index as one .npz: the posting lists concatenated plus term offsets"""
+        terms = list(self._postings)
+        rows = [self._postings[term][0] for term in terms]
+        offsets = np.cumsum([0] + [len(r) for r in rows])
+        np.savez(
+            path,
+            ids=np.array(self.ids, dtype=str),
+            lengths=np.frombuffer(self._lengths, dtype=np.int32),
+            terms=np.array(terms, dtype=str),
+            offsets=offsets,
+            rows=np.concatenate([np.frombuffer(r, dtype=np.int32) for r in rows] or [[]]),
+            counts=np.concatenate(
+                [np.frombuffer(self._postings[term][1], dtype=np.int32) for term in terms] or [[]]
+            ),
+            params=np.array([self.k1, self.b]),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(*data["params"].tolist())
+            index.ids = data["ids"].tolist()
+            index._lengths.frombytes(data["lengths"].astype(np.int32).tobytes())
+            offsets = data["offsets"]
+            rows = data["rows"].astype(np.int32)
+            counts = data["counts"].astype(np.int32)
+            for i, term in enumerate(data["terms"].tolist()):
+                start, stop = offsets[i], offsets[i + 1]
+                index._postings[term] = (
+                    array("i", rows[start:stop].tobytes()),
+                    array("i", counts[start:stop].tobytes()),
+                )
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge ranked lists of ids. Each id scores sum(1 / (k + rank)) over the lists it's in,
+    so agreeing retrievers win without having to compare their raw scores."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def hybrid_query(
+    collection,
+    keyword_index,
+    query_text,
+    query_embedding=None,
+    n_results=4,
+    candidates=HYBRID_CANDIDATES,
+):
+    """Vector search and BM25 fused with reciprocal rank fusion.
+
+    Returns the same shape as collection.query() for a single query (without distances,
+    which don't mean anything after fusion)."""
+    include = ["documents", "metadatas"]
+    if query_embedding is not None:
+        dense = collection.query(
+            query_embeddings=[query_embedding], n_results=candidates, include=include
+        )
+    else:
+        dense = collection.query(query_texts=query_text, n_results=candidates, include=include)
+    with span("keyword_query", n_results=candidates):
+        keyword = keyword_index.query(query_text, candidates)
+
+    fused = reciprocal_rank_fusion([dense["ids"][0], [chunk_id for chunk_id, _ in keyword]])
+    fused = fused[:n_results]
+    found = {
+        chunk_id: (document, metadata)
+        for chunk_id, document, metadata in zip(
+            dense["ids"][0], dense["documents"][0], dense["metadatas"][0]
+        )
+    }
+    missing = [chunk_id for chunk_id in fused if chunk_id not in found]
+    if missing:
+        extra = collection.get(ids=missing, include=include)
+        found.update(zip(extra["ids"], zip(extra["documents"], extra["metadatas"])))
+    return {
+        "ids": [fused],
+        "documents": [[found[chunk_id][0] for chunk_id in fused]],
+        "metadatas": [[found[chunk_id][1] for chunk_id in fused]],
+        "distances": None,
+        "embeddings": None,
+        "included": include,
+    }
@@ -0,0 +1,549 @@
+import glob
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from python_rag_cache import text_hash
+from python_rag_common import RETRYABLE_STATUS_CODES
+from python_rag_metrics import count, span
+from python_rag_splitter import TextSplitter
+
+# How many ids to pull back per request when reading what a collection already holds
+GET_PAGE_SIZE = 10_000
+
+# Pages handed to a PDF worker process at a time
+PDF_PAGES_PER_TASK = 16
+
+# File types ingest_files() picks up when walking a directory
+SOURCE_SUFFIXES = {".txt", ".pdf"}
+
+# Chunks allowed to wait between the file workers and the embed/write thread. When embedding
+# falls behind, the workers stall here instead of filling memory with split text.
+CHUNK_QUEUE_SIZE = 4096
+
+# Rows per write request. The server's own limit (a few thousand for the sqlite backed
+# server) is used when it's lower.
+BULK_BATCH_SIZE = 1000
+
+
+def chunk_ids(source, texts):
+    """Deterministic IDs for the chunks of `source`, derived from the source path and the
+    chunk's content hash. The same chunk always gets the same ID no matter where it sits in
+    the document, so an edit only changes the IDs of the chunks that were edited."""
+    ids = []
+    seen = {}
+    for text in texts:
+        chunk_id = f"{source}:{text_hash(text)[:16]}"
+        # A chunk that repeats word for word within one source still needs its own ID
+        seen[chunk_id] = seen.get(chunk_id, 0) + 1
+        if seen[chunk_id] > 1:
+            chunk_id = f"{chunk_id}:{seen[chunk_id]}"
+        ids.append(chunk_id)
+    return ids
+
+
+def existing_ids(collection, source):
+    """IDs the collection currently holds for `source`"""
+    if hasattr(collection, "shards"):
+        # Paging a python_rag_shard.ShardedCollection re-reads every shard up to the page
+        # each time, so its shards are paged through one by one instead
+        return set().union(*(existing_ids(shard, source) for shard in collection.shards))
+    ids = set()
+    offset = 0
+    while True:
+        page = collection.get(
+            where={"source": str(source)}, include=[], limit=GET_PAGE_SIZE, offset=offset
+        )
+        ids.update(page["ids"])
+        if len(page["ids"]) < GET_PAGE_SIZE:
+            return ids
+        offset += GET_PAGE_SIZE
+
+
+def sync_collection(collection, source, texts, embed_fn=None, writer=None):
+    """Make `collection` hold exactly `texts` for `source`, writing only what changed.
+
+    Chunks already in the collection are left alone, new chunks are upserted and chunks
+    that are no longer in the source are deleted, so running it twice is a no-op. When
+    `embed_fn` is given it is called with just the new chunks; otherwise the collection's
+    own embedding function does the work. New chunks go through `writer` (a BulkWriter for
+    `collection`) when there is one.
+
+    Returns counts of what was added, deleted and left unchanged."""
+    ids = chunk_ids(source, texts)
+    current = existing_ids(collection, source)
+
+    new = [(chunk_id, text) for chunk_id, text in zip(ids, texts) if chunk_id not in current]
+    stale = current - set(ids)
+
+    if stale:
+        with span("delete", items=len(stale)):
+            collection.delete(ids=list(stale))
+    if new:
+        new_ids = [chunk_id for chunk_id, _ in new]
+        new_texts = [text for _, text in new]
+        embeddings = embed_fn(new_texts) if embed_fn else None
+        with span("add", items=len(new)):
+            (writer or collection).upsert(
+                ids=new_ids,
+                documents=new_texts,
+                embeddings=embeddings,
+                metadatas=[{"source": str(source)} for _ in new],
+            )
+            if writer:
+                writer.flush()
+
+    return {"added": len(new), "deleted": len(stale), "unchanged": len(ids) - len(new)}
+
+
+def make_text_splitter(chunk_size=500, chunk_overlap=100):
+    """The splitter every script uses. Same chunks as langchain's
+    RecursiveCharacterTextSplitter, and it can also give them as offsets (see TextSplitter)."""
+    return TextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _extract_pages(pdf_path, start, stop):
+    """Text of pages [start, stop) as (page_number, text) pairs. Page numbers start at 1."""
+    import PyPDF2
+
+    with open(pdf_path, "rb") as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [(i + 1, pdf_reader.pages[i].extract_text()) for i in range(start, stop)]
+
+
+def iter_pdf_pages(pdf_path, processes=0):
+    """Yield (page_number, text) for each page of a PDF, in order, one page at a time.
+
+    With `processes` > 0 pages are extracted in a process pool. Only a couple of tasks
+    per worker are queued at once so memory stays bounded no matter how long the PDF is."""
+    import PyPDF2
+
+    with open(pdf_path, "rb") as file:
+        page_count = len(PyPDF2.PdfReader(file).pages)
+
+    ranges = (
+        (start, min(start + PDF_PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PDF_PAGES_PER_TASK)
+    )
+    if not processes:
+        for start, stop in ranges:
+            yield from _extract_pages(pdf_path, start, stop)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for start, stop in ranges:
+            pending.append(executor.submit(_extract_pages, pdf_path, start, stop))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_page_chunks(source, pages, text_splitter):
+    """Split each page on its own and yield (id, text, metadata) for every chunk.
+
+    Chunks carry the page they came from and where on the page's text they start and end,
+    so `text_splitter` has to give offsets: a python_rag_splitter.TextSplitter (see
+    make_text_splitter()), not a langchain splitter. IDs follow chunk_ids() but are scoped
+    to the page so nothing has to be remembered across pages."""
+    for page_number, page_text in pages:
+        with span("split", page=page_number):
+            spans = text_splitter.spans(page_text)
+        count("chunks", len(spans))
+        texts = [page_text[start:end] for _, start, end in spans]
+        ids = chunk_ids(f"{source}:{page_number}", texts)
+        for chunk_id, text, (_, start, end) in zip(ids, texts, spans):
+            yield chunk_id, text, {
+                "source": str(source),
+                "page": page_number,
+                "start": start,
+                "end": end,
+            }
+
+
+def add_chunks_in_batches(collection, chunks, batch_size=256, embed_fn=None, keyword_index=None):
+    """Add (id, text, metadata) chunks to the collection `batch_size` at a time.
+
+    Works on any iterable, so with generators upstream only one batch is ever held in
+    memory. When `embed_fn` is given each batch is embedded with it first; otherwise the
+    collection's embedding function is used. A `keyword_index` (python_rag_hybrid.BM25Index)
+    is built from the same batches. Returns how many chunks were added."""
+    total = 0
+    for batch in itertools.batched(chunks, batch_size):
+        ids, texts, metadatas = (list(column) for column in zip(*batch))
+        embeddings = embed_fn(texts) if embed_fn else None
+        with span("add", items=len(ids)):
+            collection.add(ids=ids, documents=texts, embeddings=embeddings, metadatas=metadatas)
+        if keyword_index is not None:
+            keyword_index.add(ids, texts)
+        total += len(ids)
+    return total
+
+
+def load_file_chunks(source, chunk_size=500, chunk_overlap=100, processes=0):
+    """(id, text, metadata) chunks for a .txt or .pdf file. Text chunks carry their start
+    and end offset in the file's text. A PDF's chunks come from a generator that reads it a
+    page at a time, so only a few pages are in memory at once. `processes` > 1 splits a big
+    text file in parallel, and `processes` > 0 extracts PDF pages in that many processes."""
+    text_splitter = make_text_splitter(chunk_size, chunk_overlap)
+    if Path(source).suffix.lower() == ".pdf":
+        pages = iter_pdf_pages(source, processes=processes)
+        return iter_page_chunks(source, pages, text_splitter)
+
+    with open(source, "r") as file:
+        content = file.read()
+    with span("split"):
+        spans = text_splitter.spans(content, processes=processes)
+    count("chunks", len(spans))
+    texts = [content[start:end] for _, start, end in spans]
+    ids = chunk_ids(source, texts)
+    return [
+        (chunk_id, text, {"source": str(source), "start": start, "end": end})
+        for chunk_id, text, (_, start, end) in zip(ids, texts, spans)
+    ]
+
+
+class BulkWriter:
+    """Adds and upserts to a collection in batches with several requests in flight.
+
+    Meant for a collection on a chroma server, where one huge add() goes over the server's
+    batch limit and one batch at a time leaves the connection idle between round trips.
+    Rows are cut into `batch_size` batches and sent from `max_concurrency` threads that
+    share the client's connection pool. Transient failures (dropped connections, 429s and
+    5xx) are retried with backoff. Retries are upserts, so a batch the server got before
+    the connection dropped isn't written twice.
+
+    add() and upsert() return one future per batch and only block when too many batches
+    are waiting. flush() waits for everything sent so far and raises the first error."""
+
+    def __init__(
+        self,
+        collection,
+        batch_size=None,
+        max_concurrency=4,
+        max_retries=5,
+        initial_backoff=0.5,
+    ):
+        self.collection = collection
+        self.batch_size = batch_size or server_batch_size(collection)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._started = None
+
+    def add(self, ids, documents=None, embeddings=None, metadatas=None):
+        return self._write("add", ids, documents, embeddings, metadatas)
+
+    def upsert(self, ids, documents=None, embeddings=None, metadatas=None):
+        return self._write("upsert", ids, documents, embeddings, metadatas)
+
+    def flush(self):
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        seconds = time.perf_counter() - self._started if self._started else 0.0
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "retries": self.retries,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds else None,
+        }
+
+    def _write(self, method, ids, documents, embeddings, metadatas):
+        if self._started is None:
+            self._started = time.perf_counter()
+        futures = []
+        for start in range(0, len(ids), self.batch_size):
+            rows = slice(start, start + self.batch_size)
+            batch = {"ids": list(ids[rows])}
+            for name, column in [
+                ("documents", documents),
+                ("embeddings", embeddings),
+                ("metadatas", metadatas),
+            ]:
+                if column is not None:
+                    batch[name] = column[rows]
+            # A couple of batches per thread queued up is enough to keep them all busy
+            while len(self._pending) >= self.max_concurrency * 2:
+                self._pending.popleft().result()
+            future = self._executor.submit(self._send, method, batch)
+            self._pending.append(future)
+            futures.append(future)
+        return futures
+
+    def _send(self, method, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("bulk_write", method=method, items=len(batch["ids"])):
+                    getattr(self.collection, method if attempt == 0 else "upsert")(**batch)
+                break
+            except Exception as e:
+                if not _retryable(e) or attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                count("bulk_write_retries")
+                time.sleep(self.initial_backoff * 2**attempt * random.uniform(0.5, 1.5))
+        with self._lock:
+            self.rows += len(batch["ids"])
+            self.batches += 1
+        count("bulk_write_rows", len(batch["ids"]))
+
+
+def server_batch_size(collection, default=BULK_BATCH_SIZE):
+    """`default`, or the most rows the collection's server takes per request if that's less"""
+    client = getattr(collection, "_client", None)
+    if client is None or not hasattr(client, "get_max_batch_size"):
+        return default
+    limit = client.get_max_batch_size()
+    return min(default, limit) if limit > 0 else default
+
+
+def _retryable(error):
+    """Connection failures and the status codes worth another try"""
+    import httpx
+
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    # chroma's own errors carry the status code the server answered with
+    code = getattr(error, "code", None)
+    return callable(code) and code() in RETRYABLE_STATUS_CODES
+
+
+def find_sources(patterns):
+    """.txt and .pdf files under each directory or matching each glob, sorted"""
+    sources = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = (str(path) for path in Path(pattern).rglob("*"))
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        sources.update(
+            match
+            for match in matches
+            if Path(match).suffix.lower() in SOURCE_SUFFIXES and os.path.isfile(match)
+        )
+    return sorted(sources)
+
+
+def file_fingerprint(source):
+    """Cheap change check that doesn't read the file"""
+    stat = os.stat(source)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class IngestManifest:
+    """Checkpoint of the files that are fully in the collection, kept as JSON lines.
+
+    A line is appended as each file's last chunk is written, so checkpointing stays cheap
+    with tens of thousands of files and an interrupted ingest picks up where it stopped.
+    The last line for a file wins."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by a crash
+                    self.files[entry["source"]] = entry
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a")
+
+    def is_current(self, source, fingerprint):
+        entry = self.files.get(source)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def record(self, source, fingerprint, chunks):
+        entry = {"source": source, "fingerprint": fingerprint, "chunks": chunks}
+        self.files[source] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def ingest_files(
+    collection,
+    sources,
+    manifest,
+    embed_fn=None,
+    processes=None,
+    batch_size=256,
+    queue_size=CHUNK_QUEUE_SIZE,
+    on_file_done=None,
+    write_concurrency=4,
+):
+    """Read, split, embed and write many files, skipping the ones `manifest` says are done.
+
+    Files are read and split in a process pool. Their chunks go through a bounded queue to
+    one thread that embeds them `batch_size` at a time, so batches fill up across file
+    boundaries and a slow embedder holds the workers back rather than letting chunks pile
+    up. Embedded batches are upserted through a BulkWriter with `write_concurrency`
+    requests in flight while the next batch is embedded. A file goes in the manifest once
+    all of its chunks are written. A file that changed since it was last ingested has its
+    old chunks deleted first.
+
+    `on_file_done(source, fingerprint, chunks)` is called as each file finishes. Returns
+    counts of the files ingested, skipped and failed, the chunks written and the write
+    rate."""
+    todo = [(source, file_fingerprint(source)) for source in sources]
+    todo = [(source, fp) for source, fp in todo if not manifest.is_current(source, fp)]
+    totals = {"files": 0, "skipped": len(sources) - len(todo), "failed": 0, "chunks": 0}
+
+    def file_done(source, fingerprint, chunks):
+        manifest.record(source, fingerprint, chunks)
+        totals["files"] += 1
+        totals["chunks"] += chunks
+        count("ingested_files")
+        if on_file_done:
+            on_file_done(source, fingerprint, chunks)
+
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    bulk_writer = BulkWriter(collection, max_concurrency=write_concurrency)
+    writer = threading.Thread(
+        target=_write_chunks,
+        args=(bulk_writer, chunk_queue, embed_fn, batch_size, file_done, errors),
+    )
+    writer.start()
+
+    def enqueue(source, fingerprint, future):
+        try:
+            chunks = future.result()
+        except Exception as e:
+            print(f"{source}: {e}")
+            totals["failed"] += 1
+            return
+        if source in manifest.files:
+            chunk_queue.put(("delete", source))
+        for chunk in chunks:
+            chunk_queue.put(("chunk", chunk))
+        chunk_queue.put(("done", source, fingerprint, len(chunks)))
+
+    workers = processes or os.cpu_count()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Same bounded window as iter_pdf_pages(): a couple of files per worker in flight
+            pending = deque()
+            for source, fingerprint in todo:
+                if errors:
+                    break
+                pending.append(
+                    (source, fingerprint, executor.submit(_load_file_chunk_list, source))
+                )
+                if len(pending) >= workers * 2:
+                    enqueue(*pending.popleft())
+            while pending and not errors:
+                enqueue(*pending.popleft())
+            for _, _, future in pending:
+                future.cancel()
+    finally:
+        chunk_queue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    totals["rows_per_second"] = bulk_writer.stats()["rows_per_second"]
+    return totals
+
+
+def _load_file_chunk_list(source):
+    """load_file_chunks() for a process pool worker, which has to send all of a file's
+    chunks back at once. Files are already read in parallel there, so a PDF's pages aren't."""
+    return list(load_file_chunks(source))
+
+
+def _write_chunks(writer, chunk_queue, embed_fn, batch_size, file_done, errors):
+    """Writer thread for ingest_files(). After an error it keeps draining the queue so the
+    producer never blocks on a full queue, and the error is raised once the producer stops."""
+    batch = []
+    # Files whose last chunk is in `batch`; they're done once it has been written
+    finished = []
+    # (futures, files) for batches that were sent but may not be written yet, oldest first
+    in_flight = deque()
+
+    def settle(wait=False):
+        """Mark files done once their batches (and every batch before them) are written"""
+        while in_flight and (wait or all(future.done() for future in in_flight[0][0])):
+            futures, files = in_flight.popleft()
+            for future in futures:
+                future.result()
+            for done in files:
+                file_done(*done)
+
+    def flush():
+        futures = []
+        if batch:
+            ids, texts, metadatas = (list(column) for column in zip(*batch))
+            embeddings = embed_fn(texts) if embed_fn else None
+            futures = writer.upsert(
+                ids=ids, documents=texts, embeddings=embeddings, metadatas=metadatas
+            )
+            batch.clear()
+        in_flight.append((futures, list(finished)))
+        finished.clear()
+        settle()
+
+    while (item := chunk_queue.get()) is not None:
+        if errors:
+            continue
+        try:
+            if item[0] == "chunk":
+                batch.append(item[1])
+                if len(batch) >= batch_size:
+                    flush()
+            elif item[0] == "done":
+                finished.append(item[1:])
+                if not batch:
+                    flush()
+            elif item[0] == "delete":
+                # The file's new chunks may have the same IDs as old ones, so the delete has
+                # to land before any of them are sent
+                flush()
+                settle(wait=True)
+                with span("delete", source=item[1]):
+                    writer.collection.delete(where={"source": item[1]})
+        except Exception as e:
+            errors.append(e)
+    try:
+        if not errors:
+            flush()
+            settle(wait=True)
+        writer.close()
+    except Exception as e:
+        errors.append(e)
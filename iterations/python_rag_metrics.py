@@ -0,0 +1,128 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pprint import pprint
+
+
+class Metrics:
+    """Timings for pipeline stages (spans) and running counters.
+
+    Spans and counters are always aggregated in memory, which is cheap. Individual events
+    only go anywhere if a sink has been added; a sink is any callable taking an event dict."""
+
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.sinks = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.record(name, time.perf_counter() - start, **attributes)
+
+    def record(self, name, seconds, **attributes):
+        """Add a span that was timed some other way"""
+        with self._lock:
+            count, total, longest = self.spans.get(name, (0, 0.0, 0.0))
+            self.spans[name] = (count + 1, total + seconds, max(longest, seconds))
+        if self.sinks:
+            self.emit({"type": "span", "name": name, "seconds": seconds, **attributes})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.sinks:
+            self.emit({"type": "counter", "name": name, "value": value})
+
+    def detail(self, name, value):
+        """Something only worth looking at when debugging (results, prompts, ...)"""
+        if self.sinks:
+            self.emit({"type": "detail", "name": name, "value": value})
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def prometheus_text(self, prefix="rag"):
+        """Current totals in the Prometheus text exposition format"""
+        with self._lock:
+            spans = dict(self.spans)
+            counters = dict(self.counters)
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent in each pipeline stage",
+            f"# TYPE {prefix}_span_seconds summary",
+        ]
+        for name, (count, total, _) in sorted(spans.items()):
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {total}')
+        lines.append(f"# TYPE {prefix}_span_seconds_max gauge")
+        for name, (_, _, longest) in sorted(spans.items()):
+            lines.append(f'{prefix}_span_seconds_max{{span="{name}"}} {longest}')
+        for name, value in sorted(counters.items()):
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Process wide metrics that the pipeline reports to
+METRICS = Metrics()
+
+
+def span(name, **attributes):
+    """Time a block as one pipeline stage: `with span("embed", items=10): ...`"""
+    return METRICS.span(name, **attributes)
+
+
+def count(name, value=1):
+    METRICS.count(name, value)
+
+
+def detail(name, value):
+    METRICS.detail(name, value)
+
+
+def add_sink(sink):
+    METRICS.sinks.append(sink)
+
+
+def json_lines_sink(file):
+    """Sink that writes each event as one JSON line"""
+    lock = threading.Lock()
+
+    def sink(event):
+        line = json.dumps({"time": time.time(), **event}, default=str)
+        with lock:
+            file.write(line + "\n")
+            file.flush()
+
+    return sink
+
+
+def print_sink(event):
+    """Sink for --verbose: prints details in full and a one line summary of everything else"""
+    if event["type"] == "detail":
+        print(f"{event['name']}:")
+        pprint(event["value"])
+    elif event["type"] == "span":
+        attributes = {k: v for k, v in event.items() if k not in ("type", "name", "seconds")}
+        suffix = f" {attributes}" if attributes else ""
+        print(f"[{event['name']} {event['seconds'] * 1000:.1f}ms{suffix}]")
+    else:
+        print(f"[{event['name']} +{event['value']}]")
+
+
+def write_prometheus(path):
+    with open(path, "w") as file:
+        file.write(METRICS.prometheus_text())
@@ -0,0 +1,535 @@
+import asyncio
+import functools
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import python_rag_batching
+import python_rag_cache
+import python_rag_common
+import python_rag_context
+import python_rag_hybrid
+import python_rag_ingest
+import python_rag_rerank
+import python_rag_shard
+import python_rag_store
+
+PROMPT_TEMPLATE = """\
+Answer the question based only on the following context:
+
+{context}
+
+---
+
+Answer the question based on the above context: {question}
+"""
+
+
+class RagPipeline:
+    """The retrieve -> prompt -> generate flow of the scripts that answer questions, set up
+    once so it can answer any number of them.
+
+    `generate_fn(prompt)` returns the answer text. When `embed_query_fn(question)` is given
+    the collection is searched by embedding, otherwise by the collection's own embedding
+    function. An `answer_cache` (which needs `embed_query_fn`) answers repeated and
+    near-duplicate questions without retrieval or generation. With a `keyword_index`
+    retrieval is hybrid: vector and BM25 results fused (see python_rag_hybrid).
+    `embed_batch_fn(questions)` lets answer_batch() embed a batch of questions in one call.
+    A `reranker` (python_rag_rerank.CrossEncoderReranker) retrieves its number of
+    candidates and keeps the best `n_results` of them. `stream_fn(prompt)` yields the answer
+    as (text, token_count) pieces for print_answer(stream=True)."""
+
+    def __init__(
+        self,
+        collection,
+        generate_fn,
+        embed_query_fn=None,
+        n_results=4,
+        answer_cache=None,
+        keyword_index=None,
+        context_tokens=python_rag_context.DEFAULT_CONTEXT_TOKENS,
+        embed_batch_fn=None,
+        reranker=None,
+        stream_fn=None,
+    ):
+        self.collection = collection
+        self.generate_fn = generate_fn
+        self.embed_query_fn = embed_query_fn
+        self.n_results = n_results
+        self.answer_cache = answer_cache
+        self.keyword_index = keyword_index
+        self.context_tokens = context_tokens
+        self.embed_batch_fn = embed_batch_fn
+        self.reranker = reranker
+        self.stream_fn = stream_fn
+        # How many chunks to retrieve, before any reranking
+        self.n_retrieve = reranker.candidates if reranker else n_results
+
+    def retrieve(self, question, query_embedding=None):
+        if query_embedding is None and self.embed_query_fn:
+            query_embedding = self.embed_query_fn(question)
+        with python_rag_common.span("query", n_results=self.n_retrieve):
+            if self.keyword_index is not None:
+                results = python_rag_hybrid.hybrid_query(
+                    self.collection,
+                    self.keyword_index,
+                    question,
+                    query_embedding,
+                    self.n_retrieve,
+                )
+            elif query_embedding is not None:
+                results = self.collection.query(
+                    query_embeddings=[query_embedding], n_results=self.n_retrieve
+                )
+            else:
+                results = self.collection.query(query_texts=question, n_results=self.n_retrieve)
+        return self._rerank(question, results)
+
+    def retrieve_batch(self, questions):
+        """Search for many questions at once: one embedding call and one collection query
+        for the whole batch. Returns (query_embeddings, results), one entry per question,
+        each result shaped like a single-question collection.query()."""
+        if self.embed_batch_fn is not None:
+            query_embeddings = list(self.embed_batch_fn(questions))
+        elif self.embed_query_fn is not None:
+            query_embeddings = [self.embed_query_fn(question) for question in questions]
+        else:
+            query_embeddings = [None] * len(questions)
+
+        # Fusion happens per question, so hybrid search can't share one query
+        if self.keyword_index is not None or self.embed_query_fn is None:
+            results = [self.retrieve(q, e) for q, e in zip(questions, query_embeddings)]
+            return query_embeddings, results
+        with python_rag_common.span("query", n_results=self.n_retrieve, queries=len(questions)):
+            batch = self.collection.query(
+                query_embeddings=query_embeddings, n_results=self.n_retrieve
+            )
+        results = [
+            {
+                key: [batch[key][i]] if batch.get(key) is not None else None
+                for key in ["ids", "documents", "metadatas", "distances"]
+            }
+            for i in range(len(questions))
+        ]
+        results = [self._rerank(question, result) for question, result in zip(questions, results)]
+        return query_embeddings, results
+
+    def format_prompt(self, question, results):
+        with python_rag_common.span("prompt"):
+            context = python_rag_context.build_context(results["documents"][0], self.context_tokens)
+            return PROMPT_TEMPLATE.format(context=context, question=question)
+
+    def answer(self, question):
+        """Answer a question. Returns the answer, the documents used and stage timings."""
+        start = time.perf_counter()
+        query_embedding = self.embed_query_fn(question) if self.embed_query_fn else None
+        response = self._cached_answer(question, query_embedding)
+        if response is None:
+            results = self.retrieve(question, query_embedding)
+            response = self._generate(question, query_embedding, results)
+        response["seconds"]["retrieve"] = (
+            time.perf_counter() - start - response["seconds"]["generate"]
+        )
+        return response
+
+    def print_answer(self, question, stream=False):
+        """Answer a question on stdout, the way the interactive scripts do. With `stream`
+        the answer is printed as it's generated. Returns the answer."""
+        if stream and self.stream_fn is None:
+            raise ValueError("Streaming answers needs a stream_fn")
+        # Repeated and near-identical questions get the earlier answer instead of going
+        # through retrieval and the LLM again
+        query_embedding = self.embed_query_fn(question) if self.embed_query_fn else None
+        cached = self._cached_answer(question, query_embedding)
+        if cached is not None:
+            print("ANSWER (cached)")
+            print(cached["answer"])
+            return cached["answer"]
+
+        results = self.retrieve(question, query_embedding)
+        python_rag_common.detail("results", results)
+        # Overlapping chunks are stitched together and the context is kept to a budget,
+        # since every prompt token adds to the time before the first answer token
+        prompt = self.format_prompt(question, results)
+        python_rag_common.detail("prompt", prompt)
+
+        print("ANSWER")
+        if stream:
+            # Tokens show up as they're generated instead of after the whole answer is done
+            answer, stats = python_rag_common.print_streamed_answer(self.stream_fn(prompt))
+            python_rag_common.print_stream_stats(stats)
+        else:
+            with python_rag_common.span("generate"):
+                answer = self.generate_fn(prompt)
+            print(answer)
+        self._cache_answer(query_embedding, answer)
+        return answer
+
+    async def answer_batch(self, questions, max_concurrency=4, batch_size=32):
+        """Answer many questions, yielding {"index", "question", "answer", ...} dicts as they
+        finish (not in input order).
+
+        Questions are embedded and searched `batch_size` at a time while the answers for
+        earlier batches are being generated, with up to `max_concurrency` generate calls in
+        flight. Only a couple of batches are ever retrieved ahead of generation."""
+        # Own pool rather than asyncio.to_thread(), whose default pool can be smaller than
+        # max_concurrency (it's sized from the CPU count)
+        generation_pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        window = asyncio.Semaphore(batch_size * 2)
+        finished = asyncio.Queue()
+
+        async def generate(index, question, query_embedding, results, retrieve_seconds):
+            try:
+                answer = await asyncio.get_running_loop().run_in_executor(
+                    generation_pool,
+                    lambda: self._cached_answer(question, query_embedding)
+                    or self._generate(question, query_embedding, results),
+                )
+                answer["seconds"]["retrieve"] = retrieve_seconds
+            except Exception as e:
+                answer = {"question": question, "error": str(e)}
+            await finished.put({"index": index, **answer})
+
+        async def produce():
+            tasks = []
+            for batch in itertools.batched(enumerate(questions), batch_size):
+                for _ in batch:
+                    await window.acquire()
+                start = time.perf_counter()
+                try:
+                    query_embeddings, results = await asyncio.to_thread(
+                        self.retrieve_batch, [question for _, question in batch]
+                    )
+                except Exception as e:
+                    for index, question in batch:
+                        await finished.put({"index": index, "question": question, "error": str(e)})
+                    continue
+                retrieve_seconds = (time.perf_counter() - start) / len(batch)
+                for (index, question), query_embedding, result in zip(
+                    batch, query_embeddings, results
+                ):
+                    tasks.append(
+                        asyncio.create_task(
+                            generate(index, question, query_embedding, result, retrieve_seconds)
+                        )
+                    )
+            await asyncio.gather(*tasks)
+            await finished.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (answer := await finished.get()) is not None:
+                window.release()
+                yield answer
+            await producer
+        finally:
+            generation_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _rerank(self, question, results):
+        if self.reranker is None:
+            return results
+        return self.reranker.rerank_results(question, results, self.n_results)
+
+    def _cached_answer(self, question, query_embedding):
+        if self.answer_cache is None or query_embedding is None:
+            return None
+        cached_answer = self.answer_cache.get(query_embedding, self.collection)
+        if cached_answer is None:
+            return None
+        return {
+            "question": question,
+            "answer": cached_answer,
+            "documents": [],
+            "cached": True,
+            "seconds": {"generate": 0.0},
+        }
+
+    def _cache_answer(self, query_embedding, answer):
+        if self.answer_cache is not None and query_embedding is not None:
+            self.answer_cache.put(query_embedding, answer, self.collection)
+
+    def _generate(self, question, query_embedding, results):
+        start = time.perf_counter()
+        prompt = self.format_prompt(question, results)
+        with python_rag_common.span("generate"):
+            answer = self.generate_fn(prompt)
+        self._cache_answer(query_embedding, answer)
+        return {
+            "question": question,
+            "answer": answer,
+            "documents": results["documents"][0],
+            "seconds": {"generate": time.perf_counter() - start},
+        }
+
+
+def build_pipeline(
+    source,
+    backend="ollama",
+    model_name=None,
+    n_results=4,
+    answer_cache=None,
+    vector_store="chroma",
+    index_path=None,
+    index_precision="int8",
+    hybrid=False,
+    context_tokens=python_rag_context.DEFAULT_CONTEXT_TOKENS,
+    reranker=None,
+    ann=False,
+    nprobe=None,
+    embed_wait_ms=0,
+    index_shards=1,
+):
+    """Index `source` and return a RagPipeline over it.
+
+    "ollama" embeds with chroma's built-in model and answers with a local ollama model
+    (like scripts 3 and 8). "gemini" uses Gemini for both (like script 5).
+
+    Without `index_path` the index is an ephemeral collection rebuilt on every start. With
+    it the index is a memory-mapped store in that directory (see MappedVectorStore). It's
+    written on first use and after that just opened, which is instant and lets any number
+    of processes share it. `ann` also trains an approximate (IVF) index when it's written,
+    and `nprobe` is how many of its lists a query searches (see python_rag_ann).
+    `index_shards` > 1 writes it as that many shards, which are searched at the same time
+    in a process pool (see python_rag_shard.open_local_shards()).
+
+    `hybrid` adds a BM25 keyword index next to the vectors and fuses the two at query time.
+    It's built during ingest (and kept in `index_path` when there is one). A `reranker`
+    picks the `n_results` chunks out of a longer retrieved list.
+
+    With `embed_wait_ms` questions asked at the same time from different threads share
+    embedding calls (see python_rag_batching.MicroBatchEmbedder)."""
+    embedding_cache = python_rag_common.get_embedding_cache()
+
+    # Clients and models are built here rather than by the first question, which otherwise
+    # pays for them when an existing index is opened without embedding anything
+    if backend == "ollama":
+        from python_rag_embeddings import CachedEmbeddingFunction
+
+        model = python_rag_common.get_ollama_llm(model_name or "deepseek-r1:8b")
+        generate_fn = model.invoke
+        onnx_fn = python_rag_common.get_chromadb_embedding_function()
+        # Straight to the model, since the cache would skip it for text it has seen
+        onnx_fn(["warm up"])
+        embed_fn = CachedEmbeddingFunction(
+            onnx_fn, embedding_cache, python_rag_common.chromadb_embedding_model_name()
+        )
+        embedding_function = embed_fn
+    elif backend == "gemini":
+        generate_fn = functools.partial(
+            python_rag_common.generate_gemini_answer, model=model_name or "gemini-2.0-flash"
+        )
+        embedding_function = None
+        python_rag_common.get_gemini_client()
+
+        def embed_fn(texts):
+            return python_rag_common.embed_texts_gemini(texts, cache=embedding_cache)
+
+    else:
+        raise ValueError(f"{backend}: Unknown backend, expected 'ollama' or 'gemini'")
+
+    keyword_index = python_rag_hybrid.BM25Index()
+    if index_path is None:
+        collection = python_rag_common.create_ephemeral_collection(
+            "rag_pipeline", embedding_function, vector_store
+        )
+        python_rag_ingest.add_chunks_in_batches(
+            collection,
+            python_rag_ingest.load_file_chunks(source, processes=os.cpu_count()),
+            embed_fn=embed_fn,
+            keyword_index=keyword_index if hybrid else None,
+        )
+    else:
+        keyword_path = os.path.join(index_path, "bm25.npz")
+        sharded = bool(python_rag_shard.local_shard_paths(index_path))
+        if not sharded and not os.path.exists(os.path.join(index_path, "manifest.json")):
+            if index_shards > 1:
+                writer = python_rag_shard.write_local_shards(
+                    index_path, index_shards, index_precision, ann
+                )
+            else:
+                writer = python_rag_store.MappedStoreWriter(index_path, index_precision, ann=ann)
+            with writer:
+                python_rag_ingest.add_chunks_in_batches(
+                    writer,
+                    python_rag_ingest.load_file_chunks(source, processes=os.cpu_count()),
+                    embed_fn=embed_fn,
+                    keyword_index=keyword_index,
+                )
+            keyword_index.save(keyword_path)
+            sharded = index_shards > 1
+        if sharded:
+            collection = python_rag_shard.open_local_shards(
+                index_path, embedding_function, nprobe=nprobe
+            )
+        else:
+            collection = python_rag_store.MappedVectorStore(index_path, embedding_function)
+        if hybrid and os.path.exists(keyword_path):
+            keyword_index = python_rag_hybrid.BM25Index.load(keyword_path)
+        elif hybrid:
+            # Index written before it had a keyword index
+            everything = collection.get(include=["documents"])
+            keyword_index.add(everything["ids"], everything["documents"])
+            keyword_index.save(keyword_path)
+    if nprobe and getattr(collection, "index", None) is not None:
+        collection.index.nprobe = nprobe
+    if reranker is not None:
+        reranker.rerank("warm up", ["warm up"])
+
+    def embed_query_fn(question):
+        return embed_fn([question])[0]
+
+    if embed_wait_ms:
+        embed_query_fn = python_rag_batching.MicroBatchEmbedder(embed_fn, max_wait_ms=embed_wait_ms)
+
+    return RagPipeline(
+        collection,
+        generate_fn,
+        embed_query_fn=embed_query_fn,
+        n_results=n_results,
+        answer_cache=answer_cache,
+        keyword_index=keyword_index if hybrid else None,
+        context_tokens=context_tokens,
+        embed_batch_fn=embed_fn,
+        reranker=reranker,
+    )
+
+
+def add_pipeline_arguments(parser):
+    """build_pipeline() options, for the scripts built on it"""
+    parser.add_argument("--source", default="data/escondido.txt", help="text file or PDF")
+    parser.add_argument("--backend", choices=["ollama", "gemini"], default="ollama")
+    parser.add_argument("--model", help="response model (default depends on backend)")
+    add_query_arguments(parser)
+    python_rag_common.add_vector_store_argument(parser)
+    parser.add_argument(
+        "--index",
+        help="keep the index in this directory as a memory-mapped store; built from --source "
+        "if it isn't there yet, shared by every process started with the same --index",
+    )
+    parser.add_argument(
+        "--index-precision",
+        choices=python_rag_store.PRECISIONS,
+        default="int8",
+        help="precision of the copy of the vectors that --index scans first",
+    )
+    parser.add_argument(
+        "--index-shards",
+        type=int,
+        default=1,
+        help="write --index as this many shards, searched in parallel processes",
+    )
+    parser.add_argument(
+        "--ann",
+        default=False,
+        action="store_true",
+        help="build an approximate (IVF) index when --index is written, for big corpora",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        help="IVF lists searched per query (--ann or --vector-store ivf); more is slower "
+        "and finds more of the true nearest chunks",
+    )
+    parser.add_argument(
+        "--embed-wait-ms",
+        type=float,
+        default=0,
+        help="let concurrent questions wait this long to share one embedding call (0 = off)",
+    )
+
+
+def pipeline_from_args(args):
+    """build_pipeline() from the add_pipeline_arguments() options. Call after load_dotenv()."""
+    return build_pipeline(
+        args.source,
+        args.backend,
+        args.model,
+        answer_cache=answer_cache_from_args(args),
+        vector_store=args.vector_store,
+        index_path=args.index,
+        index_precision=args.index_precision,
+        hybrid=args.hybrid,
+        context_tokens=args.context_tokens,
+        reranker=python_rag_rerank.reranker_from_args(args),
+        ann=args.ann,
+        nprobe=args.nprobe,
+        embed_wait_ms=args.embed_wait_ms,
+        index_shards=args.index_shards,
+    )
+
+
+def ask_questions(pipeline, default_query, is_interactive=False, stream=False, prompt="Query"):
+    """The question loop of the interactive scripts: answer `default_query`, or with
+    `is_interactive` whatever is typed in until q/quit"""
+    print(f"\nExample: {default_query}")
+
+    while True:
+        question = input(f"\n{prompt} (or q/quit to quit): ") if is_interactive else default_query
+        if question.lower() in ["q", "quit"]:
+            break
+        pipeline.print_answer(question, stream)
+        if not is_interactive:
+            break
+
+
+def add_query_arguments(parser):
+    """Options for answering questions over an index, shared by every script that does"""
+    parser.add_argument(
+        "--answer-cache-threshold",
+        type=float,
+        default=0.95,
+        help="reuse the answer to an earlier question at least this similar (1.0 = exact)",
+    )
+    parser.add_argument(
+        "--answer-cache-ttl", type=int, default=3600, help="seconds a cached answer is reused"
+    )
+    parser.add_argument(
+        "--hybrid",
+        default=False,
+        action="store_true",
+        help="combine vector search with BM25 keyword search",
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=python_rag_context.DEFAULT_CONTEXT_TOKENS,
+        help="most tokens of retrieved text to put in the prompt",
+    )
+    python_rag_rerank.add_rerank_arguments(parser)
+
+
+def add_query_loop_arguments(parser):
+    """add_query_arguments() plus --stream, for the scripts that use ask_questions()"""
+    add_query_arguments(parser)
+    parser.add_argument(
+        "--stream", default=False, action="store_true", help="print the answer as it's generated"
+    )
+
+
+def answer_cache_from_args(args):
+    return python_rag_cache.AnswerCache(
+        threshold=args.answer_cache_threshold, ttl=args.answer_cache_ttl
+    )
+
+
+def query_pipeline_from_args(args, collection, generate_fn, embed_query_fn, stream_fn=None):
+    """RagPipeline over a collection a script has already filled, with the
+    add_query_arguments() options"""
+    keyword_index = None
+    if args.hybrid:
+        # Exact terms that embeddings miss are picked up by a keyword index built from the
+        # same chunks
+        everything = collection.get(include=["documents"])
+        keyword_index = python_rag_hybrid.BM25Index()
+        keyword_index.add(everything["ids"], everything["documents"])
+    return RagPipeline(
+        collection,
+        generate_fn,
+        embed_query_fn=embed_query_fn,
+        answer_cache=answer_cache_from_args(args),
+        keyword_index=keyword_index,
+        context_tokens=args.context_tokens,
+        reranker=python_rag_rerank.reranker_from_args(args),
+        stream_fn=stream_fn,
+    )
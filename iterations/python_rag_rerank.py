@@ -0,0 +1,147 @@
+import os
+import time
+
+import numpy as np
+from python_rag_metrics import count, span
+
+# A small (22M parameter) cross-encoder trained on MS MARCO, with an ONNX export on the hub
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# Chunks retrieved for the reranker to choose from, and how long it gets to choose
+RERANK_CANDIDATES = 16
+RERANK_BUDGET_MS = 200
+RERANK_BATCH_SIZE = 8
+# Question and chunk together. A 500 character chunk is ~120 tokens.
+RERANK_MAX_TOKENS = 256
+
+
+class CrossEncoderReranker:
+    """Re-orders retrieved chunks by how well they answer the question.
+
+    Embedding search compares a question and a chunk that were embedded separately. A
+    cross-encoder reads them together, which ranks much better, but it's a model call per
+    chunk so it only makes sense on a short list. The usual setup is to retrieve
+    `candidates` chunks, rerank them and keep the best few, so the prompt gets 2-4 good
+    chunks instead of 8 so-so ones.
+
+    Candidates are scored in batches on CPU, best retrieved first. Scoring stops when the
+    next batch wouldn't finish within `budget_ms`; anything not scored by then keeps its
+    retrieval order behind the scored chunks.
+
+    The model is RERANK_MODEL from the Hugging Face hub, downloaded on first use, or
+    model.onnx and tokenizer.json from `model_dir` (RERANKER_MODEL_DIR) if set."""
+
+    def __init__(
+        self,
+        candidates=RERANK_CANDIDATES,
+        budget_ms=RERANK_BUDGET_MS,
+        batch_size=RERANK_BATCH_SIZE,
+        model_dir=None,
+        threads=None,
+    ):
+        self.candidates = candidates
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.model_dir = model_dir or os.environ.get("RERANKER_MODEL_DIR")
+        self.threads = threads
+        self._tokenizer = None
+        self._session = None
+
+    def rerank(self, question, documents):
+        """(index, score) for `documents`, best first. Unscored documents have score None."""
+        tokenizer, session = self._load()
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        inputs = {i.name for i in session.get_inputs()}
+        scores = []
+        slowest = 0.0
+        with span("rerank", candidates=len(documents)):
+            for start in range(0, len(documents), self.batch_size):
+                now = time.perf_counter()
+                # Always score one batch, so there's some reranking however tight the budget
+                if scores and now + slowest > deadline:
+                    count("rerank_budget_exceeded")
+                    break
+                batch = documents[start : start + self.batch_size]
+                encoded = tokenizer.encode_batch([(question, document or "") for document in batch])
+                longest = max(len(e.ids) for e in encoded)
+                feed = {
+                    name: np.zeros((len(batch), longest), dtype=np.int64)
+                    for name in ["input_ids", "attention_mask", "token_type_ids"]
+                }
+                for row, e in enumerate(encoded):
+                    feed["input_ids"][row, : len(e.ids)] = e.ids
+                    feed["attention_mask"][row, : len(e.ids)] = 1
+                    feed["token_type_ids"][row, : len(e.ids)] = e.type_ids
+                logits = session.run(None, {k: v for k, v in feed.items() if k in inputs})[0]
+                scores.extend(float(score) for score in logits.reshape(len(batch), -1)[:, 0])
+                slowest = max(slowest, time.perf_counter() - now)
+        count("reranked", len(scores))
+        scored = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        return [(i, scores[i]) for i in scored] + [
+            (i, None) for i in range(len(scores), len(documents))
+        ]
+
+    def rerank_results(self, question, results, n_results):
+        """The best `n_results` of a single-question collection.query() result, reranked.
+        Returns the same shape, with the reranker scores in place of distances."""
+        order = self.rerank(question, results["documents"][0])[:n_results]
+        reranked = dict(results)
+        for key in ["ids", "documents", "metadatas", "embeddings"]:
+            if results.get(key) is not None:
+                reranked[key] = [[results[key][0][i] for i, _ in order]]
+        reranked["distances"] = None
+        reranked["rerank_scores"] = [[score for _, score in order]]
+        return reranked
+
+    def _load(self):
+        if self._session is None:
+            from python_rag_embeddings import onnx_session
+            from tokenizers import Tokenizer
+
+            model_path, tokenizer_path = self._model_files()
+            tokenizer = Tokenizer.from_file(tokenizer_path)
+            tokenizer.enable_truncation(max_length=RERANK_MAX_TOKENS)
+            tokenizer.no_padding()
+            self._tokenizer = tokenizer
+            self._session = onnx_session(model_path, self.threads)
+        return self._tokenizer, self._session
+
+    def _model_files(self):
+        if self.model_dir:
+            return (
+                os.path.join(self.model_dir, "model.onnx"),
+                os.path.join(self.model_dir, "tokenizer.json"),
+            )
+        from huggingface_hub import hf_hub_download
+
+        return (
+            hf_hub_download(RERANK_MODEL, "onnx/model.onnx"),
+            hf_hub_download(RERANK_MODEL, "tokenizer.json"),
+        )
+
+
+def add_rerank_arguments(parser):
+    parser.add_argument(
+        "--rerank",
+        default=False,
+        action="store_true",
+        help="retrieve more chunks and keep the best ones by a cross-encoder (CPU)",
+    )
+    parser.add_argument(
+        "--rerank-candidates",
+        type=int,
+        default=RERANK_CANDIDATES,
+        help="chunks retrieved for the reranker to choose from",
+    )
+    parser.add_argument(
+        "--rerank-budget-ms",
+        type=float,
+        default=RERANK_BUDGET_MS,
+        help="stop reranking after about this long per question",
+    )
+
+
+def reranker_from_args(args):
+    """CrossEncoderReranker from the add_rerank_arguments() options, or None without --rerank"""
+    if not args.rerank:
+        return None
+    return CrossEncoderReranker(args.rerank_candidates, args.rerank_budget_ms)
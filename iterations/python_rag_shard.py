@@ -0,0 +1,344 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from python_rag_cache import text_hash
+from python_rag_metrics import span
+
+# Directories of the local shards inside an --index directory
+LOCAL_SHARD_PREFIX = "shard-"
+GET_KEYS = ["ids", "documents", "metadatas", "embeddings"]
+RESULT_KEYS = GET_KEYS + ["distances"]
+
+
+class ShardedCollection:
+    """Several collections (or local stores) that look like one.
+
+    Every chunk lives in exactly one shard, picked by hashing its ID (see shard_of()), so
+    the same chunk always lands in the same shard and upserts, deletes and gets by ID only
+    go to that shard. Writes are split per shard and sent to all shards at once, and a
+    query goes to every shard at once and the results are merged by distance, so n_results
+    comes back as if it was one collection.
+
+    Shards are called from a thread per shard. For chroma collections that's parallel HTTP
+    requests (to one server or several, see chroma_shards()); for local stores the calls
+    are handed to a process pool (see open_local_shards()), so they use more than one core.
+    All shards need the same embedding model and distance function for the merge to make
+    sense. With an `embedding_function`, query_texts are embedded once here instead of
+    once per shard."""
+
+    def __init__(self, shards, embedding_function=None, pool=None):
+        if not shards:
+            raise ValueError("A sharded collection needs at least one shard")
+        self.shards = list(shards)
+        self.name = "+".join(str(shard.name) for shard in self.shards)
+        # What python_rag_cache.collection_version() keys cached answers on (writers don't
+        # have one)
+        self.id = "+".join(str(getattr(shard, "id", shard.name)) for shard in self.shards)
+        self.embedding_function = embedding_function
+        self._pool = pool
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    # -- writing
+
+    def add(self, ids, documents=None, embeddings=None, metadatas=None):
+        self._write("add", ids, documents, embeddings, metadatas)
+
+    def upsert(self, ids, documents=None, embeddings=None, metadatas=None):
+        self._write("upsert", ids, documents, embeddings, metadatas)
+
+    def delete(self, ids=None, where=None):
+        if ids is not None:
+            self._by_shard(ids, lambda shard, shard_ids: shard.delete(ids=shard_ids))
+        if where:
+            self._all(lambda shard: shard.delete(where=where))
+
+    # -- reading
+
+    def count(self):
+        return sum(self._all(lambda shard: shard.count()))
+
+    def get(self, ids=None, where=None, limit=None, offset=0, include=None):
+        """Like collection.get(). Paging goes through the shards in order, so limit and
+        offset page through the whole collection the same way every time. Every page reads
+        each shard's first offset + limit rows though, so to read everything page through
+        the shards one by one instead."""
+        kwargs = {"where": where} if where else {}
+        if include is not None:
+            kwargs["include"] = include
+        if ids is not None:
+            ids = [ids] if isinstance(ids, str) else ids
+            parts = self._by_shard(ids, lambda shard, shard_ids: shard.get(ids=shard_ids, **kwargs))
+        else:
+            # Each shard's first offset + limit rows is enough to cover the page
+            if limit is not None:
+                kwargs["limit"] = offset + limit
+            parts = self._all(lambda shard: shard.get(**kwargs))
+        result = _concatenate(parts, include)
+        if ids is None:
+            stop = offset + limit if limit is not None else None
+            for key in GET_KEYS:
+                if result.get(key) is not None:
+                    result[key] = result[key][offset:stop]
+        return result
+
+    def peek(self, limit=10):
+        return self.get(limit=limit)
+
+    def query(
+        self, query_embeddings=None, query_texts=None, n_results=10, include=None, where=None
+    ):
+        """Nearest neighbours across all shards, best match first"""
+        if query_embeddings is None and self.embedding_function is not None:
+            texts = [query_texts] if isinstance(query_texts, str) else query_texts
+            query_embeddings = self.embedding_function(texts)
+        if query_embeddings is not None:
+            query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+            if query_embeddings.ndim == 1:
+                query_embeddings = query_embeddings[np.newaxis, :]
+            kwargs = {"query_embeddings": query_embeddings}
+        else:
+            kwargs = {"query_texts": query_texts}
+        kwargs["n_results"] = n_results
+        if include is not None:
+            # Merging needs the distances, even when the caller doesn't
+            kwargs["include"] = list(dict.fromkeys([*include, "distances"]))
+        if where:
+            kwargs["where"] = where
+
+        with span("shard_query", shards=len(self.shards), n_results=n_results):
+            parts = self._all(lambda shard: shard.query(**kwargs))
+        keys = [key for key in RESULT_KEYS if parts[0].get(key) is not None]
+        merged = {key: [] if key in keys else None for key in RESULT_KEYS}
+        for query in range(len(parts[0]["ids"])):
+            # (distance, shard, position) for every shard's hits, merged closest first
+            hits = sorted(
+                (distance, shard, position)
+                for shard, part in enumerate(parts)
+                for position, distance in enumerate(part["distances"][query])
+            )[:n_results]
+            for key in keys:
+                merged[key].append(
+                    [parts[shard][key][query][position] for _, shard, position in hits]
+                )
+        if include is not None and "distances" not in include:
+            merged["distances"] = None
+        merged["included"] = include if include is not None else parts[0].get("included")
+        return merged
+
+    # -- plumbing
+
+    def close(self):
+        """Close shards that need it (local store writers) and the worker pools"""
+        self._shut_down("close")
+
+    def abort(self):
+        """Close without finishing the local store writers, so they can't be opened"""
+        self._shut_down("abort")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._shut_down("close" if exc_type is None else "abort")
+
+    def _shut_down(self, method):
+        try:
+            for shard in self.shards:
+                if hasattr(shard, method):
+                    getattr(shard, method)()
+        finally:
+            self._executor.shutdown()
+            if self._pool is not None:
+                self._pool.shutdown()
+                _open_pools.discard(self._pool)
+
+    def _all(self, call):
+        """call(shard) for every shard at once, results in shard order"""
+        return list(self._executor.map(call, self.shards))
+
+    def _by_shard(self, ids, call):
+        """call(shard, ids) for each shard that has some of `ids`, at once"""
+        shard_ids = [[] for _ in self.shards]
+        for chunk_id in ids:
+            shard_ids[shard_of(chunk_id, len(self.shards))].append(chunk_id)
+        busy = [(shard, ids) for shard, ids in zip(self.shards, shard_ids) if ids]
+        return list(self._executor.map(lambda item: call(*item), busy))
+
+    def _write(self, method, ids, documents, embeddings, metadatas):
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        shard_rows = [[] for _ in self.shards]
+        for row, chunk_id in enumerate(ids):
+            shard_rows[shard_of(chunk_id, len(self.shards))].append(row)
+
+        def write(shard, rows):
+            batch = {"ids": [ids[row] for row in rows]}
+            for name, column in [
+                ("documents", documents),
+                ("embeddings", embeddings),
+                ("metadatas", metadatas),
+            ]:
+                if isinstance(column, np.ndarray):
+                    batch[name] = column[rows]
+                elif column is not None:
+                    batch[name] = [column[row] for row in rows]
+            getattr(shard, method)(**batch)
+
+        busy = [(shard, rows) for shard, rows in zip(self.shards, shard_rows) if rows]
+        with span("shard_write", method=method, items=len(ids), shards=len(busy)):
+            list(self._executor.map(lambda item: write(*item), busy))
+
+
+def shard_of(chunk_id, shards):
+    """Which of `shards` shards a chunk belongs in. Stable across runs and machines, unlike
+    hash(), and spreads python_rag_ingest.chunk_ids() evenly."""
+    return int(text_hash(chunk_id)[:8], 16) % shards
+
+
+def shard_names(name, shards):
+    """Collection names for `shards` shards of `name`. One shard is just `name`, so an
+    unsharded collection can be opened the same way."""
+    if shards < 1:
+        raise ValueError(f"Expected at least one shard, got {shards}")
+    return [name] if shards == 1 else [f"{name}_{i}_of_{shards}" for i in range(shards)]
+
+
+def chroma_shards(name, shards, create=False):
+    """ShardedCollection over the `shards` chroma collections of `name`.
+
+    They're spread round robin over the servers in CHROMA_SHARD_HOSTS ("host:port,..."),
+    so each shard's writes and queries can use a different machine, or all live on the
+    CHROMA_HOST server if that isn't set. `create` creates missing shards."""
+    import python_rag_common
+
+    hosts = os.environ.get("CHROMA_SHARD_HOSTS")
+    if hosts:
+        import chromadb
+
+        clients = []
+        for address in hosts.split(","):
+            host, _, port = address.strip().rpartition(":")
+            clients.append(chromadb.HttpClient(host=host, port=int(port)))
+    else:
+        clients = [python_rag_common.get_chroma_http_client()]
+
+    collections = []
+    for i, shard_name in enumerate(shard_names(name, shards)):
+        client = clients[i % len(clients)]
+        if create:
+            collections.append(client.get_or_create_collection(name=shard_name))
+        else:
+            collections.append(client.get_collection(name=shard_name))
+    return ShardedCollection(collections)
+
+
+def local_shard_paths(path):
+    """The finished local shards in directory `path`, in shard order"""
+    if not os.path.isdir(path):
+        return []
+    names = [name for name in os.listdir(path) if name.startswith(LOCAL_SHARD_PREFIX)]
+    paths = [
+        os.path.join(path, name)
+        for name in sorted(names, key=lambda name: int(name[len(LOCAL_SHARD_PREFIX) :]))
+    ]
+    return [shard for shard in paths if os.path.exists(os.path.join(shard, "manifest.json"))]
+
+
+def write_local_shards(path, shards, precision="int8", ann=False):
+    """ShardedCollection of `shards` MappedStoreWriters in `path`/shard-N. Close it (or use
+    it as a context manager) to finish them, then open them with open_local_shards(). If
+    it's aborted, or the with block raises, none of them are finished."""
+    import python_rag_store
+
+    return ShardedCollection(
+        [
+            python_rag_store.MappedStoreWriter(
+                os.path.join(path, f"{LOCAL_SHARD_PREFIX}{i}"),
+                precision,
+                name=f"{LOCAL_SHARD_PREFIX}{i}",
+                ann=ann,
+            )
+            for i in range(shards)
+        ]
+    )
+
+
+def open_local_shards(path, embedding_function=None, processes=None, nprobe=None):
+    """ShardedCollection over the local shards in `path`, searched in a process pool.
+
+    Every worker opens every shard once when it starts. They're memory-mapped, so that's
+    instant and the workers share one copy of them through the page cache. A query then
+    scans all shards at the same time on up to `processes` (default: one per shard, at most
+    one per CPU) cores."""
+    paths = local_shard_paths(path)
+    if not paths:
+        raise ValueError(f"{path}: No local shards found")
+    pool = ProcessPoolExecutor(
+        max_workers=processes or min(len(paths), os.cpu_count()),
+        initializer=_open_worker_shards,
+        initargs=(paths, nprobe),
+    )
+    _open_pools.add(pool)
+    return ShardedCollection(
+        [_ProcessShard(pool, shard) for shard in paths], embedding_function, pool=pool
+    )
+
+
+class _ProcessShard:
+    """Stand-in for a MappedVectorStore that lives in the pool's worker processes"""
+
+    def __init__(self, pool, path):
+        self.name = os.path.basename(path)
+        self.id = path
+        self._pool = pool
+        self._path = path
+        # The store is read only, so its count is the manifest's. Reading it here keeps
+        # count() (which python_rag_cache.collection_version() calls for every cached
+        # answer lookup) from being a round trip to a worker.
+        with open(os.path.join(path, "manifest.json")) as file:
+            self._count = json.load(file)["count"]
+
+    def count(self):
+        return self._count
+
+    def get(self, **kwargs):
+        return self._call("get", **kwargs)
+
+    def query(self, **kwargs):
+        return self._call("query", **kwargs)
+
+    def _call(self, method, **kwargs):
+        return self._pool.submit(_call_worker_shard, self._path, method, kwargs).result()
+
+
+# Pools of collections that weren't closed. A pool that's garbage collected while the
+# interpreter exits can race with concurrent.futures' own exit handler (and print a "Bad
+# file descriptor" traceback), so they're kept until the handler has shut them down.
+_open_pools = set()
+# The shards a pool worker has open, by path
+_worker_shards = {}
+
+
+def _open_worker_shards(paths, nprobe):
+    import python_rag_store
+
+    for path in paths:
+        _worker_shards[path] = python_rag_store.MappedVectorStore(path, nprobe=nprobe)
+
+
+def _call_worker_shard(path, method, kwargs):
+    return getattr(_worker_shards[path], method)(**kwargs)
+
+
+def _concatenate(parts, include):
+    """collection.get() results from several shards as one"""
+    if not parts:
+        # None of the shards had any of the IDs asked for
+        include = ["metadatas", "documents"] if include is None else include
+        return {key: [] if key in include else None for key in GET_KEYS} | {"ids": []}
+    result = dict(parts[0])
+    for key in GET_KEYS:
+        if all(part.get(key) is not None for part in parts):
+            result[key] = [item for part in parts for item in part[key]]
+    return result
@@ -0,0 +1,219 @@
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+
+import numpy as np
+from python_rag_ingest import make_text_splitter, server_batch_size
+from python_rag_metrics import count, span
+
+DEFAULT_SNAPSHOT_DIR = ".cache/snapshots"
+# Bumped whenever the file layout changes, so old snapshots are rebuilt rather than misread
+SNAPSHOT_FORMAT = 2
+
+
+class SnapshotWriter:
+    """Passes add() through to a collection and writes every row to a snapshot at `path`
+    as it goes, so whatever builds the index leaves a snapshot of it behind.
+
+    A snapshot is a directory: the embeddings as raw float32 rows, one JSON line per chunk
+    (its ID, document and metadata) and snapshot.json saying what they were made from. Rows
+    go straight to disk, so writing one doesn't hold anything more in memory than the
+    batch being added. It's written next to `path` and only moved there by close(), so a
+    build that raised (or abort()) never leaves a snapshot that looks finished.
+
+    Rows need their embeddings (pass `embed_fn` to add_chunks_in_batches()): a snapshot
+    is only worth having if loading it doesn't embed anything."""
+
+    def __init__(self, collection, path, model, sources):
+        self.collection = collection
+        self.path = path
+        self.model = model
+        self.sources = sources
+        self.dimensions = None
+        self._size = 0
+        self._partial = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(self._partial, ignore_errors=True)
+        os.makedirs(self._partial)
+        self._embeddings = open(os.path.join(self._partial, "embeddings.f32"), "wb")
+        self._records = open(os.path.join(self._partial, "records.jsonl"), "w")
+
+    def add(self, ids, documents=None, embeddings=None, metadatas=None):
+        if embeddings is None:
+            raise ValueError("SnapshotWriter needs embeddings")
+        self.collection.add(
+            ids=ids, documents=documents, embeddings=embeddings, metadatas=metadatas
+        )
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        self.dimensions = vectors.shape[1]
+        self._embeddings.write(vectors.tobytes())
+        for i, chunk_id in enumerate(ids):
+            record = {
+                "id": chunk_id,
+                "document": documents[i] if documents is not None else None,
+                "metadata": metadatas[i] if metadatas is not None else None,
+            }
+            self._records.write(json.dumps(record) + "\n")
+        self._size += len(ids)
+
+    def close(self):
+        """Finish the snapshot and put it at `path`, in place of any older one"""
+        self._embeddings.close()
+        self._records.close()
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "model": self.model,
+            "splitter": splitter_settings(),
+            "sources": source_hashes(self.sources),
+            "count": self._size,
+            "dimensions": self.dimensions or 0,
+        }
+        with open(os.path.join(self._partial, "snapshot.json"), "w") as file:
+            json.dump(header, file)
+        with span("snapshot_save", items=self._size):
+            # A directory can't replace one that has files in it, so the old snapshot is
+            # moved out of the way first
+            stale = f"{self.path}.{os.getpid()}.stale"
+            if os.path.exists(self.path):
+                os.replace(self.path, stale)
+            os.replace(self._partial, self.path)
+            shutil.rmtree(stale, ignore_errors=True)
+
+    def abort(self):
+        """Throw the snapshot away"""
+        self._embeddings.close()
+        self._records.close()
+        shutil.rmtree(self._partial, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def restore_or_build(collection, path, model, sources, build):
+    """Fill `collection` from the snapshot at `path`, or by calling `build(writer)` if
+    there's no snapshot that matches `model` and `sources`.
+
+    `build` adds the chunks to `writer` (with their embeddings) like it would to the
+    collection; they're passed through and written as a new snapshot at `path`. With
+    `path` None it just builds."""
+    if path is None:
+        build(collection)
+        return
+    header = load_snapshot(path, model, sources)
+    if header is not None:
+        add_snapshot(collection, path, header)
+        return
+    with SnapshotWriter(collection, path, model, sources) as writer:
+        build(writer)
+
+
+def load_snapshot(path, model, sources):
+    """The header of the snapshot at `path`, or None if there isn't one or it's out of
+    date: a source file changed, or it was made with a different embedding model or
+    splitter"""
+    header_path = os.path.join(path, "snapshot.json")
+    if not os.path.exists(header_path):
+        count("snapshot_misses")
+        return None
+    with open(header_path) as file:
+        header = json.load(file)
+    current = (
+        header.get("format") == SNAPSHOT_FORMAT
+        and header["model"] == model
+        and header["splitter"] == splitter_settings()
+        and header["sources"] == source_hashes(sources)
+    )
+    if not current:
+        count("snapshot_stale")
+        return None
+    count("snapshot_hits")
+    return header
+
+
+def add_snapshot(collection, path, header):
+    """Add the snapshot at `path` to a collection, as many rows per add() as the collection
+    takes. The embeddings are memory mapped and the records read a batch at a time, so only
+    one batch is in memory at once."""
+    size = header["count"]
+    if not size:
+        return
+    embeddings = np.memmap(
+        os.path.join(path, "embeddings.f32"),
+        dtype=np.float32,
+        mode="r",
+        shape=(size, header["dimensions"]),
+    )
+    batch_size = server_batch_size(collection)
+    with span("snapshot_load", items=size), open(os.path.join(path, "records.jsonl")) as file:
+        for start, lines in enumerate(itertools.batched(file, batch_size)):
+            records = [json.loads(line) for line in lines]
+            rows = slice(start * batch_size, start * batch_size + len(records))
+            collection.add(
+                ids=[record["id"] for record in records],
+                documents=[record["document"] for record in records],
+                embeddings=np.array(embeddings[rows]),
+                metadatas=_metadatas([record["metadata"] for record in records]),
+            )
+
+
+def snapshot_path(sources, model, snapshot_dir=None):
+    """Where the snapshot of `sources` embedded with `model` goes by default:
+    SNAPSHOT_DIR (or .cache/snapshots)/<first source>-<model>"""
+    snapshot_dir = snapshot_dir or os.environ.get("SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR)
+    name = re.sub(r"[^\w.-]", "_", f"{Path(sources[0]).name}-{model}")
+    return os.path.join(snapshot_dir, name)
+
+
+def source_hashes(sources):
+    """SHA-256 of each source file's bytes, by path"""
+    hashes = {}
+    for source in sources:
+        with open(source, "rb") as file:
+            hashes[str(source)] = hashlib.file_digest(file, "sha256").hexdigest()
+    return hashes
+
+
+def splitter_settings():
+    """The settings of the splitter the scripts use, which decide what the chunks are"""
+    splitter = make_text_splitter()
+    return {
+        "chunk_size": splitter.chunk_size,
+        "chunk_overlap": splitter.chunk_overlap,
+        "separators": splitter.separators,
+    }
+
+
+def add_snapshot_arguments(parser):
+    parser.add_argument(
+        "--snapshot",
+        help="load the chunks and embeddings from this directory instead of re-embedding the "
+        "source, and write it when the source or model changed "
+        f"(default: under {DEFAULT_SNAPSHOT_DIR})",
+    )
+    parser.add_argument(
+        "--no-snapshot",
+        default=False,
+        action="store_true",
+        help="always rebuild the index from the source, and don't write a snapshot",
+    )
+
+
+def snapshot_path_from_args(args, sources, model):
+    """The add_snapshot_arguments() snapshot directory, or None with --no-snapshot"""
+    if args.no_snapshot:
+        return None
+    return args.snapshot or snapshot_path(sources, model)
+
+
+def _metadatas(metadatas):
+    # chroma rejects a list of all None metadatas, but takes no metadatas at all
+    return None if all(metadata is None for metadata in metadatas) else metadatas
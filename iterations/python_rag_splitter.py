@@ -0,0 +1,177 @@
+import itertools
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Same order as langchain's RecursiveCharacterTextSplitter: paragraphs, lines, words, characters
+SEPARATORS = ["\n\n", "\n", " ", ""]
+# Texts longer than this are split in segments of about this many characters, one per worker
+SEGMENT_CHARS = 1 << 18
+
+
+class TextSplitter:
+    """langchain's RecursiveCharacterTextSplitter (with its defaults: separators kept at the
+    start of a piece, whitespace stripped) producing the same chunks, but as offsets.
+
+    spans() returns (doc_id, start, end) tuples rather than copies of the text, so chunks
+    can point back into the source (for citations, or to widen a chunk to its neighbours)
+    without keeping the text twice. Long texts can be split in parallel segments.
+    split_text() gives the strings, so it can stand in for the langchain splitter."""
+
+    def __init__(self, chunk_size=500, chunk_overlap=100, separators=SEPARATORS):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Got a larger chunk overlap ({chunk_overlap}) than chunk size ({chunk_size})"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators)
+
+    def split_text(self, text):
+        return [text[start:end] for _, start, end in self.spans(text)]
+
+    def spans(self, text, doc_id=None, processes=0):
+        """(doc_id, start, end) for each chunk of `text`, in order.
+
+        With `processes` > 1, text longer than two SEGMENT_CHARS is cut into segments at
+        paragraph (or whichever separator the whole text splits on first) boundaries and the
+        segments are split in a process pool. Only the chunks around each cut are then
+        re-split, so the result is exactly what splitting it in one go would give."""
+        separator = self._separator(text, 0, len(text), self.separators)
+        cuts = []
+        if processes > 1 and separator and len(text) > 2 * SEGMENT_CHARS:
+            cuts = _segment_cuts(text, separator, SEGMENT_CHARS)
+        if cuts:
+            chunks = self._split_segments(text, separator, cuts, processes)
+        else:
+            chunks = list(self._split(text, 0, len(text), self.separators, separator))
+        spans = []
+        for start, end, depth in chunks:
+            if depth is not None:
+                start, end = _strip(text, start, end)
+            if start < end:
+                spans.append((doc_id, start, end))
+        return spans
+
+    def _split_segments(self, text, separator, cuts, processes):
+        bounds = [0, *cuts, len(text)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(_split_segment, self, text[start:stop], separator, start)
+                for start, stop in zip(bounds, bounds[1:])
+            ]
+            chunks = futures[0].result()
+            for cut, stop, future in zip(cuts, bounds[2:], futures[1:]):
+                chunks = self._stitch(text, separator, chunks, cut, stop, future.result())
+        return chunks
+
+    def _stitch(self, text, separator, chunks, cut, stop, segment_chunks):
+        """Join the chunks before a cut with the chunks of the segment after it.
+
+        The last chunk before the cut may have been cut short, and the segment's first
+        chunks are missing the overlap from it. Merging depends only on where a chunk
+        starts, so re-splitting from the start of that last chunk puts things right: as soon
+        as it produces a chunk the segment also has, the rest of the segment is correct."""
+        start, _, depth = chunks[-1]
+        if depth != 0:
+            # Ended inside a piece too big to merge, which was split on its own anyway
+            return chunks + segment_chunks
+        known = {
+            (chunk_start, chunk_end): i
+            for i, (chunk_start, chunk_end, _) in enumerate(segment_chunks)
+        }
+        redone = []
+        for chunk in self._split(text, start, stop, self.separators, separator):
+            i = known.get(chunk[:2])
+            if i is not None and chunk[0] >= cut:
+                return chunks[:-1] + redone + segment_chunks[i:]
+            redone.append(chunk)
+        return chunks[:-1] + redone
+
+    def _separator(self, text, start, end, separators):
+        for separator in separators:
+            if not separator or text.find(separator, start, end) != -1:
+                return separator
+        return separators[-1]
+
+    def _split(self, text, start, end, separators, separator=None, depth=0):
+        """Yield (start, end, depth) for the chunks of text[start:end], before whitespace is
+        stripped. `depth` counts how many times a piece was split again for being too big,
+        and is None for a piece that couldn't be split any further (which isn't stripped)."""
+        if separator is None:
+            separator = self._separator(text, start, end, separators)
+        remaining = separators[separators.index(separator) + 1 :] if separator else []
+
+        # Each piece starts with the separator in front of it. They're found lazily, so
+        # re-splitting across a cut in _stitch() only scans as far as it needs to.
+        if separator:
+            matches = re.compile(re.escape(separator)).finditer(text, start, end)
+            bounds = itertools.chain(
+                [start], (m.start() for m in matches if m.start() > start), [end]
+            )
+        else:
+            bounds = range(start, end + 1)
+
+        # Neighbouring pieces are joined greedily into chunks of up to chunk_size, each
+        # chunk starting with up to chunk_overlap characters from the end of the last one.
+        # Pieces too big for a chunk are split again with the next separator.
+        current = deque()
+        total = 0
+        for piece_start, piece_end in itertools.pairwise(bounds):
+            length = piece_end - piece_start
+            if length >= self.chunk_size:
+                if current:
+                    yield current[0][0], current[-1][1], depth
+                    current.clear()
+                    total = 0
+                if remaining:
+                    yield from self._split(text, piece_start, piece_end, remaining, depth=depth + 1)
+                else:
+                    yield piece_start, piece_end, None
+                continue
+            if current and total + length > self.chunk_size:
+                yield current[0][0], current[-1][1], depth
+                while total > self.chunk_overlap or (total + length > self.chunk_size and total):
+                    first_start, first_end = current.popleft()
+                    total -= first_end - first_start
+            current.append((piece_start, piece_end))
+            total += length
+        if current:
+            yield current[0][0], current[-1][1], depth
+
+
+def _split_segment(splitter, segment, separator, offset):
+    """Process pool task: the chunks of one segment, as offsets into the whole text"""
+    return [
+        (start + offset, end + offset, depth)
+        for start, end, depth in splitter._split(
+            segment, 0, len(segment), splitter.separators, separator
+        )
+    ]
+
+
+def _segment_cuts(text, separator, segment_chars):
+    """Offsets of separators roughly every `segment_chars` characters.
+
+    Only separators that splitting the whole text would find: in a run like "\n\n\n" the
+    split happens at the first "\n\n", not the second, so each search starts from a
+    character that can't be part of a separator."""
+    not_separator = re.compile(f"[^{re.escape(''.join(set(separator)))}]")
+    cuts = []
+    position = segment_chars
+    while position < len(text) - segment_chars:
+        outside = not_separator.search(text, position)
+        cut = text.find(separator, outside.start()) if outside else -1
+        if cut == -1:
+            break
+        cuts.append(cut)
+        position = cut + segment_chars
+    return cuts
+
+
+def _strip(text, start, end):
+    """text[start:end].strip() as offsets"""
+    piece = text[start:end]
+    stripped = piece.lstrip()
+    start += len(piece) - len(stripped)
+    return start, start + len(stripped.rstrip())
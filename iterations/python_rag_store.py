@@ -0,0 +1,503 @@
+import json
+import os
+import uuid
+
+import numpy as np
+from python_rag_ann import IVFFlatIndex, load_index
+from python_rag_cache import text_hash
+
+INCLUDE_DEFAULT = ["metadatas", "documents", "distances"]
+# How MappedStoreWriter can store the vectors it searches first. float32 keeps them exact.
+PRECISIONS = ["float32", "float16", "int8"]
+# Rows scored at once when scanning a mapped store, so a scan never converts the whole
+# index to float32 in memory
+SCAN_BLOCK_ROWS = 16384
+
+
+class NumpyVectorStore:
+    """Lightweight in-process replacement for an ephemeral ChromaDB collection.
+
+    Vectors live in one contiguous float32 matrix with every row normalized when it's added,
+    so a query is a single matrix multiply followed by an argpartition for the top k. It has
+    the parts of the collection API the scripts use (add, upsert, get, delete, query, count,
+    peek) and returns results in the same shape chroma does. Distances are cosine distances
+    (1 - cosine similarity).
+
+    With an `index` (python_rag_ann.IVFFlatIndex) queries only score the rows the index
+    picks out, which is approximate but scales to corpora too big to scan every query."""
+
+    def __init__(self, name="numpy_store", embedding_function=None, dimensions=None, index=None):
+        self.name = name
+        self.id = uuid.uuid4()
+        self.embedding_function = embedding_function
+        self.index = index
+        self._matrix = np.empty((0, dimensions or 0), dtype=np.float32)
+        self._size = 0
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._rows = {}
+
+    # -- writing
+
+    def add(self, ids, documents=None, embeddings=None, metadatas=None):
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        duplicates = [i for i in ids if i in self._rows]
+        if duplicates or len(set(ids)) != len(ids):
+            raise ValueError(f"Duplicate ids: {duplicates or ids}")
+        vectors = self._vectors(embeddings, documents, len(ids))
+        self._append(vectors)
+        if self.index is not None:
+            self.index.add(self._matrix, self._size - len(ids), self._size)
+        for i, chunk_id in enumerate(ids):
+            self._rows[chunk_id] = len(self._ids)
+            self._ids.append(chunk_id)
+            self._documents.append(documents[i] if documents is not None else None)
+            self._metadatas.append(metadatas[i] if metadatas is not None else None)
+
+    def upsert(self, ids, documents=None, embeddings=None, metadatas=None):
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        self.delete(ids=[i for i in ids if i in self._rows])
+        self.add(ids, documents, embeddings, metadatas)
+
+    def delete(self, ids=None, where=None):
+        doomed = set(ids or []) | set(self.get(where=where, include=[])["ids"] if where else [])
+        doomed &= self._rows.keys()
+        if not doomed:
+            return
+        keep = [row for row, chunk_id in enumerate(self._ids) if chunk_id not in doomed]
+        self._matrix = np.ascontiguousarray(self._matrix[keep])
+        self._size = len(keep)
+        self._ids = [self._ids[row] for row in keep]
+        self._documents = [self._documents[row] for row in keep]
+        self._metadatas = [self._metadatas[row] for row in keep]
+        self._rows = {chunk_id: row for row, chunk_id in enumerate(self._ids)}
+        if self.index is not None:
+            self.index.remap(keep)
+
+    # -- reading
+
+    def count(self):
+        return self._size
+
+    def get(self, ids=None, where=None, limit=None, offset=0, include=None):
+        include = ["metadatas", "documents"] if include is None else include
+        if ids is not None:
+            ids = [ids] if isinstance(ids, str) else ids
+            rows = [row for row in map(self._row_of, ids) if row is not None]
+        else:
+            rows = range(self._size)
+        if where:
+            rows = [row for row in rows if _matches(self._metadata(row), where)]
+        rows = list(rows)[offset : offset + limit if limit is not None else None]
+        return self._result(rows, include)
+
+    def peek(self, limit=10):
+        return self.get(limit=limit)
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=10, include=None):
+        """Nearest neighbours for one or more queries, best match first"""
+        include = INCLUDE_DEFAULT if include is None else include
+        if query_embeddings is None:
+            texts = [query_texts] if isinstance(query_texts, str) else query_texts
+            query_embeddings = self.embedding_function(texts)
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis, :]
+        queries = _normalize(queries)
+
+        result = {key: [] for key in ["ids", "documents", "metadatas", "distances"]}
+        for rows, row_scores in self._top_k(queries, min(n_results, self._size)):
+            row_result = self._result(rows.tolist(), ["documents", "metadatas"])
+            for key in ["ids", "documents", "metadatas"]:
+                result[key].append(row_result[key])
+            result["distances"].append((1.0 - row_scores).tolist())
+        return {
+            "ids": result["ids"],
+            "documents": result["documents"] if "documents" in include else None,
+            "metadatas": result["metadatas"] if "metadatas" in include else None,
+            "distances": result["distances"] if "distances" in include else None,
+            "embeddings": None,
+            "included": include,
+        }
+
+    # -- persistence
+
+    def save(self, path):
+        """Write the store to a directory: vectors as .npy and everything else as JSON"""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.npy"), self._matrix[: self._size])
+        if self.index is not None and self.index.is_trained:
+            self.index.save(os.path.join(path, "ivf.npz"))
+        with open(os.path.join(path, "records.json"), "w") as file:
+            json.dump(
+                {
+                    "name": self.name,
+                    "ids": self._ids,
+                    "documents": self._documents,
+                    "metadatas": self._metadatas,
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, path, embedding_function=None, mmap=True):
+        """Load a saved store. With `mmap` the vectors are memory mapped rather than read,
+        so startup doesn't depend on the size of the index. The first write copies them
+        into memory."""
+        with open(os.path.join(path, "records.json")) as file:
+            records = json.load(file)
+        store = cls(records["name"], embedding_function, index=load_index(path))
+        store._matrix = np.load(
+            os.path.join(path, "embeddings.npy"), mmap_mode="r" if mmap else None
+        )
+        store._size = len(records["ids"])
+        store._ids = records["ids"]
+        store._documents = records["documents"]
+        store._metadatas = records["metadatas"]
+        store._rows = {chunk_id: row for row, chunk_id in enumerate(store._ids)}
+        return store
+
+    # -- internals
+
+    def _vectors(self, embeddings, documents, expected):
+        if embeddings is None:
+            if self.embedding_function is None:
+                raise ValueError("Embeddings are required when there's no embedding function")
+            embeddings = self.embedding_function(list(documents))
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(expected, -1)
+        return _normalize(vectors)
+
+    def _append(self, vectors):
+        """Add rows to the matrix, growing its capacity geometrically so repeated small
+        adds don't copy the whole matrix every time"""
+        needed = self._size + len(vectors)
+        if self._matrix.shape[1] != vectors.shape[1] and self._size == 0:
+            self._matrix = np.empty((0, vectors.shape[1]), dtype=np.float32)
+        if needed > self._matrix.shape[0] or not self._matrix.flags.writeable:
+            capacity = max(needed, self._matrix.shape[0] * 2, 64)
+            grown = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            grown[: self._size] = self._matrix[: self._size]
+            self._matrix = grown
+        self._matrix[self._size : needed] = vectors
+        self._size = needed
+
+    def _top_k(self, queries, k):
+        """(rows, scores) of the k best rows for each query, best first"""
+        if not k:
+            return [_best(None, 0) for _ in queries]
+        if self.index is not None and self.index.is_trained:
+            top = []
+            for query, rows in zip(queries, self.index.probe(queries, min_rows=k)):
+                best, scores = _best(self._matrix[rows] @ query, min(k, len(rows)))
+                top.append((rows[best], scores))
+            return top
+        # One matrix multiply scores every query against every row
+        scores = queries @ self._matrix[: self._size].T
+        return [_best(query_scores, k) for query_scores in scores]
+
+    def _row_of(self, chunk_id):
+        """The row `chunk_id` is in, or None"""
+        return self._rows.get(chunk_id)
+
+    def _metadata(self, row):
+        return self._metadatas[row]
+
+    def _result(self, rows, include):
+        result = {"ids": [self._ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [self._documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadatas[row] for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = self._matrix[rows]
+        return result
+
+
+class MappedStoreWriter:
+    """Streams chunks into an on-disk store that MappedVectorStore can open.
+
+    Has the same add() as a collection, so python_rag_ingest.add_chunks_in_batches() can
+    write to it. Each batch is packed into float32 (plus its float16 or int8 copy) and
+    appended to the files straight away, so only one batch is ever in memory no matter
+    how big the corpus is (apart from an 8 byte hash of each ID, for the ID lookup table
+    close() writes). Use it as a context manager or call close() to finish. The store
+    only gets its manifest when it's finished, so one whose build raised (or that abort()
+    was called on) is never opened as if it was complete.
+
+    With `ann` close() also trains an IVFFlatIndex over the finished store (when it has
+    enough rows) for MappedVectorStore to search with."""
+
+    def __init__(self, path, precision="int8", name="mapped_store", ann=False):
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}")
+        os.makedirs(path, exist_ok=True)
+        # Rewriting a store: it stops being a finished one before its files are truncated
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            os.remove(os.path.join(path, "manifest.json"))
+        self.path = path
+        self.precision = precision
+        self.name = name
+        self.ann = ann
+        self.dimensions = None
+        self._size = 0
+        self._ids = set()
+        self._id_hashes = []
+        self._vectors = open(os.path.join(path, "vectors.f32"), "wb")
+        self._records = open(os.path.join(path, "records.jsonl"), "wb")
+        # Where each record starts in records.jsonl, so readers can map the file instead of
+        # loading it
+        self._offsets = open(os.path.join(path, "records.offsets"), "wb")
+        self._records_size = 0
+        self._codes = None
+        self._scales = None
+        if precision != "float32":
+            self._codes = open(os.path.join(path, f"codes.{precision}"), "wb")
+        if precision == "int8":
+            self._scales = open(os.path.join(path, "scales.f32"), "wb")
+
+    def add(self, ids, documents=None, embeddings=None, metadatas=None):
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        if embeddings is None:
+            raise ValueError("MappedStoreWriter needs embeddings")
+        duplicates = [i for i in ids if i in self._ids]
+        if duplicates or len(set(ids)) != len(ids):
+            raise ValueError(f"Duplicate ids: {duplicates or ids}")
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1))
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Expected {self.dimensions} dimensions, got {vectors.shape[1]}")
+
+        self._vectors.write(vectors.tobytes())
+        if self.precision == "float16":
+            self._codes.write(vectors.astype(np.float16).tobytes())
+        elif self.precision == "int8":
+            codes, scales = _quantize_int8(vectors)
+            self._codes.write(codes.tobytes())
+            self._scales.write(scales.tobytes())
+        offsets = np.empty(len(ids), dtype=np.int64)
+        for i, chunk_id in enumerate(ids):
+            record = {
+                "id": chunk_id,
+                "document": documents[i] if documents is not None else None,
+                "metadata": metadatas[i] if metadatas is not None else None,
+            }
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            offsets[i] = self._records_size
+            self._records.write(line)
+            self._records_size += len(line)
+        self._offsets.write(offsets.tobytes())
+        self._id_hashes.append(np.array([_id_hash(chunk_id) for chunk_id in ids], np.uint64))
+        self._ids.update(ids)
+        self._size += len(ids)
+
+    def count(self):
+        return self._size
+
+    def close(self):
+        self._offsets.write(np.array([self._records_size], dtype=np.int64).tobytes())
+        self.abort()
+        hashes = np.concatenate(self._id_hashes) if self._id_hashes else np.empty(0, np.uint64)
+        _write_id_table(self.path, hashes)
+        if self.ann and self._size:
+            vectors = np.memmap(
+                os.path.join(self.path, "vectors.f32"),
+                dtype=np.float32,
+                mode="r",
+                shape=(self._size, self.dimensions),
+            )
+            index = IVFFlatIndex()
+            index.add(vectors, 0, self._size)
+            if index.is_trained:
+                index.save(os.path.join(self.path, "ivf.npz"))
+        # The manifest goes last, so a store that was never finished can't be opened
+        manifest = {
+            "name": self.name,
+            "count": self._size,
+            "dimensions": self.dimensions or 0,
+            "precision": self.precision,
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as file:
+            json.dump(manifest, file)
+
+    def abort(self):
+        """Close the files without finishing the store, so it can't be opened"""
+        for file in [self._vectors, self._records, self._offsets, self._codes, self._scales]:
+            if file is not None:
+                file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class MappedVectorStore(NumpyVectorStore):
+    """Read-only store over a directory written by MappedStoreWriter.
+
+    The vector files are memory mapped rather than read, so opening is instant, memory use
+    doesn't grow with the corpus and every process that opens the same store shares one
+    copy of it through the OS page cache. Queries scan the compact float16/int8 copy to find
+    `n_results * rerank` candidates and then re-rank those exactly against their float32
+    rows, which only pulls a handful of pages of the full-size file in.
+
+    The chunks' documents and metadata are memory mapped too and only decoded for the rows
+    a get() or query() returns, and IDs are looked up in a mapped table of their hashes, so
+    opening a store doesn't read any of it into the process.
+
+    If the writer built an IVF index (ann=True) only the rows in the `nprobe` nearest lists
+    are scanned instead of all of them."""
+
+    def __init__(self, path, embedding_function=None, rerank=4, nprobe=None):
+        with open(os.path.join(path, "manifest.json")) as file:
+            manifest = json.load(file)
+        super().__init__(manifest["name"], embedding_function, index=load_index(path))
+        if self.index is not None and nprobe:
+            self.index.nprobe = nprobe
+        self.path = path
+        self.precision = manifest["precision"]
+        self.rerank = rerank
+        self._size = manifest["count"]
+        shape = (self._size, manifest["dimensions"])
+
+        def mapped(filename, dtype, shape):
+            if not self._size:
+                return np.zeros(shape, dtype=dtype)
+            return np.memmap(os.path.join(path, filename), dtype=dtype, mode="r", shape=shape)
+
+        self._matrix = mapped("vectors.f32", np.float32, shape)
+        self._codes = self._matrix
+        self._scales = None
+        if self.precision != "float32":
+            self._codes = mapped(f"codes.{self.precision}", self.precision, shape)
+        if self.precision == "int8":
+            self._scales = mapped("scales.f32", np.float32, (self._size,))
+
+        if not os.path.exists(os.path.join(path, "records.offsets")):
+            raise ValueError(f"{path}: No records.offsets, write it again with MappedStoreWriter")
+        self._offsets = mapped("records.offsets", np.int64, (self._size + 1,))
+        self._records = mapped("records.jsonl", np.uint8, (int(self._offsets[-1]),))
+        self._id_hashes = mapped("ids.hashes", np.uint64, (self._size,))
+        self._id_rows = mapped("ids.rows", np.int64, (self._size,))
+
+    def add(self, *args, **kwargs):
+        raise ValueError(f"{self.name} is read only, write it with MappedStoreWriter")
+
+    upsert = add
+    delete = add
+
+    def _record(self, row):
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(self._records[start:end].tobytes())
+
+    def _row_of(self, chunk_id):
+        hashes = self._id_hashes
+        chunk_hash = _id_hash(chunk_id)
+        i = np.searchsorted(hashes, chunk_hash)
+        # Different IDs can share a hash, so the record says whether it's really this one
+        while i < len(hashes) and hashes[i] == chunk_hash:
+            row = int(self._id_rows[i])
+            if self._record(row)["id"] == chunk_id:
+                return row
+            i += 1
+        return None
+
+    def _metadata(self, row):
+        return self._record(row)["metadata"]
+
+    def _result(self, rows, include):
+        records = [self._record(row) for row in rows]
+        result = {"ids": [record["id"] for record in records]}
+        if "documents" in include:
+            result["documents"] = [record["document"] for record in records]
+        if "metadatas" in include:
+            result["metadatas"] = [record["metadata"] for record in records]
+        if "embeddings" in include:
+            result["embeddings"] = self._matrix[rows]
+        return result
+
+    def _top_k(self, queries, k):
+        if not k:
+            return [_best(None, 0) for _ in queries]
+        candidate_count = min(self._size, k * self.rerank)
+        if self.index is not None and self.index.is_trained:
+            top = []
+            for query, rows in zip(queries, self.index.probe(queries, min_rows=k)):
+                block = self._codes[rows].astype(np.float32)
+                scores = block @ query
+                if self._scales is not None:
+                    scores *= self._scales[rows]
+                best, best_scores = _best(scores, min(len(rows), candidate_count))
+                if self.precision == "float32":
+                    top.append((rows[best[:k]], best_scores[:k]))
+                else:
+                    top.append(self._exact(query, rows[best], k))
+            return top
+
+        scores = np.empty((len(queries), self._size), dtype=np.float32)
+        for start in range(0, self._size, SCAN_BLOCK_ROWS):
+            block = self._codes[start : start + SCAN_BLOCK_ROWS].astype(np.float32)
+            block_scores = queries @ block.T
+            if self._scales is not None:
+                block_scores *= self._scales[start : start + SCAN_BLOCK_ROWS]
+            scores[:, start : start + len(block)] = block_scores
+        if self.precision == "float32":
+            return [_best(query_scores, k) for query_scores in scores]
+        top = []
+        for query, query_scores in zip(queries, scores):
+            candidates, _ = _best(query_scores, candidate_count)
+            top.append(self._exact(query, candidates, k))
+        return top
+
+    def _exact(self, query, candidates, k):
+        """The k best of `candidates` scored against their float32 rows"""
+        # Reading rows in file order keeps the page cache access sequential-ish
+        candidates = np.sort(candidates)
+        exact = self._matrix[candidates] @ query
+        rows, row_scores = _best(exact, min(k, len(candidates)))
+        return candidates[rows], row_scores
+
+
+def _id_hash(chunk_id):
+    return np.uint64(int(text_hash(chunk_id)[:16], 16))
+
+
+def _write_id_table(path, hashes):
+    """ids.hashes (sorted ID hashes) and ids.rows (the row of each), for looking IDs up
+    with a binary search"""
+    rows = np.argsort(hashes, kind="stable")
+    hashes[rows].tofile(os.path.join(path, "ids.hashes"))
+    rows.astype(np.int64).tofile(os.path.join(path, "ids.rows"))
+
+
+def _best(scores, k):
+    if not k:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    rows = candidates[np.argsort(-scores[candidates])]
+    return rows, scores[rows]
+
+
+def _quantize_int8(vectors):
+    """Symmetric per-row int8 codes: row ~= codes * scale"""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _matches(metadata, where):
+    """Equality-only subset of chroma's `where` filters"""
+    metadata = metadata or {}
+    return all(metadata.get(key) == value for key, value in where.items())